@@ -2,9 +2,35 @@ import sys
 import sqlite3
 import os
 import json
+import io
+import csv
+import gzip
+import math
+import bisect
+import gc
+import hashlib
+import ipaddress
+import marshal
+import mmap
+import struct
+from array import array
+import threading
+import queue
+import functools
+import heapq
+import itertools
+import tracemalloc
+from urllib.parse import urlsplit
+from html.parser import HTMLParser
+import re
+import argparse
 import zipfile
 import tempfile
 import shutil
+import time
+import random
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
 from datetime import datetime
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QLineEdit, QPushButton, QFrame, QLabel, QToolBar, QTabWidget,
@@ -15,14 +41,19 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QH
                              QFormLayout, QScrollArea, QSizePolicy, QStackedWidget, QTreeWidget,
                              QTreeWidgetItem, QHeaderView, QDockWidget, QToolBar, QSystemTrayIcon,
                              QSplashScreen, QGraphicsDropShadowEffect, QButtonGroup, QRadioButton,
-                             QGridLayout, QSpacerItem, QTabBar, QStylePainter, QStyleOptionTab)
+                             QGridLayout, QSpacerItem, QTabBar, QStylePainter, QStyleOptionTab, QCompleter,
+                             QTableView, QAbstractItemView, QProgressDialog)
 from PyQt5.QtCore import (Qt, QTimer, QUrl, QSize, QSettings, QPoint, QRect, QPropertyAnimation, 
-                          QEasingCurve, QThread, pyqtSignal, QDateTime, QTime, QDate, QEvent, QSizeF)
+                          QEasingCurve, QThread, pyqtSignal, QDateTime, QTime, QDate, QEvent, QSizeF,
+                          QStandardPaths, QObject, QFileSystemWatcher, QAbstractTableModel, QModelIndex,
+                          QCoreApplication, QBuffer, QIODevice)
 from PyQt5.QtGui import (QFont, QColor, QIcon, QPalette, QKeySequence, QPainter, QPen, QBrush,
                          QLinearGradient, QRadialGradient, QConicalGradient, QPixmap, QMovie,
-                         QDesktopServices, QFontDatabase, QClipboard, QGuiApplication)
-from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEngineProfile, QWebEnginePage, QWebEngineSettings
-from PyQt5.QtWebEngineCore import QWebEngineUrlRequestInterceptor, QWebEngineHttpRequest
+                         QDesktopServices, QFontDatabase, QClipboard, QGuiApplication, QStandardItemModel,
+                         QStandardItem)
+from PyQt5.QtWebEngineWidgets import (QWebEngineView, QWebEngineProfile, QWebEnginePage, QWebEngineSettings,
+                                      QWebEngineScript)
+from PyQt5.QtWebEngineCore import QWebEngineUrlRequestInterceptor, QWebEngineUrlRequestInfo, QWebEngineHttpRequest
 from PyQt5.QtPrintSupport import QPrintDialog, QPrinter
 
 # ==============================
@@ -500,6 +531,60 @@ class ThemeManager:
     def get_available_themes(self):
         return ['dark', 'light', 'blue']
 
+class BrowserPage(QWebEnginePage):
+    COSMETIC_SCRIPT_NAME = 'nexus-cosmetic-filters'
+    
+    # History visit types, weighted differently in frecency
+    VISIT_TYPES = {
+        'NavigationTypeLinkClicked': 'link',
+        'NavigationTypeTyped': 'typed',
+        'NavigationTypeFormSubmitted': 'form',
+        'NavigationTypeBackForward': 'back_forward',
+        'NavigationTypeReload': 'reload',
+        'NavigationTypeRedirect': 'redirect'
+    }
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.visit_type = 'link'
+        self.visit_types = {}
+        for name, visit_type in self.VISIT_TYPES.items():
+            if hasattr(QWebEnginePage, name):
+                self.visit_types[int(getattr(QWebEnginePage, name))] = visit_type
+                
+        # Qt 5.13 and later filter each page's requests separately, so blocks are known per tab
+        self.request_interceptor = None
+        if hasattr(self, 'setUrlRequestInterceptor'):
+            self.request_interceptor = PageRequestInterceptor(self)
+            self.setUrlRequestInterceptor(self.request_interceptor)
+            
+    def acceptNavigationRequest(self, url, navigation_type, is_main_frame):
+        # Swap in the element hiding script for the new host before the document is created
+        if is_main_frame:
+            self.visit_type = self.visit_types.get(int(navigation_type), 'other')
+            self.update_cosmetic_filters(url.host())
+        return super().acceptNavigationRequest(url, navigation_type, is_main_frame)
+        
+    def update_cosmetic_filters(self, host):
+        scripts = self.scripts()
+        old_script = scripts.findScript(self.COSMETIC_SCRIPT_NAME)
+        if not old_script.isNull():
+            scripts.remove(old_script)
+            
+        request_filter = install_request_interceptor().request_filter
+        if not host or not request_filter.adblock_enabled:
+            return
+            
+        source = request_filter.adblock_engine.cosmetic.script_for_host(host)
+        if source:
+            script = QWebEngineScript()
+            script.setName(self.COSMETIC_SCRIPT_NAME)
+            script.setSourceCode(source)
+            script.setInjectionPoint(QWebEngineScript.DocumentCreation)
+            script.setWorldId(QWebEngineScript.ApplicationWorld)
+            script.setRunsOnSubFrames(False)
+            scripts.insert(script)
+
 class AdvancedWebView(QWebEngineView):
     # Custom signals
     faviconChanged = pyqtSignal(QIcon)
@@ -507,7 +592,10 @@ class AdvancedWebView(QWebEngineView):
     
     def __init__(self, parent=None):
         super().__init__(parent)
+        self.setPage(BrowserPage(self))
         self._favicon = QIcon()
+        self.blocked_requests = 0
+        self.loadStarted.connect(self.on_load_started)
         self.loadProgress.connect(self.on_load_progress)
         self.iconChanged.connect(self.on_icon_changed)
         
@@ -525,6 +613,9 @@ class AdvancedWebView(QWebEngineView):
         self.settings().setAttribute(QWebEngineSettings.SpatialNavigationEnabled, True)
         self.settings().setAttribute(QWebEngineSettings.HyperlinkAuditingEnabled, True)
         
+    def on_load_started(self):
+        self.blocked_requests = 0
+        
     def on_load_progress(self, progress):
         self.loadingProgress.emit(progress)
         
@@ -541,359 +632,4021 @@ class AdvancedWebView(QWebEngineView):
         new_browser.page().setUrl(self.page().requestedUrl())
         return new_browser
 
-class EnhancedURLInterceptor(QWebEngineUrlRequestInterceptor):
-    def __init__(self, adblock_enabled=True, safe_browsing_enabled=True):
-        super().__init__()
-        self.adblock_enabled = adblock_enabled
-        self.safe_browsing_enabled = safe_browsing_enabled
+class MultiPatternMatcher:
+    # Every pattern is filed under one fixed-length gram it contains, so a lookup
+    # only verifies the patterns whose gram occurs in the URL instead of the whole list
+    GRAM_SIZE = 4
+    
+    # Grams found in nearly every URL make poor keys
+    COMMON_GRAMS = frozenset(['http', 'ttp:', 'tp:/', 'p://', 'ttps', 'tps:', 'ps:/', 's://',
+                              '://w', '//ww', '/www', 'www.', '.com', 'com/', '.net', '.org'])
+    
+    def __init__(self, patterns=()):
+        self._buckets = {}
+        self._short_patterns = []
+        self._size = 0
         
-        # Load adblock rules
-        self.adblock_rules = self.load_adblock_rules()
-        self.malicious_domains = {"malicious-site.com", "phishing-attempt.net", "dangerous-domain.org"}
+        for pattern in patterns:
+            self.add(pattern)
+            
+    def __len__(self):
+        return self._size
         
-    def load_adblock_rules(self):
-        # Load adblock rules from file
-        rules = set()
-        try:
-            rules_file = os.path.join(
-                QStandardPaths.writableLocation(QStandardPaths.AppDataLocation),
-                'adblock_rules.txt'
-            )
+    def add(self, pattern, payload=None):
+        if payload is None:
+            payload = pattern
             
-            if os.path.exists(rules_file):
-                with open(rules_file, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line and not line.startswith('!'):
-                            rules.add(line)
-        except:
-            pass
+        size = self.GRAM_SIZE
+        if len(pattern) < size:
+            self._short_patterns.append((pattern, payload))
+        else:
+            # File the pattern under its least crowded gram to keep buckets short
+            best_gram = None
+            best_cost = None
+            for i in range(len(pattern) - size + 1):
+                gram = pattern[i:i + size]
+                cost = len(self._buckets.get(gram, ()))
+                if gram in self.COMMON_GRAMS:
+                    cost += 1000000
+                if best_cost is None or cost < best_cost:
+                    best_gram, best_cost = gram, cost
+                    if cost == 0:
+                        break
+            self._buckets.setdefault(best_gram, []).append((pattern, payload))
+            
+        self._size += 1
+        
+    def candidates(self, text):
+        size = self.GRAM_SIZE
+        grams = {text[i:i + size] for i in range(len(text) - size + 1)}
+        buckets = self._buckets
+        
+        for gram in buckets.keys() & grams:
+            yield from buckets[gram]
+        yield from self._short_patterns
+        
+    def search(self, text):
+        for pattern, payload in self.candidates(text):
+            if pattern in text:
+                return payload
+        return None
+        
+    def to_state(self, encode):
+        buckets = {gram: [(pattern, encode(payload)) for pattern, payload in bucket]
+                   for gram, bucket in self._buckets.items()}
+        short_patterns = [(pattern, encode(payload)) for pattern, payload in self._short_patterns]
+        return buckets, short_patterns, self._size
+        
+    @classmethod
+    def from_state(cls, state, decode):
+        buckets, short_patterns, size = state
+        matcher = cls()
+        matcher._buckets = {gram: [(pattern, decode(payload)) for pattern, payload in bucket]
+                            for gram, bucket in buckets.items()}
+        matcher._short_patterns = [(pattern, decode(payload)) for pattern, payload in short_patterns]
+        matcher._size = size
+        return matcher
+
+# Request types understood by filter options, as bits so a filter's allowed types is one mask
+ADBLOCK_TYPE_BITS = {
+    'other': 1,
+    'script': 2,
+    'image': 4,
+    'stylesheet': 8,
+    'object': 16,
+    'subdocument': 32,
+    'document': 64,
+    'xmlhttprequest': 128,
+    'ping': 256,
+    'media': 512,
+    'font': 1024,
+    'websocket': 2048,
+    'popup': 4096
+}
+
+ADBLOCK_TYPE_ALIASES = {
+    'xhr': 'xmlhttprequest',
+    'css': 'stylesheet',
+    'frame': 'subdocument',
+    'doc': 'document',
+    'beacon': 'ping',
+    'object-subrequest': 'object'
+}
+
+ADBLOCK_ALL_TYPES = sum(ADBLOCK_TYPE_BITS.values())
+
+# Filters without type options never apply to page navigations or popups
+ADBLOCK_DEFAULT_TYPES = ADBLOCK_ALL_TYPES & ~(ADBLOCK_TYPE_BITS['document'] | ADBLOCK_TYPE_BITS['popup'])
+
+# Used when no public_suffix_list.dat (https://publicsuffix.org/list/) is installed in the app data folder
+PUBLIC_SUFFIX_FALLBACK = """
+com net org edu gov mil int info biz name pro mobi app dev io ai co me tv cc xyz online site top
+uk co.uk org.uk ac.uk gov.uk ltd.uk plc.uk me.uk net.uk sch.uk nhs.uk
+jp co.jp ne.jp or.jp ac.jp go.jp gr.jp
+au com.au net.au org.au edu.au gov.au asn.au id.au
+nz co.nz org.nz net.nz ac.nz govt.nz
+br com.br net.br org.br gov.br edu.br
+cn com.cn net.cn org.cn gov.cn edu.cn
+in co.in net.in org.in gov.in ac.in firm.in
+za co.za org.za gov.za ac.za
+kr co.kr or.kr go.kr ac.kr
+mx com.mx org.mx gob.mx
+tr com.tr org.tr gov.tr
+hk com.hk org.hk
+sg com.sg org.sg
+tw com.tw org.tw
+ar com.ar
+ru de fr nl it es ca us eu ch se no dk fi pl be at cz pt gr ie il ua
+*.ck !www.ck
+github.io gitlab.io blogspot.com herokuapp.com appspot.com cloudfront.net azurewebsites.net
+netlify.app vercel.app pages.dev workers.dev web.app firebaseapp.com s3.amazonaws.com
+"""
+
+class PublicSuffixList:
+    # Public suffix rules in a trie of reversed labels; '' marks a rule ending at that node
+    def __init__(self, lines=()):
+        self._root = {}
+        for line in lines:
+            for rule in line.split():
+                if rule.startswith('//'):
+                    break
+                self.add_rule(rule)
+                
+    def add_rule(self, rule):
+        rule = rule.strip().lower()
+        if not rule:
+            return
+        exception = rule.startswith('!')
+        labels = rule.lstrip('!').split('.')
+        if exception:
+            # "!www.ck" is stored as a "!www" marker under "ck"
+            labels[0] = '!' + labels[0]
+            
+        node = self._root
+        for label in reversed(labels):
+            node = node.setdefault(label, {})
+        node[''] = True
+        
+    def suffix_length(self, labels):
+        # Number of trailing labels that form the public suffix; unlisted TLDs count as one
+        length = 1
+        node = self._root
+        for depth, label in enumerate(reversed(labels), 1):
+            if '!' + label in node:
+                return depth - 1
+            child = node.get(label)
+            if child is None:
+                child = node.get('*')
+                if child is None:
+                    break
+            if '' in child:
+                length = depth
+            node = child
+        return length
+        
+    def registrable_domain(self, host):
+        host = host.lower().rstrip('.')
+        if not host or host[-1].isdigit() or ':' in host:
+            # IP addresses have no public suffix
+            return host
+        labels = host.split('.')
+        length = self.suffix_length(labels)
+        if len(labels) <= length:
+            return host
+        return '.'.join(labels[-length - 1:])
+
+_public_suffix_list = None
+_public_suffix_list_lock = threading.Lock()
+
+def public_suffix_list():
+    # Built once per process from the installed list, or the fallback when there is none
+    global _public_suffix_list
+    
+    with _public_suffix_list_lock:
+        if _public_suffix_list is None:
+            lines = PUBLIC_SUFFIX_FALLBACK.splitlines()
+            try:
+                path = os.path.join(app_data_dir(), 'public_suffix_list.dat')
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        lines = f.read().splitlines()
+            except OSError:
+                pass
+            _public_suffix_list = PublicSuffixList(lines)
+            
+    return _public_suffix_list
+    
+@functools.lru_cache(maxsize=16384)
+def registrable_domain(host):
+    # eTLD+1 of a host name, e.g. news.bbc.co.uk -> bbc.co.uk
+    return public_suffix_list().registrable_domain(host)
+
+class AdblockFilter:
+    # A single network filter in Adblock Plus syntax
+    STATE_FIELDS = ('text', 'pattern', 'is_exception', 'is_regex', 'match_case', 'type_mask', 'third_party',
+                    'include_domains', 'exclude_domains', 'important', 'host', 'host_only', 'literal')
+    
+    def __init__(self, text, pattern, is_exception=False, is_regex=False, match_case=False,
+                 type_mask=ADBLOCK_DEFAULT_TYPES, third_party=None, include_domains=(),
+                 exclude_domains=(), important=False):
+        self.text = text
+        self.pattern = pattern
+        self.is_exception = is_exception
+        self.is_regex = is_regex
+        self.match_case = match_case
+        self.type_mask = type_mask
+        self.third_party = third_party
+        self.include_domains = frozenset(include_domains)
+        self.exclude_domains = frozenset(exclude_domains)
+        self.important = important
+        self._regex = None
+        
+        # Index keys: a host name for "||host^" filters, otherwise the longest literal run
+        self.host = None
+        self.host_only = False
+        self.literal = ''
+        self._find_index_keys()
+            
+    @classmethod
+    def parse(cls, line):
+        text = line.strip()
+        if not text or text.startswith(('!', '[')):
+            return None
+            
+        # Element hiding rules are not network filters
+        if '##' in text or '#@#' in text or '#?#' in text or '#$#' in text:
+            return None
+            
+        rule = text
+        is_exception = rule.startswith('@@')
+        if is_exception:
+            rule = rule[2:]
+            
+        options = []
+        is_regex = len(rule) > 1 and rule.startswith('/') and rule.endswith('/')
+        if not is_regex:
+            dollar = rule.rfind('$')
+            if dollar >= 0 and cls._looks_like_options(rule[dollar + 1:]):
+                options = rule[dollar + 1:].split(',')
+                rule = rule[:dollar]
+                is_regex = len(rule) > 1 and rule.startswith('/') and rule.endswith('/')
+                
+        kwargs = {'is_exception': is_exception, 'is_regex': is_regex}
+        include_types = 0
+        exclude_types = 0
+        include_domains = []
+        exclude_domains = []
+        
+        for option in options:
+            name, _, value = option.strip().lower().partition('=')
+            negated = name.startswith('~')
+            name = name.lstrip('~')
+            name = ADBLOCK_TYPE_ALIASES.get(name, name)
+            
+            if name in ADBLOCK_TYPE_BITS:
+                if negated:
+                    exclude_types |= ADBLOCK_TYPE_BITS[name]
+                else:
+                    include_types |= ADBLOCK_TYPE_BITS[name]
+            elif name == 'all':
+                include_types |= ADBLOCK_ALL_TYPES
+            elif name in ('third-party', '3p'):
+                kwargs['third_party'] = not negated
+            elif name in ('first-party', '1p'):
+                kwargs['third_party'] = negated
+            elif name == 'domain' and value:
+                for domain in value.split('|'):
+                    if domain.startswith('~'):
+                        exclude_domains.append(domain[1:])
+                    elif domain:
+                        include_domains.append(domain)
+            elif name == 'match-case':
+                kwargs['match_case'] = True
+            elif name == 'important':
+                kwargs['important'] = True
+            elif name == 'collapse':
+                pass
+            else:
+                # Unsupported options change what a filter means, so drop the filter
+                return None
+                
+        if include_types:
+            kwargs['type_mask'] = include_types & ~exclude_types
+        elif exclude_types:
+            kwargs['type_mask'] = ADBLOCK_DEFAULT_TYPES & ~exclude_types
             
-        return rules
+        if is_regex:
+            rule = rule[1:-1]
+            try:
+                re.compile(rule)
+            except re.error:
+                return None
+                
+        return cls(text, rule, include_domains=include_domains, exclude_domains=exclude_domains, **kwargs)
+        
+    def to_state(self):
+        return tuple(getattr(self, field) for field in self.STATE_FIELDS)
+        
+    @classmethod
+    def from_state(cls, state):
+        # Skips parsing and index key analysis, which were done when the state was saved
+        adblock_filter = cls.__new__(cls)
+        adblock_filter.__dict__.update(zip(cls.STATE_FIELDS, state))
+        adblock_filter._regex = None
+        return adblock_filter
+        
+    @staticmethod
+    def _looks_like_options(text):
+        if not text:
+            return False
+        for option in text.split(','):
+            name = option.strip().partition('=')[0]
+            if not re.fullmatch(r'~?[a-z0-9][a-z0-9_-]*', name.lower()):
+                return False
+        return True
         
-    def interceptRequest(self, info):
-        url = info.requestUrl().toString()
-        domain = info.requestUrl().host()
+    def _find_index_keys(self):
+        pattern = self.pattern.lower()
         
-        # Safe browsing check
-        if self.safe_browsing_enabled:
-            if any(malicious in domain for malicious in self.malicious_domains):
-                info.block(True)
-                print(f"Blocked malicious domain: {domain}")
+        if self.is_regex:
+            self.literal = self._regex_literal(pattern)
+            return
+            
+        if pattern.startswith('||'):
+            rest = pattern[2:]
+            match = re.match(r'[a-z0-9-]+(?:\.[a-z0-9-]+)*', rest)
+            if match and rest[match.end():match.end() + 1] in ('^', '/'):
+                self.host = match.group(0)
+                self.host_only = rest[match.end():] in ('^', '^|')
                 return
                 
-        # Adblock check
-        if self.adblock_enabled:
-            for rule in self.adblock_rules:
-                if rule in url:
-                    info.block(True)
-                    print(f"Blocked ad/tracker: {url}")
-                    return
+        pieces = re.split(r'[*^|]', pattern)
+        self.literal = max(pieces, key=len) if pieces else ''
+        
+    @staticmethod
+    def _regex_literal(pattern):
+        # Longest run of plain characters every match has to contain. Alternations and groups
+        # can route around any run, so those regexes stay unindexed.
+        if '|' in pattern or '(' in pattern:
+            return ''
+            
+        # Escapes and classes become separators; counted repeats make the previous character optional
+        cleaned = re.sub(r'\\.', '\0', pattern)
+        cleaned = re.sub(r'\[[^\]]*\]', '\0', cleaned)
+        cleaned = re.sub(r'\{[^}]*\}', '?', cleaned)
+        
+        literal = ''
+        for match in re.finditer(r'[a-z0-9/_=&,;:%-]+', cleaned):
+            run = match.group(0)
+            if cleaned[match.end():match.end() + 1] in ('?', '*'):
+                run = run[:-1]
+            if len(run) > len(literal):
+                literal = run
+        return literal
+        
+    def regex_source(self):
+        if self.is_regex:
+            return self.pattern
+            
+        pattern = self.pattern
+        regex = ''
+        if pattern.startswith('||'):
+            regex = r'^[a-z][a-z0-9+.-]*:/+(?:[^/?#]*\.)?'
+            pattern = pattern[2:]
+        elif pattern.startswith('|'):
+            regex = '^'
+            pattern = pattern[1:]
+            
+        end = ''
+        if pattern.endswith('|'):
+            end = '$'
+            pattern = pattern[:-1]
+            
+        for char in pattern:
+            if char == '*':
+                regex += '.*'
+            elif char == '^':
+                regex += r'(?:[^\w.%-]|$)'
+            else:
+                regex += re.escape(char)
+                
+        return regex + end
+        
+    @property
+    def regex(self):
+        # Compiled on first use so loading a large list stays cheap
+        if self._regex is None:
+            self._regex = re.compile(self.regex_source(), 0 if self.match_case else re.IGNORECASE)
+        return self._regex
+        
+    def matches_domain(self, source_host):
+        if not self.include_domains and not self.exclude_domains:
+            return True
+            
+        # The most specific listed domain decides
+        domain = source_host
+        while domain:
+            if domain in self.exclude_domains:
+                return False
+            if domain in self.include_domains:
+                return True
+            domain = domain.partition('.')[2]
+            
+        return not self.include_domains
+        
+    def matches(self, url, source_host, type_bit, third_party):
+        if not self.type_mask & type_bit:
+            return False
+        if self.third_party is not None and self.third_party != third_party:
+            return False
+        if not self.matches_domain(source_host):
+            return False
+        if self.host_only:
+            return True
+        return self.regex.search(url) is not None
 
-class EnhancedHistoryManager:
+class AdblockFilterBuckets:
+    # Filters grouped by how they can be looked up: by host name, by literal, or neither
     def __init__(self):
-        self.conn = sqlite3.connect('browser_history.db')
-        self.create_tables()
+        self.host_filters = {}
+        self.token_matcher = MultiPatternMatcher()
+        self.generic_filters = []
+        self.count = 0
+        self.type_mask = 0
+        
+    def add(self, adblock_filter):
+        if adblock_filter.host:
+            self.host_filters.setdefault(adblock_filter.host, []).append(adblock_filter)
+        elif len(adblock_filter.literal) >= MultiPatternMatcher.GRAM_SIZE:
+            self.token_matcher.add(adblock_filter.literal, adblock_filter)
+        else:
+            self.generic_filters.append(adblock_filter)
+        self.count += 1
+        self.type_mask |= adblock_filter.type_mask
         
-    def create_tables(self):
-        cursor = self.conn.cursor()
+    def find(self, url, url_lower, host, source_host, type_bit, third_party):
+        if not self.count:
+            return None
+            
+        # Host anchored filters: look up the request host and each parent domain
+        if self.host_filters:
+            domain = host
+            while domain:
+                for adblock_filter in self.host_filters.get(domain, ()):
+                    if adblock_filter.matches(url, source_host, type_bit, third_party):
+                        return adblock_filter
+                domain = domain.partition('.')[2]
+                
+        for literal, adblock_filter in self.token_matcher.candidates(url_lower):
+            if literal in url_lower and adblock_filter.matches(url, source_host, type_bit, third_party):
+                return adblock_filter
+                
+        for adblock_filter in self.generic_filters:
+            if adblock_filter.matches(url, source_host, type_bit, third_party):
+                return adblock_filter
+                
+        return None
+        
+    def to_state(self, encode):
+        host_filters = {host: [encode(f) for f in filters] for host, filters in self.host_filters.items()}
+        return (host_filters, self.token_matcher.to_state(encode),
+                [encode(f) for f in self.generic_filters], self.count, self.type_mask)
+        
+    @classmethod
+    def from_state(cls, state, decode):
+        host_filters, matcher_state, generic_filters, count, type_mask = state
+        buckets = cls()
+        buckets.host_filters = {host: [decode(i) for i in filters] for host, filters in host_filters.items()}
+        buckets.token_matcher = MultiPatternMatcher.from_state(matcher_state, decode)
+        buckets.generic_filters = [decode(i) for i in generic_filters]
+        buckets.count = count
+        buckets.type_mask = type_mask
+        return buckets
+
+class CosmeticFilterSet:
+    # Element hiding rules of one list: "##selector", "domain,~domain##selector" and "#@#" exceptions
+    UNSUPPORTED_SEPARATORS = ('#?#', '#$#', '#@?#', '#@$#')
+    
+    def __init__(self):
+        self.generic = []
+        self.by_domain = {}
+        self.exceptions = {}
+        
+    def __len__(self):
+        return (len(self.generic) + sum(len(selectors) for selectors in self.by_domain.values())
+                + sum(len(selectors) for selectors in self.exceptions.values()))
+        
+    def add(self, line):
+        # Returns False for lines that are not element hiding rules
+        line = line.strip()
+        if line.startswith('!') or any(separator in line for separator in self.UNSUPPORTED_SEPARATORS):
+            return '#' in line and not line.startswith('!')
+            
+        is_exception = '#@#' in line
+        domains, separator, selector = line.partition('#@#' if is_exception else '##')
+        selector = selector.strip()
+        if not separator:
+            return False
+        if not selector or ':-abp-' in selector or '{' in selector:
+            # Procedural selectors and style injection need a content script engine
+            return True
+            
+        include = []
+        for domain in domains.lower().split(','):
+            domain = domain.strip()
+            if domain.startswith('~'):
+                # "~example.com##.ad" hides everywhere except example.com
+                self.exceptions.setdefault(domain[1:], []).append(selector)
+            elif domain:
+                include.append(domain)
+                
+        if is_exception:
+            for domain in include or ['']:
+                self.exceptions.setdefault(domain, []).append(selector)
+        elif include:
+            for domain in include:
+                self.by_domain.setdefault(domain, []).append(selector)
+        else:
+            self.generic.append(selector)
+        return True
         
-        # Check if the old table exists and migrate it
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='history'")
-        old_table_exists = cursor.fetchone()
+    def to_state(self):
+        return self.generic, self.by_domain, self.exceptions
         
-        if old_table_exists:
-            # Check if the old table has the old schema
-            cursor.execute("PRAGMA table_info(history)")
-            columns = [column[1] for column in cursor.fetchall()]
+    @classmethod
+    def from_state(cls, state):
+        cosmetic = cls()
+        cosmetic.generic, cosmetic.by_domain, cosmetic.exceptions = state
+        return cosmetic
+
+class CosmeticFilterEngine:
+    # Element hiding stylesheets: one shared generic sheet built up front, plus per-host
+    # selectors found by looking up the host and its parent domains
+    HIDE_RULE = ' { display: none !important; }'
+    
+    # One invalid selector voids its whole rule, so keep rules small
+    SELECTORS_PER_RULE = 50
+    
+    def __init__(self, cosmetic_sets=()):
+        global_exceptions = set()
+        self.by_domain = {}
+        self.exceptions = {}
+        generic = {}
+        
+        for cosmetic in cosmetic_sets:
+            global_exceptions.update(cosmetic.exceptions.get('', ()))
+            generic.update(dict.fromkeys(cosmetic.generic))
+            for domain, selectors in cosmetic.by_domain.items():
+                self.by_domain.setdefault(domain, []).extend(selectors)
+            for domain, selectors in cosmetic.exceptions.items():
+                if domain:
+                    self.exceptions.setdefault(domain, set()).update(selectors)
+                    
+        self.generic_selectors = [selector for selector in generic if selector not in global_exceptions]
+        self.generic_set = frozenset(self.generic_selectors)
+        self.generic_css = self.stylesheet(self.generic_selectors)
+        self._scripts = OrderedDict()
+        self._generic_script = self.injection_script(self.generic_css)
+        
+    @classmethod
+    def stylesheet(cls, selectors):
+        selectors = list(selectors)
+        size = cls.SELECTORS_PER_RULE
+        return '\n'.join(', '.join(selectors[i:i + size]) + cls.HIDE_RULE for i in range(0, len(selectors), size))
+        
+    @staticmethod
+    def injection_script(css):
+        if not css:
+            return ''
+        return ("(function() {\n"
+                "    var style = document.createElement('style');\n"
+                f"    style.textContent = {json.dumps(css)};\n"
+                "    (document.head || document.documentElement).appendChild(style);\n"
+                "})();")
+        
+    def stylesheet_for_host(self, host):
+        specific = []
+        exceptions = set()
+        domain = host.lower()
+        while domain:
+            specific.extend(self.by_domain.get(domain, ()))
+            exceptions.update(self.exceptions.get(domain, ()))
+            domain = domain.partition('.')[2]
             
-            if 'visit_count' not in columns:
-                # This is the old schema, we need to migrate
-                print("Migrating history database to new schema...")
+        if not specific and not exceptions:
+            return self.generic_css
+            
+        if exceptions & self.generic_set:
+            generic_css = self.stylesheet(s for s in self.generic_selectors if s not in exceptions)
+        else:
+            generic_css = self.generic_css
+        specific_css = self.stylesheet(s for s in dict.fromkeys(specific) if s not in exceptions)
+        return generic_css + '\n' + specific_css if specific_css else generic_css
+        
+    def script_for_host(self, host):
+        # Source of the document-start script for a page on host, memoized per host
+        script = self._scripts.get(host)
+        if script is None:
+            css = self.stylesheet_for_host(host)
+            script = self._generic_script if css is self.generic_css else self.injection_script(css)
+            self._scripts[host] = script
+            if len(self._scripts) > 256:
+                self._scripts.popitem(last=False)
+        else:
+            self._scripts.move_to_end(host)
+        return script
+
+class AdblockFilterList:
+    # The compiled filters of one list file
+    def __init__(self, name, lines=()):
+        self.name = name
+        self.blocking = AdblockFilterBuckets()
+        self.important = AdblockFilterBuckets()
+        self.exceptions = AdblockFilterBuckets()
+        self.documents = AdblockFilterBuckets()
+        self.cosmetic = CosmeticFilterSet()
+        
+        for line in lines:
+            self.add_filter(line)
+            
+    def add_filter(self, line):
+        if '#' in line and self.cosmetic.add(line):
+            return None
+            
+        adblock_filter = AdblockFilter.parse(line)
+        if adblock_filter is None:
+            return None
+            
+        if adblock_filter.is_exception:
+            self.exceptions.add(adblock_filter)
+            
+            # "@@||site^$document" turns blocking off for every request the page makes, so these
+            # are also matched against the page itself
+            if adblock_filter.type_mask & ADBLOCK_TYPE_BITS['document']:
+                self.documents.add(adblock_filter)
+        elif adblock_filter.important:
+            self.important.add(adblock_filter)
+        else:
+            self.blocking.add(adblock_filter)
+        return adblock_filter
+        
+    def __len__(self):
+        return self.blocking.count + self.important.count + self.exceptions.count
+        
+    def to_state(self):
+        filters = []
+        indexes = {}
+        
+        def encode(adblock_filter):
+            key = id(adblock_filter)
+            if key not in indexes:
+                indexes[key] = len(filters)
+                filters.append(adblock_filter.to_state())
+            return indexes[key]
+            
+        buckets = [group.to_state(encode) for group in (self.blocking, self.important, self.exceptions, self.documents)]
+        return self.name, filters, buckets, self.cosmetic.to_state()
+        
+    @classmethod
+    def from_state(cls, state):
+        name, filter_states, bucket_states, cosmetic_state = state
+        filters = [AdblockFilter.from_state(filter_state) for filter_state in filter_states]
+        
+        filter_list = cls(name)
+        filter_list.blocking, filter_list.important, filter_list.exceptions, filter_list.documents = (
+            AdblockFilterBuckets.from_state(bucket_state, filters.__getitem__) for bucket_state in bucket_states
+        )
+        filter_list.cosmetic = CosmeticFilterSet.from_state(cosmetic_state)
+        return filter_list
+
+# Compiled filter list cache: magic, format version, SHA-256 of the source list, marshalled state
+ADBLOCK_CACHE_MAGIC = b'NXFL'
+ADBLOCK_CACHE_VERSION = 5
+ADBLOCK_CACHE_HEADER = struct.Struct('<4sI32s')
+
+# Filter lists already loaded in this process, shared by every window
+_loaded_filter_lists = {}
+_loaded_filter_lists_lock = threading.Lock()
+
+def app_data_dir(*parts):
+    path = os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppDataLocation), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+    
+@contextmanager
+def gc_paused():
+    # Building many small objects at once triggers collector passes that find nothing to free
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+            
+def available_filter_lists():
+    # adblock_rules.txt plus every list dropped into the filter_lists folder
+    paths = [os.path.join(app_data_dir(), 'adblock_rules.txt')]
+    lists_dir = app_data_dir('filter_lists')
+    paths += sorted(os.path.join(lists_dir, name) for name in os.listdir(lists_dir) if name.endswith('.txt'))
+    return [path for path in paths if os.path.isfile(path)]
+    
+def read_filter_list_cache(cache_path, source_digest):
+    try:
+        # marshal builds its own objects from the data, so each process holds its own copy of the
+        # compiled list whichever way the file is read
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        if len(data) < ADBLOCK_CACHE_HEADER.size:
+            return None
+        magic, version, digest = ADBLOCK_CACHE_HEADER.unpack_from(data)
+        if magic != ADBLOCK_CACHE_MAGIC or version != ADBLOCK_CACHE_VERSION or digest != source_digest:
+            return None
+        state = marshal.loads(memoryview(data)[ADBLOCK_CACHE_HEADER.size:])
+        return AdblockFilterList.from_state(state)
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+        
+def write_filter_list_cache(cache_path, source_digest, filter_list):
+    temp_path = cache_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(ADBLOCK_CACHE_HEADER.pack(ADBLOCK_CACHE_MAGIC, ADBLOCK_CACHE_VERSION, source_digest))
+            f.write(marshal.dumps(filter_list.to_state()))
+        os.replace(temp_path, cache_path)
+    except (OSError, ValueError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+            
+def load_filter_list(path, cache_dir=None):
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).digest()
+    key = (os.path.abspath(path), digest)
+    
+    with _loaded_filter_lists_lock:
+        if key in _loaded_filter_lists:
+            return _loaded_filter_lists[key]
+            
+    name = os.path.basename(path)
+    if cache_dir is None:
+        cache_dir = app_data_dir('adblock_cache')
+    # Lists with the same file name in different directories each get their own cache file
+    path_hash = hashlib.sha256(key[0].encode('utf-8', errors='surrogateescape')).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f'{name}-{path_hash}.bin')
+    
+    with gc_paused():
+        filter_list = read_filter_list_cache(cache_path, digest)
+        if filter_list is None:
+            filter_list = AdblockFilterList(name, data.decode('utf-8', errors='replace').splitlines())
+            write_filter_list_cache(cache_path, digest, filter_list)
+            
+            
+    with _loaded_filter_lists_lock:
+        # Drop older compilations of the same file
+        for old_key in [k for k in _loaded_filter_lists if k[0] == key[0]]:
+            del _loaded_filter_lists[old_key]
+        _loaded_filter_lists[key] = filter_list
+    return filter_list
+
+class AdblockFilterEngine:
+    def __init__(self, filter_lists=()):
+        self.filter_lists = tuple(filter_lists)
+        
+        # Request types at least one blocking filter applies to
+        self.blocking_types = 0
+        for filter_list in self.filter_lists:
+            self.blocking_types |= filter_list.blocking.type_mask | filter_list.important.type_mask
+            
+        # $document exceptions of the lists that have any, checked against the page itself
+        self.documents = [filter_list.documents for filter_list in self.filter_lists if filter_list.documents.count]
+        
+        self.cosmetic = CosmeticFilterEngine(filter_list.cosmetic for filter_list in self.filter_lists)
+        
+    def __len__(self):
+        return sum(len(filter_list) for filter_list in self.filter_lists)
+        
+    def allows_document(self, source_url, source_host=''):
+        # Whether a $document exception allows the page at source_url, and with it everything it loads
+        if not self.documents or not source_url:
+            return False
+        source_host = source_host.lower()
+        args = (source_url, source_url.lower(), source_host, source_host, ADBLOCK_TYPE_BITS['document'], False)
+        return any(documents.find(*args) for documents in self.documents)
+        
+    def match(self, url, host, source_host='', type_bit=ADBLOCK_TYPE_BITS['other'], source_url=''):
+        # Returns the filter that blocks the request, or None when it is allowed. source_url is
+        # the first-party page, checked against $document exceptions
+        if not type_bit & self.blocking_types:
+            # Typically page navigations, which only $document filters can block
+            return None
+        if self.allows_document(source_url, source_host):
+            return None
+            
+        host = host.lower()
+        source_host = source_host.lower()
+        third_party = bool(source_host) and (
+            host != source_host and registrable_domain(host) != registrable_domain(source_host)
+        )
+        args = (url, url.lower(), host, source_host, type_bit, third_party)
+        
+        for filter_list in self.filter_lists:
+            adblock_filter = filter_list.important.find(*args)
+            if adblock_filter:
+                return adblock_filter
                 
-                # Create a temporary table with the new schema
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS history_new (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        url TEXT NOT NULL,
-                        title TEXT NOT NULL,
-                        visit_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        visit_count INTEGER DEFAULT 1
-                    )
-                ''')
+        for filter_list in self.filter_lists:
+            adblock_filter = filter_list.blocking.find(*args)
+            if adblock_filter:
+                break
+        else:
+            return None
+            
+        # Exceptions are only consulted once something would be blocked
+        for filter_list in self.filter_lists:
+            if filter_list.exceptions.find(*args):
+                return None
                 
-                # Copy data from old table to new table
-                cursor.execute('''
-                    INSERT INTO history_new (url, title, visit_time, visit_count)
-                    SELECT url, title, visit_time, 1 FROM history
-                ''')
+        return adblock_filter
+
+class BloomFilter:
+    # Bit array prefilter over 64-bit hashes, using double hashing for the probe positions
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.num_bits = self.bit_count(capacity, error_rate)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        
+    @staticmethod
+    def bit_count(capacity, error_rate=0.01):
+        return max(64, int(-max(1, capacity) * math.log(error_rate) / (math.log(2) ** 2)))
+        
+    def add(self, value):
+        bits = self.bits
+        num_bits = self.num_bits
+        position = value & 0xFFFFFFFF
+        step = (value >> 32) | 1
+        for _ in range(self.num_hashes):
+            position %= num_bits
+            bits[position >> 3] |= 1 << (position & 7)
+            position += step
+            
+    def __contains__(self, value):
+        bits = self.bits
+        num_bits = self.num_bits
+        position = value & 0xFFFFFFFF
+        step = (value >> 32) | 1
+        for _ in range(self.num_hashes):
+            position %= num_bits
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            position += step
+        return True
+
+class ThreatDomainList:
+    # Known bad host names, stored as a sorted array of 64-bit hashes behind a Bloom filter.
+    # A host matches when it or one of its parent domains is listed.
+    CACHE_MAGIC = b'NXTD'
+    CACHE_VERSION = 2
+    
+    # Hosts files list loopback names next to the blocked ones, and comment at the end of lines
+    INLINE_COMMENT = re.compile(r'(?:^|\s)#.*')
+    LOCAL_HOSTS = {'localhost', 'localhost.localdomain', 'local', 'broadcasthost', 'ip6-localhost',
+                   'ip6-loopback', 'ip6-localnet', 'ip6-mcastprefix', 'ip6-allnodes', 'ip6-allrouters'}
+    
+    def __init__(self, domains=()):
+        hashes = {self.domain_hash(domain) for domain in self.normalize_domains(domains)}
+        self._set_hashes(array('Q', sorted(hashes)))
+        
+    def _set_hashes(self, hashes, bloom_bits=None):
+        self.hashes = hashes
+        self.bloom = BloomFilter(len(hashes))
+        if bloom_bits is not None and len(bloom_bits) == len(self.bloom.bits):
+            self.bloom.bits = bloom_bits
+        else:
+            for value in hashes:
+                self.bloom.add(value)
                 
-                # Drop the old table
-                cursor.execute('DROP TABLE history')
+    def __len__(self):
+        return len(self.hashes)
+        
+    @staticmethod
+    def domain_hash(domain):
+        return int.from_bytes(hashlib.blake2b(domain.encode('utf-8'), digest_size=8).digest(), 'little')
+        
+    @classmethod
+    def normalize_domains(cls, lines):
+        # Accepts plain host lists, hosts files ("0.0.0.0 host ...") and "||host^" filters, with
+        # or without trailing "# comments"
+        for line in lines:
+            line = cls.INLINE_COMMENT.sub('', line).strip().lower()
+            if not line or line.startswith('!'):
+                continue
+            parts = line.split()
+            domains = parts[1:] if len(parts) > 1 and cls.is_ip_address(parts[0]) else parts[:1]
+            for domain in domains:
+                domain = domain.strip('|^').lstrip('*.').rstrip('.')
+                if domain and domain not in cls.LOCAL_HOSTS and not cls.is_ip_address(domain):
+                    yield domain
+                    
+    @staticmethod
+    def is_ip_address(text):
+        try:
+            ipaddress.ip_address(text)
+        except ValueError:
+            return False
+        return True
+        
+    def find(self, host):
+        # Returns the listed domain covering host, or None
+        domain = host.lower().rstrip('.')
+        hashes = self.hashes
+        while domain:
+            value = self.domain_hash(domain)
+            if value in self.bloom:
+                index = bisect.bisect_left(hashes, value)
+                if index < len(hashes) and hashes[index] == value:
+                    return domain
+            domain = domain.partition('.')[2]
+        return None
+        
+    def memory_usage(self):
+        return self.hashes.itemsize * len(self.hashes) + len(self.bloom.bits)
+        
+    @classmethod
+    def load(cls, paths, defaults=(), cache_path=None):
+        sources = []
+        for path in paths:
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    sources.append(f.read())
+                    
+        digest = hashlib.sha256()
+        for data in sources:
+            digest.update(hashlib.sha256(data).digest())
+        digest.update('\n'.join(sorted(defaults)).encode('utf-8'))
+        digest = digest.digest()
+        
+        if cache_path:
+            threat_list = cls.read_cache(cache_path, digest)
+            if threat_list is not None:
+                return threat_list
                 
-                # Rename the new table
-                cursor.execute('ALTER TABLE history_new RENAME TO history')
+        lines = list(defaults)
+        for data in sources:
+            lines.extend(data.decode('utf-8', errors='replace').splitlines())
+        threat_list = cls(lines)
+        
+        if cache_path:
+            threat_list.write_cache(cache_path, digest)
+        return threat_list
+        
+    @classmethod
+    def read_cache(cls, cache_path, source_digest):
+        try:
+            with open(cache_path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    header_size = ADBLOCK_CACHE_HEADER.size
+                    magic, version, digest = ADBLOCK_CACHE_HEADER.unpack_from(mapped)
+                    if magic != cls.CACHE_MAGIC or version != cls.CACHE_VERSION or digest != source_digest:
+                        return None
+                    (count,) = struct.unpack_from('<Q', mapped, header_size)
+                    start = header_size + 8
+                    
+                    # A truncated or padded file is rebuilt rather than read as a shorter list
+                    bloom_size = (BloomFilter.bit_count(count) + 7) // 8
+                    if len(mapped) != start + count * 8 + bloom_size:
+                        return None
+                    hashes = array('Q')
+                    hashes.frombytes(mapped[start:start + count * 8])
+                    bloom_bits = bytearray(mapped[start + count * 8:])
+        except (OSError, ValueError, struct.error):
+            return None
+            
+        threat_list = cls.__new__(cls)
+        threat_list._set_hashes(hashes, bloom_bits)
+        return threat_list
+        
+    def write_cache(self, cache_path, source_digest):
+        temp_path = cache_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(ADBLOCK_CACHE_HEADER.pack(self.CACHE_MAGIC, self.CACHE_VERSION, source_digest))
+                f.write(struct.pack('<Q', len(self.hashes)))
+                f.write(self.hashes.tobytes())
+                f.write(self.bloom.bits)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+class DecisionCache:
+    # Bounded LRU of block/allow decisions keyed by (first-party page or host, request URL, resource type)
+    MISSING = object()
+    
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self._entries)
+        
+    def get(self, key):
+        with self._lock:
+            try:
+                decision = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return self.MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return decision
+            
+    def put(self, key, decision, generation=None):
+        with self._lock:
+            # Drop decisions computed against rules that were replaced meanwhile
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = decision
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
                 
-                # Create frequent_sites table
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS frequent_sites (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        url TEXT NOT NULL UNIQUE,
-                        title TEXT NOT NULL,
-                        visit_count INTEGER DEFAULT 1,
-                        last_visit TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+class RequestFilter:
+    # Block decisions for a request, kept free of Qt so the logic can also be driven headless
+    def __init__(self, adblock_engine=None, threat_list=None, adblock_enabled=True, safe_browsing_enabled=True,
+                 cache_size=4096):
+        self.adblock_engine = adblock_engine if adblock_engine is not None else AdblockFilterEngine()
+        self.threat_list = threat_list if threat_list is not None else ThreatDomainList()
+        self.adblock_enabled = adblock_enabled
+        self.safe_browsing_enabled = safe_browsing_enabled
+        self.decision_cache = DecisionCache(cache_size)
+        
+    def set_enabled(self, adblock_enabled, safe_browsing_enabled):
+        self.adblock_enabled = adblock_enabled
+        self.safe_browsing_enabled = safe_browsing_enabled
+        self.decision_cache.clear()
+        
+    def set_adblock_engine(self, engine):
+        self.adblock_engine = engine
+        self.decision_cache.clear()
+        
+    def set_threat_list(self, threat_list):
+        self.threat_list = threat_list
+        self.decision_cache.clear()
+        
+    def check_request(self, url, host, source_host='', type_bit=ADBLOCK_TYPE_BITS['other'], source_url=''):
+        # Returns ('safe_browsing', domain) or ('adblock', filter text) for blocked requests, else None.
+        # A $document exception can allow some pages of a host and not others, so decisions are
+        # keyed by the first-party page when the engine has any, and by its host otherwise
+        generation = self.decision_cache.generation
+        engine = self.adblock_engine
+        document = source_url if engine.documents else source_host
+        key = (document, url, type_bit)
+        decision = self.decision_cache.get(key)
+        if decision is not DecisionCache.MISSING:
+            return decision
+            
+        decision = None
+        page_allowed = self.adblock_enabled and engine.allows_document(source_url, source_host)
+        
+        # Safe browsing check
+        if self.safe_browsing_enabled:
+            domain = self.threat_list.find(host)
+            if domain is not None:
+                decision = ('safe_browsing', domain)
                 
-                # Populate frequent_sites from history
-                cursor.execute('''
-                    INSERT INTO frequent_sites (url, title, visit_count, last_visit)
-                    SELECT url, title, COUNT(*) as visit_count, MAX(visit_time) as last_visit
-                    FROM history
-                    GROUP BY url, title
-                ''')
+        # Adblock check
+        if decision is None and self.adblock_enabled and not page_allowed:
+            adblock_filter = engine.match(url, host, source_host, type_bit)
+            if adblock_filter is not None:
+                decision = ('adblock', adblock_filter.text)
                 
-                self.conn.commit()
-                print("Database migration completed successfully.")
+        self.decision_cache.put(key, decision, generation)
+        return decision
         
-        # Create tables if they don't exist (for new installations)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                url TEXT NOT NULL,
-                title TEXT NOT NULL,
-                visit_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                visit_count INTEGER DEFAULT 1
-            )
-        ''')
+class BlockedRequestLog(QObject):
+    # Blocked requests are appended from Chromium's IO thread and drained on the GUI thread by a
+    # timer, so network dispatch never waits on logging. deque appends and pops are atomic.
+    requestsBlocked = pyqtSignal(list)
+    
+    def __init__(self, capacity=4096, interval=500, parent=None):
+        super().__init__(parent)
+        self._events = deque(maxlen=capacity)
+        self.host_counts = Counter()
+        self.first_party_counts = Counter()
+        self.total_blocked = 0
+        
+        self._timer = QTimer(self)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self.drain)
+        self._timer.start()
+        
+    def record(self, first_party_host, host, url, decision, page=None):
+        # page is the QWebEnginePage that made the request, when its own interceptor caught it
+        self._events.append((first_party_host, host, url, decision[0], decision[1], page))
+        
+    def drain(self):
+        events = []
+        popleft = self._events.popleft
+        while True:
+            try:
+                events.append(popleft())
+            except IndexError:
+                break
+                
+        if events:
+            for first_party_host, host, url, kind, detail, page in events:
+                self.host_counts[host] += 1
+                self.first_party_counts[first_party_host] += 1
+            self.total_blocked += len(events)
+            self.requestsBlocked.emit(events)
+        return events
+
+class EnhancedURLInterceptor(QWebEngineUrlRequestInterceptor):
+    # Filter option names for Qt's request resource types
+    RESOURCE_TYPE_OPTIONS = {
+        'ResourceTypeMainFrame': 'document',
+        'ResourceTypeSubFrame': 'subdocument',
+        'ResourceTypeStylesheet': 'stylesheet',
+        'ResourceTypeScript': 'script',
+        'ResourceTypeImage': 'image',
+        'ResourceTypeFontResource': 'font',
+        'ResourceTypeObject': 'object',
+        'ResourceTypeMedia': 'media',
+        'ResourceTypeFavicon': 'image',
+        'ResourceTypeXhr': 'xmlhttprequest',
+        'ResourceTypePing': 'ping',
+        'ResourceTypePluginResource': 'object',
+        'ResourceTypeNavigationPreloadMainFrame': 'document',
+        'ResourceTypeNavigationPreloadSubFrame': 'subdocument'
+    }
+    
+    def __init__(self, adblock_enabled=True, safe_browsing_enabled=True):
+        super().__init__()
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS frequent_sites (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                url TEXT NOT NULL UNIQUE,
-                title TEXT NOT NULL,
-                visit_count INTEGER DEFAULT 1,
-                last_visit TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        # Load adblock rules
+        self.malicious_domains = {"malicious-site.com", "phishing-attempt.net", "dangerous-domain.org"}
+        self.request_filter = RequestFilter(
+            self.load_adblock_rules(), self.load_threat_list(), adblock_enabled, safe_browsing_enabled
+        )
+        self.block_log = BlockedRequestLog(parent=self)
+        self.list_watcher = None
         
-        self.conn.commit()
+        self.resource_type_bits = {}
+        for name, option in self.RESOURCE_TYPE_OPTIONS.items():
+            if hasattr(QWebEngineUrlRequestInfo, name):
+                self.resource_type_bits[int(getattr(QWebEngineUrlRequestInfo, name))] = ADBLOCK_TYPE_BITS[option]
+                
+    def load_adblock_rules(self):
+        # Load the enabled filter lists; unchanged lists come back already compiled
+        disabled = set(QSettings('NexusBrowser', 'Settings').value('disabled_filter_lists', [], type=list))
+        filter_lists = []
+        try:
+            for path in available_filter_lists():
+                if os.path.basename(path) not in disabled:
+                    filter_lists.append(load_filter_list(path))
+        except OSError:
+            pass
+            
+        return AdblockFilterEngine(filter_lists)
         
-    def add_to_history(self, url, title):
-        cursor = self.conn.cursor()
+    def load_threat_list(self):
+        # Local safe browsing list, one host per line or in hosts file format
+        try:
+            return ThreatDomainList.load(
+                [os.path.join(app_data_dir(), 'safe_browsing_domains.txt')],
+                self.malicious_domains,
+                os.path.join(app_data_dir('adblock_cache'), 'safe_browsing_domains.bin')
+            )
+        except OSError:
+            return ThreatDomainList(self.malicious_domains)
+            
+    def interceptRequest(self, info):
+        self.filter_request(info)
         
-        # Check if URL already exists in history
-        cursor.execute('SELECT id, visit_count FROM history WHERE url = ? ORDER BY visit_time DESC LIMIT 1', (url,))
-        result = cursor.fetchone()
+    def filter_request(self, info, page=None):
+        url = info.requestUrl().toString()
+        domain = info.requestUrl().host()
+        first_party_url = info.firstPartyUrl()
+        source_host = first_party_url.host()
+        type_bit = self.resource_type_bits.get(int(info.resourceType()), ADBLOCK_TYPE_BITS['other'])
+        
+        decision = self.request_filter.check_request(url, domain, source_host, type_bit, first_party_url.toString())
+        if decision is not None:
+            info.block(True)
+            self.block_log.record(source_host, domain, url, decision, page)
+            
+class PageRequestInterceptor(QWebEngineUrlRequestInterceptor):
+    # Runs one page's requests through the shared interceptor, so blocked requests are counted
+    # for the tab that made them rather than for every tab showing the same host
+    def __init__(self, page):
+        super().__init__(page)
+        self.page = page
+        self.shared = install_request_interceptor()
+        
+    def interceptRequest(self, info):
+        self.shared.filter_request(info, self.page)
+        
+class FilterListWatcher(QObject):
+    # Rebuilds the interceptor's filter engine on a worker thread when a list file changes
+    listsReloaded = pyqtSignal(int)
+    
+    def __init__(self, interceptor, parent=None):
+        super().__init__(parent)
+        self.interceptor = interceptor
+        self._lock = threading.Lock()
+        self._building = False
+        self._pending = False
+        
+        self._watcher = QFileSystemWatcher(self)
+        self._watcher.fileChanged.connect(self.schedule_reload)
+        self._watcher.directoryChanged.connect(self.schedule_reload)
+        
+        # Editors and downloads write in bursts, so wait for them to settle
+        self._debounce = QTimer(self)
+        self._debounce.setSingleShot(True)
+        self._debounce.setInterval(500)
+        self._debounce.timeout.connect(self.reload)
+        
+        self.listsReloaded.connect(self.watch_paths)
+        self.watch_paths()
+        
+    def watch_paths(self):
+        # Files replaced on save drop out of the watcher, so add them back after every reload
+        paths = [app_data_dir(), app_data_dir('filter_lists'),
+                 os.path.join(app_data_dir(), 'safe_browsing_domains.txt')] + available_filter_lists()
+        watched = set(self._watcher.files()) | set(self._watcher.directories())
+        missing = [path for path in paths if path not in watched and os.path.exists(path)]
+        if missing:
+            self._watcher.addPaths(missing)
+            
+    def schedule_reload(self, path=''):
+        self._debounce.start()
+        
+    def reload(self):
+        with self._lock:
+            if self._building:
+                self._pending = True
+                return
+            self._building = True
+            
+        threading.Thread(target=self._rebuild, name='filter-list-reload', daemon=True).start()
+        
+    def _rebuild(self):
+        filter_count = 0
+        while True:
+            try:
+                engine = self.interceptor.load_adblock_rules()
+                threat_list = self.interceptor.load_threat_list()
+                
+                # Requests in flight keep the engine they already read; new ones see the new engine
+                self.interceptor.request_filter.set_adblock_engine(engine)
+                self.interceptor.request_filter.set_threat_list(threat_list)
+                filter_count = len(engine)
+            except Exception as e:
+                print(f"Failed to reload filter lists: {str(e)}")
+                
+            with self._lock:
+                if not self._pending:
+                    self._building = False
+                    break
+                self._pending = False
+                
+        self.listsReloaded.emit(filter_count)
+
+# One interceptor serves every window, since they all share the default profile. Where Qt can
+# intercept per page, each BrowserPage installs a PageRequestInterceptor delegating to it instead
+_request_interceptor = None
+
+def install_request_interceptor(profile=None):
+    global _request_interceptor
+    
+    if _request_interceptor is None:
+        settings = QSettings('NexusBrowser', 'Settings')
+        _request_interceptor = EnhancedURLInterceptor(
+            settings.value('ad_block', True, type=bool),
+            settings.value('safe_browsing', True, type=bool)
+        )
+        
+        if profile is None:
+            profile = QWebEngineProfile.defaultProfile()
+        if not hasattr(QWebEnginePage, 'setUrlRequestInterceptor'):
+            profile.setRequestInterceptor(_request_interceptor)
+            
+        _request_interceptor.list_watcher = FilterListWatcher(_request_interceptor, parent=_request_interceptor)
+            
+    return _request_interceptor
+
+class DatabaseWriter(threading.Thread):
+    # Runs queued writes on its own connection, committing them in batched transactions
+    FLUSH = object()
+    STOP = object()
+    EXCLUSIVE = object()
+    CONTROL = (FLUSH, STOP, EXCLUSIVE)
+    
+    def __init__(self, db_path, batch_interval=0.25, max_batch=500, on_connect=None):
+        super().__init__(name='DatabaseWriter', daemon=True)
+        self.db_path = db_path
+        self.on_connect = on_connect
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.commit_times = deque(maxlen=100)
+        self.batches = 0
+        self.writes = 0
+        self.errors = 0
+        self.start()
+        
+    def submit(self, operation, *args):
+        # operation is called as operation(cursor, *args) on the writer thread
+        self.queue.put((operation, args))
+        
+    def submit_exclusive(self, operation, *args):
+        # operation is called as operation(connection, *args) outside any transaction, for
+        # statements such as VACUUM that cannot run inside one
+        self.queue.put((self.EXCLUSIVE, (operation, args)))
+        
+    def flush(self, timeout=None):
+        # Commit everything queued so far and wait for it
+        done = threading.Event()
+        self.queue.put((self.FLUSH, done))
+        return done.wait(timeout)
+        
+    def stop(self, timeout=None):
+        if self.is_alive():
+            self.queue.put((self.STOP, None))
+            self.join(timeout)
+            
+    def queue_depth(self):
+        return self.queue.qsize()
+        
+    def stats(self):
+        commit_times = list(self.commit_times)
+        return {
+            'queue_depth': self.queue_depth(),
+            'batches': self.batches,
+            'writes': self.writes,
+            'errors': self.errors,
+            'last_commit_ms': commit_times[-1] * 1000 if commit_times else 0.0,
+            'avg_commit_ms': sum(commit_times) / len(commit_times) * 1000 if commit_times else 0.0,
+            'max_commit_ms': max(commit_times) * 1000 if commit_times else 0.0,
+        }
+        
+    def run(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        if self.on_connect:
+            self.on_connect(conn)
+            
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            
+            # Coalesce whatever arrives within the batch window into one transaction
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.max_batch and batch[-1][0] not in self.CONTROL:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                    
+            operations = [item for item in batch if item[0] not in self.CONTROL]
+            if operations:
+                self.commit_batch(conn, operations)
+                
+            for operation, args in batch:
+                if operation is self.FLUSH:
+                    args.set()
+                elif operation is self.STOP:
+                    stopping = True
+                elif operation is self.EXCLUSIVE:
+                    self.run_exclusive(conn, *args)
+                    
+        # Drain anything queued behind the stop request
+        leftover = []
+        while True:
+            try:
+                leftover.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        operations = [item for item in leftover if item[0] not in self.CONTROL]
+        if operations:
+            self.commit_batch(conn, operations)
+        for operation, args in leftover:
+            if operation is self.FLUSH:
+                args.set()
+        conn.close()
+        
+    def run_exclusive(self, conn, operation, args):
+        try:
+            operation(conn, *args)
+        except Exception as e:
+            self.errors += 1
+            print(f"Error writing to {self.db_path}: {str(e)}")
+            
+    def commit_batch(self, conn, operations):
+        start = time.perf_counter()
+        cursor = conn.cursor()
+        written = 0
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for operation, args in operations:
+                # Each operation gets its own savepoint, so one that fails loses only its own
+                # writes rather than the rest of the batch
+                cursor.execute('SAVEPOINT operation')
+                try:
+                    operation(cursor, *args)
+                    written += 1
+                except Exception as e:
+                    self.errors += 1
+                    cursor.execute('ROLLBACK TO operation')
+                    print(f"Error writing to {self.db_path}: {str(e)}")
+                cursor.execute('RELEASE operation')
+            cursor.execute('COMMIT')
+            self.writes += written
+            self.batches += 1
+        except Exception as e:
+            self.errors += 1
+            if conn.in_transaction:
+                conn.rollback()
+            print(f"Error writing to {self.db_path}: {str(e)}")
+        self.commit_times.append(time.perf_counter() - start)
+
+class ReadConnectionPool:
+    # A few read-only connections shared by every window and background reader. In WAL mode
+    # they read committed data while the writer thread keeps writing
+    def __init__(self, db_path, size=4, on_connect=None):
+        self.db_path = db_path
+        self.size = size
+        self.on_connect = on_connect
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        
+    def open_connection(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA query_only = ON')
+        conn.execute('PRAGMA busy_timeout=5000')
+        if self.on_connect:
+            self.on_connect(conn)
+        return conn
+        
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+            
+        # Open connections lazily up to the pool size, then wait for one to come back
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if not can_open:
+            return self.idle.get()
+        try:
+            return self.open_connection()
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+            
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+        
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+            
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self.lock:
+            self.opened = 0
+
+class FrecencySum:
+    # SQL aggregate folding visit scores together with frecency_add
+    def __init__(self):
+        self.score = None
+        
+    def step(self, score):
+        self.score = EnhancedHistoryManager.frecency_add(self.score, score)
+        
+    def finalize(self):
+        return self.score
+
+class EnhancedHistoryManager:
+    SCHEMA_VERSION = 3
+    
+    # Retention deletes this many rows per transaction and frees this many pages per vacuum step
+    MAINTENANCE_CHUNK = 500
+    VACUUM_PAGES = 256
+    
+    # Clearing history deletes this many visits per transaction
+    CLEAR_CHUNK = 2000
+    
+    # Frecency is the sum over visits of weight * 2 ** ((visit_time - epoch) / half_life), kept as
+    # its logarithm. Every score decays by the same factor as time passes, so scores never need
+    # recomputing and the stored order is always the current order
+    FRECENCY_EPOCH = 1577836800
+    FRECENCY_HALF_LIFE = 30 * 86400
+    VISIT_WEIGHTS = {
+        'typed': 2.0,
+        'link': 1.0,
+        'form': 0.8,
+        'back_forward': 0.6,
+        'other': 0.6,
+        'redirect': 0.25,
+        'reload': 0.2
+    }
+    
+    def __init__(self, db_path='browser_history.db', read_connections=4):
+        self.db_path = db_path
+        conn = sqlite3.connect(db_path)
+        try:
+            # Only takes effect on a new database; existing ones are converted by compact_database
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.prepare_connection(conn)
+            self.create_tables(conn)
+        finally:
+            conn.close()
+            
+        # Page loads only queue their visit; the writer thread commits them in batches.
+        # Reads borrow a pooled connection, so no query waits on a write
+        self.writer = DatabaseWriter(db_path, on_connect=self.prepare_connection)
+        self.readers = ReadConnectionPool(db_path, read_connections, on_connect=self.prepare_connection)
+        self.maintenance_stats = {'expired_urls': 0, 'expired_visits': 0, 'vacuumed_pages': 0}
+        
+        # Set by the FaviconStore sharing this database, which sweeps out unused icons before vacuums
+        self.favicons = None
+        
+    @classmethod
+    def prepare_connection(cls, conn):
+        conn.create_function('frecency_add', 2, cls.frecency_add, deterministic=True)
+        conn.create_aggregate('frecency_sum', 1, FrecencySum)
+        
+    @classmethod
+    def visit_score(cls, timestamp, visit_type='link', count=1):
+        weight = cls.VISIT_WEIGHTS.get(visit_type, cls.VISIT_WEIGHTS['other']) * count
+        return math.log(weight) + (timestamp - cls.FRECENCY_EPOCH) * math.log(2) / cls.FRECENCY_HALF_LIFE
+        
+    @staticmethod
+    def frecency_add(score, visit_score):
+        # log(exp(score) + exp(visit_score)) without overflowing
+        if score is None:
+            return visit_score
+        if visit_score is None:
+            return score
+        high, low = max(score, visit_score), min(score, visit_score)
+        return high + math.log1p(math.exp(low - high))
+        
+    def create_tables(self, conn):
+        cursor = conn.cursor()
+        
+        # Schema changes after the visit_count migration are numbered through PRAGMA user_version
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        
+        # Check if the old table exists and migrate it
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='history'")
+        old_table_exists = cursor.fetchone()
+        
+        if old_table_exists:
+            # Check if the old table has the old schema
+            cursor.execute("PRAGMA table_info(history)")
+            columns = [column[1] for column in cursor.fetchall()]
+            
+            if 'visit_count' not in columns:
+                # This is the old schema, we need to migrate
+                print("Migrating history database to new schema...")
+                
+                # Create a temporary table with the new schema
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS history_new (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        url TEXT NOT NULL,
+                        title TEXT NOT NULL,
+                        visit_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        visit_count INTEGER DEFAULT 1
+                    )
+                ''')
+                
+                # Copy data from old table to new table
+                cursor.execute('''
+                    INSERT INTO history_new (url, title, visit_time, visit_count)
+                    SELECT url, title, visit_time, 1 FROM history
+                ''')
+                
+                # Drop the old table
+                cursor.execute('DROP TABLE history')
+                
+                # Rename the new table
+                cursor.execute('ALTER TABLE history_new RENAME TO history')
+                
+                # Create frequent_sites table
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS frequent_sites (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        url TEXT NOT NULL UNIQUE,
+                        title TEXT NOT NULL,
+                        visit_count INTEGER DEFAULT 1,
+                        last_visit TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                
+                # Populate frequent_sites from history
+                cursor.execute('''
+                    INSERT INTO frequent_sites (url, title, visit_count, last_visit)
+                    SELECT url, title, COUNT(*) as visit_count, MAX(visit_time) as last_visit
+                    FROM history
+                    GROUP BY url, title
+                ''')
+                
+                conn.commit()
+                print("Database migration completed successfully.")
+                
+            # Split history into unique urls and their individual visits
+            if version < 2:
+                self.migrate_to_urls(cursor)
+                
+        if version == 2:
+            self.add_frecency_columns(cursor)
+            
+        # Create tables if they don't exist (for new installations)
+        self.create_url_tables(cursor)
+        
+        if version < 3:
+            self.backfill_frecency(cursor)
+        cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        
+        # The search index is not part of the numbered schema, since SQLite may be built without
+        # FTS5. It is created on the first open where it can be
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='urls_fts'")
+        self.fts_enabled = cursor.fetchone() is not None or self.create_search_index(cursor)
+        
+        conn.commit()
+        
+    def create_url_tables(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS urls (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                title TEXT NOT NULL DEFAULT '',
+                visit_count INTEGER NOT NULL DEFAULT 0,
+                last_visit TIMESTAMP,
+                frecency REAL
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS visits (
+                id INTEGER PRIMARY KEY,
+                url_id INTEGER NOT NULL REFERENCES urls(id) ON DELETE CASCADE,
+                visit_time TIMESTAMP NOT NULL,
+                visit_type TEXT NOT NULL DEFAULT 'link'
+            )
+        ''')
+        
+        # Recent and frequent lists walk these indexes instead of sorting the table
+        cursor.execute('CREATE INDEX IF NOT EXISTS urls_last_visit ON urls(last_visit)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS urls_frecency ON urls(frecency)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS visits_visit_time ON visits(visit_time)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS visits_url_id ON visits(url_id, visit_time)')
+        
+    def add_frecency_columns(self, cursor):
+        cursor.execute("PRAGMA table_info(urls)")
+        if 'frecency' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE urls ADD COLUMN frecency REAL')
+            cursor.execute("ALTER TABLE visits ADD COLUMN visit_type TEXT NOT NULL DEFAULT 'link'")
+        cursor.execute('DROP INDEX IF EXISTS urls_visit_count')
+        
+    def backfill_frecency(self, cursor):
+        # Earlier schemas kept no per-visit history, so score visit_count link visits at last_visit
+        cursor.execute(
+            "SELECT id, visit_count, CAST(strftime('%s', last_visit) AS INTEGER) FROM urls WHERE frecency IS NULL"
+        )
+        scores = [
+            (self.visit_score(timestamp, 'link', max(visit_count, 1)), url_id)
+            for url_id, visit_count, timestamp in cursor.fetchall() if timestamp is not None
+        ]
+        cursor.executemany('UPDATE urls SET frecency = ? WHERE id = ?', scores)
+        
+    def migrate_to_urls(self, cursor):
+        print("Migrating history database to urls and visits...")
+        cursor.execute('DROP TABLE IF EXISTS history_fts')
+        self.create_url_tables(cursor)
+        
+        # With MAX() the bare title column comes from the most recent row of each url
+        cursor.execute('''
+            INSERT INTO urls (url, title, last_visit, visit_count)
+            SELECT url, title, MAX(visit_time), SUM(visit_count) FROM history GROUP BY url
+        ''')
+        
+        # The old schema only kept the latest time of each row, so that is the visit we can keep
+        cursor.execute('''
+            INSERT INTO visits (url_id, visit_time)
+            SELECT urls.id, history.visit_time FROM history JOIN urls ON urls.url = history.url
+            ORDER BY history.visit_time
+        ''')
+        
+        cursor.execute('DROP TABLE history')
+        cursor.execute('DROP TABLE IF EXISTS frequent_sites')
+        
+    def create_search_index(self, cursor):
+        # Full text index over url titles and addresses, kept in sync by triggers
+        try:
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS urls_fts USING fts5(
+                    title, url,
+                    content='urls', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"Full text history search unavailable: {str(e)}")
+            return False
+            
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS urls_fts_insert AFTER INSERT ON urls BEGIN
+                INSERT INTO urls_fts(rowid, title, url) VALUES (new.id, new.title, new.url);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS urls_fts_delete AFTER DELETE ON urls BEGIN
+                INSERT INTO urls_fts(urls_fts, rowid, title, url) VALUES ('delete', old.id, old.title, old.url);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS urls_fts_update AFTER UPDATE OF title, url ON urls
+            WHEN old.title IS NOT new.title OR old.url IS NOT new.url BEGIN
+                INSERT INTO urls_fts(urls_fts, rowid, title, url) VALUES ('delete', old.id, old.title, old.url);
+                INSERT INTO urls_fts(rowid, title, url) VALUES (new.id, new.title, new.url);
+            END
+        ''')
+        
+        # Index the rows that existed before the table was created
+        print("Building history search index...")
+        cursor.execute("INSERT INTO urls_fts(urls_fts) VALUES ('rebuild')")
+        return True
+        
+    @staticmethod
+    def search_expression(query):
+        # Every word of the query must prefix-match a token of the title or url
+        terms = re.findall(r'\w+', query.lower())
+        return ' '.join(f'"{term}"*' for term in terms)
+        
+    def add_to_history(self, url, title, visit_type='link'):
+        timestamp = int(time.time())
+        visit_time = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+        score = self.visit_score(timestamp, visit_type)
+        self.writer.submit(self.record_visit, url, title, visit_time, visit_type, score)
+        
+    @staticmethod
+    def record_visit(cursor, url, title, visit_time, visit_type='link', score=None):
+        # One upsert on the unique url index, then an append to visits
+        cursor.execute('''
+            INSERT INTO urls (url, title, visit_count, last_visit, frecency) VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET
+                visit_count = visit_count + 1,
+                last_visit = excluded.last_visit,
+                frecency = frecency_add(frecency, excluded.frecency),
+                title = CASE WHEN excluded.title != '' THEN excluded.title ELSE title END
+        ''', (url, title, visit_time, score))
+        cursor.execute(
+            'INSERT INTO visits (url_id, visit_time, visit_type) SELECT id, ?, ? FROM urls WHERE url = ?',
+            (visit_time, visit_type, url)
+        )
+        
+    def writer_stats(self):
+        return self.writer.stats()
+        
+    def flush(self, timeout=None):
+        return self.writer.flush(timeout)
+        
+    def close(self):
+        # Commit pending visits before the process exits
+        self.writer.stop()
+        self.readers.close()
+        
+    def run_maintenance(self, max_age_days=0, max_entries=0):
+        # Expire history in small transactions on the writer thread, then return the freed pages
+        # to the file system. Visits recorded meanwhile are committed between the chunks
+        self.maintenance_stats = {'expired_urls': 0, 'expired_visits': 0, 'vacuumed_pages': 0}
+        self.writer.submit(self.expire_chunk, max_age_days, max_entries)
+        
+    @staticmethod
+    def compact_database(db_path):
+        # Rewrites the whole file, so it runs on its own connection, from browser.py --compact-history
+        # or on a legacy import before the writer opens it. Databases created before auto_vacuum was
+        # set also switch to incremental mode here, after which vacuum_chunk can shrink them
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA busy_timeout=5000')
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            size = os.path.getsize(db_path)
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return size - os.path.getsize(db_path)
+        finally:
+            conn.close()
+            
+    def expire_chunk(self, cursor, max_age_days, max_entries):
+        url_ids = []
+        if max_age_days:
+            cursor.execute("SELECT datetime('now', ?)", (f'-{int(max_age_days)} days',))
+            cutoff = cursor.fetchone()[0]
+            
+            # Urls last visited before the cutoff have no visits left to keep
+            cursor.execute(
+                'SELECT id FROM urls WHERE last_visit < ? ORDER BY last_visit LIMIT ?',
+                (cutoff, self.MAINTENANCE_CHUNK)
+            )
+            url_ids = [row[0] for row in cursor.fetchall()]
+            
+        if not url_ids and max_entries:
+            cursor.execute('SELECT COUNT(*) FROM urls')
+            excess = cursor.fetchone()[0] - max_entries
+            if excess > 0:
+                cursor.execute(
+                    'SELECT id FROM urls ORDER BY last_visit LIMIT ?',
+                    (min(excess, self.MAINTENANCE_CHUNK),)
+                )
+                url_ids = [row[0] for row in cursor.fetchall()]
+                
+        expired_visits = []
+        if not url_ids and max_age_days:
+            # Old visits of urls that are still in use
+            cursor.execute(
+                'SELECT id, url_id FROM visits WHERE visit_time < ? ORDER BY visit_time LIMIT ?',
+                (cutoff, self.MAINTENANCE_CHUNK)
+            )
+            expired_visits = cursor.fetchall()
+            
+        if url_ids:
+            cursor.executemany('DELETE FROM visits WHERE url_id = ?', [(url_id,) for url_id in url_ids])
+            cursor.executemany('DELETE FROM urls WHERE id = ?', [(url_id,) for url_id in url_ids])
+            self.maintenance_stats['expired_urls'] += len(url_ids)
+        elif expired_visits:
+            # Visit counts, last visits and frecency are recomputed from the visits left
+            self.delete_visit_rows(cursor, expired_visits)
+            self.maintenance_stats['expired_visits'] += len(expired_visits)
+            
+        # Queue the next chunk behind whatever else is waiting, or move on to vacuuming
+        if url_ids or expired_visits:
+            self.writer.submit(self.expire_chunk, max_age_days, max_entries)
+        else:
+            self.start_vacuum()
+            
+    def start_vacuum(self, url=None):
+        # Icons of sites no url is on any more go first, so their pages are freed as well. After
+        # one url is deleted only its site's icon is checked
+        if self.favicons is None:
+            self.writer.submit_exclusive(self.vacuum_chunk)
+        elif url is None:
+            self.writer.submit(self.favicons.sweep_chunk)
+        else:
+            self.writer.submit(self.favicons.sweep_chunk, '', FaviconStore.key(url))
+            
+    def vacuum_chunk(self, conn):
+        # incremental_vacuum does nothing unless auto_vacuum is INCREMENTAL (2); databases still in
+        # another mode are converted by compact_database
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if free_pages:
+            # incremental_vacuum frees one page per step, and executescript steps it to completion
+            conn.executescript(f'PRAGMA incremental_vacuum({self.VACUUM_PAGES});')
+            freed = free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+            self.maintenance_stats['vacuumed_pages'] += max(freed, 0)
+            if freed > 0 and free_pages - freed > 0:
+                self.writer.submit_exclusive(self.vacuum_chunk)
+                
+    def get_history(self, limit=100):
+        with self.readers.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT url, title, last_visit, visit_count FROM urls ORDER BY last_visit DESC LIMIT ?', (limit,))
+            return cursor.fetchall()
+            
+    def get_frequent_sites(self, limit=10):
+        with self.readers.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT url, title, visit_count FROM urls ORDER BY frecency DESC LIMIT ?', (limit,))
+            return cursor.fetchall()
+            
+    def search_history(self, query, limit=20):
+        with self.readers.connection() as conn:
+            return self.query_history(conn.cursor(), query, limit)
+            
+    def query_history(self, cursor, query, limit):
+        expression = self.search_expression(query)
+        if self.fts_enabled and expression:
+            # Best matches first, weighting title hits over url hits. Every match is ranked inside
+            # the full text index and only the best ones are joined to their urls
+            cursor.execute('''
+                SELECT urls.url, urls.title, urls.last_visit
+                FROM (
+                    SELECT rowid, bm25(urls_fts, 5.0, 1.0) AS score FROM urls_fts
+                    WHERE urls_fts MATCH ? ORDER BY score LIMIT ?
+                ) AS matches JOIN urls ON urls.id = matches.rowid
+                ORDER BY matches.score
+            ''', (expression, limit))
+            return cursor.fetchall()
+            
+        cursor.execute(
+            'SELECT url, title, last_visit FROM urls WHERE url LIKE ? OR title LIKE ? ORDER BY last_visit DESC LIMIT ?',
+            (f'%{query}%', f'%{query}%', limit)
+        )
+        return cursor.fetchall()
+        
+    def get_history_page(self, after=None, limit=200, query=''):
+        # Keyset pagination: rows older than after, a (last_visit, id) pair, newest first
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append('(urls.last_visit, urls.id) < (?, ?)')
+            params.extend(after)
+            
+        expression = self.search_expression(query)
+        if expression and self.fts_enabled:
+            conditions.append('urls.id IN (SELECT rowid FROM urls_fts WHERE urls_fts MATCH ?)')
+            params.append(expression)
+        elif query.strip():
+            conditions.append('(urls.url LIKE ? OR urls.title LIKE ?)')
+            params.extend([f'%{query}%', f'%{query}%'])
+            
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self.readers.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT urls.id, urls.url, urls.title, urls.last_visit, urls.visit_count FROM urls
+                {where}
+                ORDER BY urls.last_visit DESC, urls.id DESC
+                LIMIT ?
+            ''', params + [limit])
+            return cursor.fetchall()
+        
+    def iter_visits(self, since=None, until=None):
+        # Every visit oldest first, streamed off a pooled cursor so exports of any size use
+        # constant memory. since and until are UTC times in the visit_time format
+        conditions = []
+        params = []
+        if since:
+            conditions.append('visits.visit_time >= ?')
+            params.append(since)
+        if until:
+            conditions.append('visits.visit_time < ?')
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        
+        with self.readers.connection() as conn:
+            yield from conn.execute(f'''
+                SELECT urls.url, urls.title, visits.visit_time, visits.visit_type
+                FROM visits JOIN urls ON urls.id = visits.url_id
+                {where}
+                ORDER BY visits.visit_time
+            ''', params)
+            
+    def clear_history(self, timeframe=None, on_done=None):
+        # Deletes go through the writer in small transactions, after any visits still queued and
+        # interleaved with the ones recorded meanwhile. on_done is called on the writer thread
+        # once everything is committed
+        if timeframe and timeframe not in self.CLEAR_TIMEFRAMES:
+            return
+        self.writer.submit(self.start_clear, timeframe, on_done)
+        
+    CLEAR_TIMEFRAMES = {
+        'last_hour': '-1 hour',
+        'last_day': '-1 day',
+        'last_week': '-7 days',
+        'last_month': '-30 days'
+    }
+    
+    def start_clear(self, cursor, timeframe, on_done):
+        cutoff = None
+        if timeframe:
+            cursor.execute("SELECT datetime('now', ?)", (self.CLEAR_TIMEFRAMES[timeframe],))
+            cutoff = cursor.fetchone()[0]
+            
+        # Visits recorded after the request are kept, however long clearing takes
+        last_visit_id = cursor.execute('SELECT MAX(id) FROM visits').fetchone()[0] or 0
+        last_url_id = cursor.execute('SELECT MAX(id) FROM urls').fetchone()[0] or 0
+        self.clear_chunk(cursor, cutoff, last_visit_id, last_url_id, on_done)
+        
+    def clear_chunk(self, cursor, cutoff, last_visit_id, last_url_id, on_done):
+        if cutoff:
+            # Only visits since the cutoff are touched, found through the visit_time index
+            cursor.execute(
+                'SELECT id, url_id FROM visits WHERE visit_time > ? AND id <= ? LIMIT ?',
+                (cutoff, last_visit_id, self.CLEAR_CHUNK)
+            )
+        else:
+            cursor.execute('SELECT id, url_id FROM visits WHERE id <= ? LIMIT ?', (last_visit_id, self.CLEAR_CHUNK))
+        visits = cursor.fetchall()
+        
+        url_ids = []
+        if not visits and cutoff is None:
+            # Urls that never had a visit row, such as ones migrated from the oldest schema
+            cursor.execute(
+                'SELECT id FROM urls WHERE id <= ? AND NOT EXISTS (SELECT 1 FROM visits WHERE url_id = urls.id) LIMIT ?',
+                (last_url_id, self.CLEAR_CHUNK)
+            )
+            url_ids = [row[0] for row in cursor.fetchall()]
+            
+        if visits:
+            self.delete_visit_rows(cursor, visits)
+        elif url_ids:
+            cursor.executemany('DELETE FROM urls WHERE id = ?', [(url_id,) for url_id in url_ids])
+            
+        # Queue the next chunk behind whatever else is waiting, then report and vacuum
+        if visits or url_ids:
+            self.writer.submit(self.clear_chunk, cutoff, last_visit_id, last_url_id, on_done)
+        else:
+            if on_done:
+                self.writer.submit_exclusive(self.run_callback, on_done)
+            self.start_vacuum()
+            
+    @classmethod
+    def delete_visit_rows(cls, cursor, visits):
+        # visits are (id, url_id) pairs; urls left without visits go with them
+        cursor.executemany('DELETE FROM visits WHERE id = ?', [(visit_id,) for visit_id, _ in visits])
+        visit_counts = Counter(url_id for _, url_id in visits)
+        cursor.executemany('''
+            UPDATE urls SET
+                visit_count = MAX(visit_count - ?, 1),
+                last_visit = (SELECT MAX(visit_time) FROM visits WHERE url_id = urls.id)
+            WHERE id = ?
+        ''', [(count, url_id) for url_id, count in visit_counts.items()])
+        cursor.executemany('DELETE FROM urls WHERE id = ? AND last_visit IS NULL', [(url_id,) for url_id in visit_counts])
+        cls.recompute_frecency(cursor, list(visit_counts))
+        
+    @staticmethod
+    def run_callback(conn, callback):
+        # Exclusive operations run after the batch before them has committed
+        callback()
+        
+    def when_written(self, callback):
+        # Calls callback on the writer thread once everything queued so far has committed, where
+        # flush would wait for that
+        self.writer.submit_exclusive(self.run_callback, callback)
+        
+    @classmethod
+    def recompute_frecency(cls, cursor, url_ids):
+        # Rebuild scores from the visits that remain
+        for url_id in url_ids:
+            cursor.execute(
+                "SELECT CAST(strftime('%s', visit_time) AS INTEGER), visit_type FROM visits WHERE url_id = ?",
+                (url_id,)
+            )
+            score = None
+            for timestamp, visit_type in cursor.fetchall():
+                score = cls.frecency_add(score, cls.visit_score(timestamp, visit_type))
+            if score is not None:
+                cursor.execute('UPDATE urls SET frecency = ? WHERE id = ?', (score, url_id))
+                
+    @staticmethod
+    def delete_url(cursor, url):
+        cursor.execute('DELETE FROM visits WHERE url_id IN (SELECT id FROM urls WHERE url = ?)', (url,))
+        cursor.execute('DELETE FROM urls WHERE url = ?', (url,))
+        
+    def delete_history_item(self, url, on_done=None):
+        self.writer.submit(self.delete_url, url)
+        if on_done:
+            self.writer.submit_exclusive(self.run_callback, on_done)
+        self.start_vacuum(url)
+
+class BackgroundImporter:
+    # An import run on its own thread and polled from the window: total and read give progress,
+    # done is set once it ends and error holds why it failed. cancel stops it after the batch in
+    # progress
+    THREAD_NAME = 'Import'
+    DESCRIPTION = 'data'
+    
+    def __init__(self, path):
+        self.path = path
+        self.source = None
+        self.total = 0
+        self.read = 0
+        self.imported = 0
+        self.cancelled = False
+        self.done = False
+        self.error = None
+        
+    def cancel(self):
+        self.cancelled = True
+        
+    def start(self):
+        threading.Thread(target=self.run_safely, name=self.THREAD_NAME, daemon=True).start()
+        
+    def run_safely(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.error = str(e)
+            print(f"Error importing {self.DESCRIPTION}: {self.error}")
+        finally:
+            self.done = True
+            
+    def run(self):
+        raise NotImplementedError
+
+class HistoryImporter(BackgroundImporter):
+    # Imports Chrome or Firefox history. The source database is copied first, since the other
+    # browser keeps it locked, and the copy is attached to the history writer's connection.
+    # Each batch is a range of source url ids merged with a few set-based statements, so rows
+    # never pass through Python and memory stays flat however large the source is
+    BATCH_SIZE = 10000
+    
+    # Page cache for both databases while importing, in KiB; with the default 2 MB most index updates miss
+    IMPORT_CACHE_KIB = 65536
+    
+    # Write-ahead log pages between checkpoints while importing. Every range commits on its own,
+    # and with the default 1000 most index pages would be copied back at nearly every commit
+    IMPORT_CHECKPOINT_PAGES = 10000
+    
+    # Visit times are microseconds since 1601 in Chrome and since 1970 in Firefox
+    SOURCES = {
+        'chrome': {
+            'database': 'History',
+            'visits': 'visits',
+            'url_id': 'url',
+            'rows': '''
+                SELECT urls.url AS url, COALESCE(urls.title, '') AS title,
+                       visits.visit_time / 1000000 - 11644473600 AS timestamp, {visit_type} AS visit_type
+                FROM source.visits JOIN source.urls ON urls.id = visits.url
+                WHERE visits.url BETWEEN ? AND ?
+            '''
+        },
+        'firefox': {
+            'database': 'places.sqlite',
+            'visits': 'moz_historyvisits',
+            'url_id': 'place_id',
+            'rows': '''
+                SELECT moz_places.url AS url, COALESCE(moz_places.title, '') AS title,
+                       moz_historyvisits.visit_date / 1000000 AS timestamp, {visit_type} AS visit_type
+                FROM source.moz_historyvisits JOIN source.moz_places ON moz_places.id = moz_historyvisits.place_id
+                WHERE moz_historyvisits.place_id BETWEEN ? AND ?
+            '''
+        }
+    }
+    
+    # Chrome keeps the core transition in the low byte; automatic subframe loads are not visits
+    CHROME_TRANSITIONS = {0: 'link', 1: 'typed', 2: 'typed', 4: 'link', 5: 'typed', 6: 'other', 7: 'form',
+                          8: 'reload', 9: 'typed', 10: 'other'}
+    CHROME_FORWARD_BACK = 0x01000000
+    FIREFOX_VISIT_TYPES = {1: 'link', 2: 'typed', 3: 'typed', 5: 'redirect', 6: 'redirect', 7: 'other',
+                           8: 'link', 9: 'reload'}
+                           
+    THREAD_NAME = 'HistoryImport'
+    DESCRIPTION = 'history'
+    
+    def __init__(self, history_manager, path):
+        super().__init__(self.find_database(path))
+        self.history_manager = history_manager
+        self.attached = False
+        self.cache_size = 0
+        self.checkpoint_pages = 0
+        
+    @classmethod
+    def find_database(cls, path):
+        # A profile folder can be given instead of the database inside it
+        if os.path.isdir(path):
+            for source in cls.SOURCES.values():
+                candidate = os.path.join(path, source['database'])
+                if os.path.isfile(candidate):
+                    return candidate
+        return path
+        
+    def detect_source(self, conn):
+        tables = {row[0] for row in conn.execute("SELECT name FROM source.sqlite_master WHERE type='table'")}
+        if {'moz_places', 'moz_historyvisits'} <= tables:
+            return 'firefox'
+        if {'urls', 'visits'} <= tables:
+            columns = {row[1] for row in conn.execute('PRAGMA source.table_info(visits)')}
+            if 'transition' in columns:
+                return 'chrome'
+        raise ValueError(f"{os.path.basename(self.path)} is not a Chrome or Firefox history database")
+        
+    def rows_query(self):
+        source = self.SOURCES[self.source]
+        if self.source == 'chrome':
+            cases = ' '.join(f"WHEN {core} THEN '{kind}'" for core, kind in self.CHROME_TRANSITIONS.items())
+            visit_type = (f"CASE WHEN visits.transition & {self.CHROME_FORWARD_BACK} THEN 'back_forward' "
+                          f"ELSE CASE visits.transition & 255 {cases} END END")
+        else:
+            cases = ' '.join(f"WHEN {code} THEN '{kind}'" for code, kind in self.FIREFOX_VISIT_TYPES.items())
+            visit_type = f"CASE moz_historyvisits.visit_type {cases} END"
+        return source['rows'].format(visit_type=visit_type)
+        
+    @staticmethod
+    def score_sql():
+        # EnhancedHistoryManager.visit_score as an SQL expression, so scoring needs no Python call per visit
+        weights = ' '.join(
+            f"WHEN '{kind}' THEN {math.log(weight)!r}" for kind, weight in EnhancedHistoryManager.VISIT_WEIGHTS.items()
+        )
+        rate = math.log(2) / EnhancedHistoryManager.FRECENCY_HALF_LIFE
+        return f"(CASE visit_type {weights} END + (timestamp - {EnhancedHistoryManager.FRECENCY_EPOCH}) * {rate!r})"
+        
+    def copy_database(self, directory):
+        if not os.path.isfile(self.path):
+            raise ValueError(f"{self.path} does not exist")
+            
+        # The write-ahead log holds the most recent visits, so it is copied along with the database
+        copy = os.path.join(directory, 'history.db')
+        for suffix in ('', '-wal', '-journal'):
+            if os.path.isfile(self.path + suffix):
+                shutil.copyfile(self.path + suffix, copy + suffix)
+        return copy
+        
+    def url_id_ranges(self, conn):
+        # Split the visits into ranges of whole urls holding about BATCH_SIZE visits each
+        source = self.SOURCES[self.source]
+        visits, url_id = source['visits'], source['url_id']
+        indexed = any(
+            conn.execute(f'PRAGMA source.index_info("{index[1]}")').fetchone()[2] == url_id
+            for index in conn.execute(f'PRAGMA source.index_list({visits})').fetchall()
+        )
+        if not indexed:
+            conn.execute(f'CREATE INDEX source.import_url_id ON {visits} ({url_id})')
+            
+        first, count = None, 0
+        for current, visit_count in conn.execute(f'SELECT {url_id}, COUNT(*) FROM source.{visits} GROUP BY {url_id}'):
+            if first is None:
+                first = current
+            count += visit_count
+            if count >= self.BATCH_SIZE:
+                yield first, current, count
+                first, count = None, 0
+        if first is not None:
+            yield first, current, count
+            
+    def run(self):
+        writer = self.history_manager.writer
+        with tempfile.TemporaryDirectory() as directory:
+            copy = self.copy_database(directory)
+            conn = sqlite3.connect(':memory:')
+            try:
+                conn.execute('ATTACH DATABASE ? AS source', (copy,))
+                self.source = self.detect_source(conn)
+                ranges = list(self.url_id_ranges(conn))
+            finally:
+                conn.close()
+            self.total = sum(count for first, last, count in ranges)
+            
+            writer.submit_exclusive(self.attach, copy)
+            writer.flush()
+            if not self.attached:
+                raise ValueError(f"Could not open {self.path}")
+            try:
+                query = self.rows_query()
+                for first, last, count in ranges:
+                    if self.cancelled:
+                        break
+                    
+                    # One range per transaction, committed before the next is queued, so writes
+                    # queued meanwhile by page loads and edits wait behind one range at most
+                    writer.submit(self.merge_range, query, first, last, count)
+                    writer.flush()
+            finally:
+                writer.submit_exclusive(self.detach)
+                writer.flush()
+        return self.imported
+        
+    def attach(self, conn, path):
+        conn.execute('ATTACH DATABASE ? AS source', (path,))
+        self.cache_size = conn.execute('PRAGMA main.cache_size').fetchone()[0]
+        conn.execute(f'PRAGMA main.cache_size = -{self.IMPORT_CACHE_KIB}')
+        conn.execute(f'PRAGMA source.cache_size = -{self.IMPORT_CACHE_KIB}')
+        self.checkpoint_pages = conn.execute('PRAGMA wal_autocheckpoint').fetchone()[0]
+        conn.execute(f'PRAGMA wal_autocheckpoint = {self.IMPORT_CHECKPOINT_PAGES}')
+        self.attached = True
+        
+    def detach(self, conn):
+        conn.execute('DROP TABLE IF EXISTS temp.imported_visits')
+        conn.execute('DETACH DATABASE source')
+        conn.execute(f'PRAGMA main.cache_size = {self.cache_size}')
+        conn.execute(f'PRAGMA wal_autocheckpoint = {self.checkpoint_pages}')
+        self.attached = False
+        
+    def merge_range(self, cursor, query, first, last, count):
+        cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS imported_visits (
+                url TEXT NOT NULL,
+                title TEXT NOT NULL,
+                visit_time TIMESTAMP NOT NULL,
+                visit_type TEXT NOT NULL,
+                score REAL
+            )
+        ''')
+        cursor.execute('DELETE FROM temp.imported_visits')
+        
+        # Only web pages are imported, and visits already in history from an earlier import are skipped
+        cursor.execute(f'''
+            INSERT INTO temp.imported_visits (url, title, visit_time, visit_type, score)
+            SELECT url, title, visit_time, visit_type, score FROM (
+                SELECT url, title, datetime(timestamp, 'unixepoch') AS visit_time, visit_type, {self.score_sql()} AS score
+                FROM ({query})
+                WHERE visit_type IS NOT NULL AND timestamp > 0 AND substr(url, 1, 4) = 'http'
+            ) AS source_visits
+            WHERE NOT EXISTS (
+                SELECT 1 FROM main.urls AS known_urls JOIN main.visits AS known_visits ON known_visits.url_id = known_urls.id
+                WHERE known_urls.url = source_visits.url AND known_visits.visit_time = source_visits.visit_time
+            )
+        ''', (first, last))
+        
+        # One upsert per distinct url; the bare title column comes from the row holding MAX(visit_time)
+        cursor.execute('''
+            INSERT INTO main.urls (url, title, visit_count, last_visit, frecency)
+            SELECT url, title, COUNT(*), MAX(visit_time), frecency_sum(score) FROM temp.imported_visits
+            WHERE true GROUP BY url
+            ON CONFLICT(url) DO UPDATE SET
+                visit_count = visit_count + excluded.visit_count,
+                last_visit = MAX(IFNULL(last_visit, excluded.last_visit), excluded.last_visit),
+                frecency = frecency_add(frecency, excluded.frecency),
+                title = CASE WHEN excluded.title != '' AND (title = '' OR excluded.last_visit > last_visit)
+                             THEN excluded.title ELSE title END
+        ''')
+        cursor.execute('''
+            INSERT INTO main.visits (url_id, visit_time, visit_type)
+            SELECT urls.id, imported_visits.visit_time, imported_visits.visit_type
+            FROM temp.imported_visits JOIN main.urls ON urls.url = imported_visits.url
+            ORDER BY imported_visits.visit_time
+        ''')
+        self.imported += cursor.rowcount
+        self.read += count
+
+EXPORT_FORMATS = ('jsonl', 'csv', 'json')
+EXPORT_CHUNK = 1000
+
+def export_format_for(path, default='jsonl'):
+    # Taken from the file name, so history.csv.gz is compressed CSV
+    name = path[:-3] if path.endswith('.gz') else path
+    extension = os.path.splitext(name)[1].lstrip('.').lower()
+    return extension if extension in EXPORT_FORMATS else default
+    
+def write_export(path, fields, rows, export_format=None, compress=None):
+    # Writes rows as they arrive from the iterator, a chunk at a time, so memory use doesn't
+    # grow with the export
+    if export_format is None:
+        export_format = export_format_for(path)
+    if compress is None:
+        compress = path.endswith('.gz')
+        
+    rows = iter(rows)
+    chunks = iter(lambda: list(itertools.islice(rows, EXPORT_CHUNK)), [])
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    count = 0
+    
+    # Level 6 is what the gzip tool uses; 9 is a third slower for under one percent
+    f = gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=6) if compress else \
+        open(path, 'w', encoding='utf-8', newline='')
+    with f:
+        if export_format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for chunk in chunks:
+                writer.writerows(chunk)
+                count += len(chunk)
+        elif export_format == 'jsonl':
+            for chunk in chunks:
+                f.write(''.join([encode(dict(zip(fields, row))) + '\n' for row in chunk]))
+                count += len(chunk)
+        else:
+            # A JSON array, written one chunk of elements at a time
+            f.write('[')
+            for chunk in chunks:
+                f.write(',' if count else '')
+                f.write(','.join(['\n  ' + encode(dict(zip(fields, row))) for row in chunk]))
+                count += len(chunk)
+            f.write('\n]\n' if count else ']\n')
+    return count
+
+class UrlCompletionIndex:
+    # Immutable prefix index over history and bookmark urls and titles. Entries are numbered best
+    # score first, so walking posting lists in id order visits matches in rank order
+    HEAVY_PREFIX_TOKENS = 32
+    TOP_ENTRIES = 64
+    MAX_CHECKED = 20000
+    ID_SET_LIMIT = 20000
+    
+    # Words are split at punctuation, which also lets word prefixes be checked with a substring search
+    WORD_SEPARATORS = str.maketrans({character: ' ' for character in '!"#$%&\'()*+,-./:;<=>?@[\\]^`{|}~'})
+    
+    def __init__(self, rows=()):
+        rows = sorted(rows, key=lambda row: row[2] if row[2] is not None else -math.inf, reverse=True)
+        self.urls = [row[0] for row in rows]
+        self.titles = [row[1] for row in rows]
+        self.scores = array('d', (row[2] if row[2] is not None else -math.inf for row in rows))
+        del rows
+        
+        postings = {}
+        for entry_id, (url, title) in enumerate(zip(self.urls, self.titles)):
+            for token in self.tokens(url, title):
+                ids = postings.get(token)
+                if ids is None:
+                    postings[token] = [entry_id]
+                else:
+                    ids.append(entry_id)
+                    
+        self.vocabulary = sorted(postings)
+        self.postings = [array('I', postings.pop(token)) for token in self.vocabulary]
+        self.id_sets = OrderedDict()
+        
+        # Prefixes shared by many tokens would need a wide merge per keystroke, so their best
+        # entries are merged once here
+        self.top_entries = {}
+        ranges = [(0, len(self.vocabulary), 1)]
+        while ranges:
+            low, high, length = ranges.pop()
+            while low < high:
+                prefix = self.vocabulary[low][:length]
+                if len(prefix) < length:
+                    # A token no longer than the prefixes being grouped
+                    low += 1
+                    continue
+                end = bisect.bisect_left(self.vocabulary, prefix + '\uffff', low, high)
+                if end - low > self.HEAVY_PREFIX_TOKENS:
+                    heads = [ids[:self.TOP_ENTRIES] for ids in self.postings[low:end]]
+                    self.top_entries[prefix] = array(
+                        'I', itertools.islice(self.unique(heapq.merge(*heads)), self.TOP_ENTRIES)
+                    )
+                    ranges.append((low, end, length + 1))
+                low = end
+        
+    def __len__(self):
+        return len(self.urls)
+        
+    @staticmethod
+    def normalize_url(url):
+        url = url.lower()
+        for scheme in ('https://', 'http://'):
+            if url.startswith(scheme):
+                url = url[len(scheme):]
+                break
+        return url[4:] if url.startswith('www.') else url
+        
+    @classmethod
+    def tokens(cls, url, title):
+        # Title words, the host, its labels and the non-numeric words of the path
+        normalized = cls.normalize_url(url)
+        host, _, path = normalized.partition('/')
+        tokens = set(title.lower().translate(cls.WORD_SEPARATORS).split())
+        tokens.add(host)
+        tokens.update(host.split('.'))
+        tokens.update(word for word in path.translate(cls.WORD_SEPARATORS).split() if not word.isdigit())
+        tokens.discard('')
+        return tokens
+        
+    @staticmethod
+    def query_terms(text):
+        # Returns (words, url_prefix); address-like input is matched against the start of the url
+        text = text.strip().lower()
+        if text and ' ' not in text and ('.' in text or '/' in text):
+            normalized = UrlCompletionIndex.normalize_url(text)
+            host = normalized.partition('/')[0]
+            return [host] if host else [], normalized
+        return text.translate(UrlCompletionIndex.WORD_SEPARATORS).split(), None
+        
+    @classmethod
+    def matches(cls, words, url_prefix, url, title):
+        if url_prefix is not None:
+            return cls.normalize_url(url).startswith(url_prefix)
+        # Plain substring search first, as most candidates fail it
+        text = f"{title} {url}".lower()
+        if not all(word in text for word in words):
+            return False
+        text = ' ' + text.translate(cls.WORD_SEPARATORS)
+        return all(' ' + word in text for word in words)
+        
+    @staticmethod
+    def unique(ids):
+        previous = None
+        for entry_id in ids:
+            if entry_id != previous:
+                yield entry_id
+                previous = entry_id
+                
+    def prefix_range(self, prefix):
+        low = bisect.bisect_left(self.vocabulary, prefix)
+        return low, bisect.bisect_left(self.vocabulary, prefix + '\uffff', low)
+        
+    def prefix_ids(self, prefix):
+        # Entries with a token starting with prefix, best first
+        top = self.top_entries.get(prefix)
+        if top is not None:
+            yield from top
+            if len(top) < self.TOP_ENTRIES:
+                return
+            last = top[-1]
+        else:
+            last = -1
+        low, high = self.prefix_range(prefix)
+        if high - low == 1:
+            ids = self.postings[low]
+            yield from ids[bisect.bisect_right(ids, last):]
+        else:
+            for entry_id in self.unique(heapq.merge(*self.postings[low:high])):
+                if entry_id > last:
+                    yield entry_id
+                    
+    def estimate_matches(self, prefix):
+        # Entries a prefix can match; prefixes shared by many tokens count as matching everything
+        if prefix in self.top_entries:
+            return len(self)
+        low, high = self.prefix_range(prefix)
+        return sum(len(self.postings[i]) for i in range(low, high))
+        
+    def prefix_id_set(self, prefix):
+        # Typing repeats the earlier words of a query, so their id sets are kept for a while
+        ids = self.id_sets.get(prefix)
+        if ids is None:
+            ids = set()
+            low, high = self.prefix_range(prefix)
+            for i in range(low, high):
+                ids.update(self.postings[i])
+            self.id_sets[prefix] = ids
+            if len(self.id_sets) > 32:
+                self.id_sets.popitem(last=False)
+        return ids
+        
+    def search(self, words, url_prefix=None, limit=8):
+        # Returns (url, title, score) for the best entries matching every word
+        if not words:
+            return []
+            
+        # Walk the most selective word in rank order; the others are checked by set membership
+        # when their matches are few enough, otherwise against the entry text
+        estimates = [self.estimate_matches(word) for word in words]
+        primary = estimates.index(min(estimates))
+        id_sets = []
+        text_words = []
+        for i, word in enumerate(words):
+            if i == primary or url_prefix is not None:
+                continue
+            if estimates[i] <= self.ID_SET_LIMIT:
+                id_sets.append(self.prefix_id_set(word))
+            else:
+                text_words.append(word)
+                
+        results = []
+        for checked, entry_id in enumerate(self.prefix_ids(words[primary])):
+            if checked >= self.MAX_CHECKED:
+                break
+            if id_sets and not all(entry_id in ids for ids in id_sets):
+                continue
+            url, title = self.urls[entry_id], self.titles[entry_id]
+            if (url_prefix is None and not text_words) or self.matches(text_words, url_prefix, url, title):
+                results.append((url, title, self.scores[entry_id]))
+                if len(results) >= limit:
+                    break
+        return results
+
+class IncrementalIndexSource:
+    # An index built on a background thread plus the entries recorded since, which are few enough
+    # to scan on every keystroke. Pending entries are [title, tags, score, data, recorded] lists,
+    # data being whatever entry_data derives to match them quickly
+    REBUILD_THRESHOLD = 2000
+    BOOKMARK_WEIGHT = 5
+    THREAD_NAME = 'IndexBuilder'
+    DESCRIPTION = 'index'
+    
+    def __init__(self, history_manager, index):
+        self.history_manager = history_manager
+        self.index = index
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.building = False
+        
+    def bookmark_score(self):
+        return EnhancedHistoryManager.visit_score(time.time(), 'typed', self.BOOKMARK_WEIGHT)
+        
+    def rebuild(self):
+        with self.lock:
+            if self.building:
+                return
+            self.building = True
+            
+        # The index is read once the visits queued so far have committed; entries recorded from
+        # now on stay pending, since they may commit after it is read
+        started = time.monotonic()
+        self.history_manager.when_written(
+            lambda: threading.Thread(target=self.build_index, args=(started,), name=self.THREAD_NAME, daemon=True).start()
+        )
+        
+    def build_index(self, started):
+        try:
+            rows = self.index_rows()
+            
+            # The index is millions of small objects; collector passes would only slow the build
+            with gc_paused():
+                index = self.create_index(rows)
+            del rows
+            
+            # Keep what was recorded while the index was being built
+            with self.lock:
+                self.index = index
+                self.pending = {url: entry for url, entry in self.pending.items() if entry[4] > started}
+        except Exception as e:
+            print(f"Error building {self.DESCRIPTION}: {str(e)}")
+        finally:
+            with self.lock:
+                self.building = False
+                
+    def index_rows(self):
+        raise NotImplementedError
+        
+    def create_index(self, rows):
+        raise NotImplementedError
+        
+    def entry_data(self, url, title, tags):
+        return None
+        
+    def bookmark_rows(self, rows, bookmarks):
+        # Merges (url, title, tags) bookmarks into {url: [title, tags, score]} history rows
+        bookmark_score = self.bookmark_score()
+        for url, title, tags in bookmarks:
+            row = rows.setdefault(url, [title, '', None])
+            row[0] = title or row[0]
+            row[1] = tags
+            row[2] = EnhancedHistoryManager.frecency_add(row[2], bookmark_score)
+        return rows
+        
+    def record(self, url, title, score, tags=''):
+        with self.lock:
+            entry = self.pending.get(url)
+            if entry is None:
+                entry = self.pending[url] = [title, tags, score, None, 0]
+            else:
+                entry[0] = title or entry[0]
+                entry[1] = tags or entry[1]
+                entry[2] = EnhancedHistoryManager.frecency_add(entry[2], score)
+            entry[3] = self.entry_data(url, entry[0], entry[1])
+            entry[4] = time.monotonic()
+            stale = len(self.pending) > self.REBUILD_THRESHOLD
+        if stale:
+            self.rebuild()
+            
+    def record_visit(self, url, title, visit_type='link'):
+        self.record(url, title, EnhancedHistoryManager.visit_score(time.time(), visit_type))
+        
+    def snapshot(self):
+        with self.lock:
+            return self.index, list(self.pending.items())
+
+class OmniboxCompletionSource(IncrementalIndexSource):
+    # Address bar suggestions: a UrlCompletionIndex over all history and bookmarks
+    THREAD_NAME = 'OmniboxIndex'
+    DESCRIPTION = 'address bar index'
+    
+    def __init__(self, history_manager):
+        super().__init__(history_manager, UrlCompletionIndex())
+        self.bookmarks = []
+        
+    def rebuild(self, bookmarks=None):
+        if bookmarks is not None:
+            self.bookmarks = list(bookmarks)
+        super().rebuild()
+        
+    def index_rows(self):
+        with self.history_manager.readers.connection() as conn:
+            rows = {url: [title, '', score] for url, title, score in conn.execute('SELECT url, title, frecency FROM urls')}
+        return self.bookmark_rows(rows, ((url, title, '') for url, title in self.bookmarks))
+        
+    def create_index(self, rows):
+        return UrlCompletionIndex((url, title, score) for url, (title, tags, score) in rows.items())
+        
+    def record_bookmark(self, url, title):
+        self.bookmarks.append((url, title))
+        self.record(url, title, self.bookmark_score())
+        
+    def suggest(self, text, limit=8):
+        words, url_prefix = UrlCompletionIndex.query_terms(text)
+        if not words:
+            return []
+            
+        index, pending = self.snapshot()
+        suggestions = {url: [title, score] for url, title, score in index.search(words, url_prefix, limit)}
+        for url, (title, tags, score, _, _) in pending:
+            if UrlCompletionIndex.matches(words, url_prefix, url, title):
+                suggestion = suggestions.get(url)
+                if suggestion is None:
+                    suggestions[url] = [title, score]
+                else:
+                    suggestion[1] = EnhancedHistoryManager.frecency_add(suggestion[1], score)
+                    
+        ranked = sorted(suggestions.items(), key=lambda item: item[1][1], reverse=True)
+        return [(url, title) for url, (title, score) in ranked[:limit]]
+
+class QuickOpenIndex:
+    # Immutable trigram index over bookmark and history titles, tags and urls for the quick open
+    # palette. Every word contributes its trigrams plus its first two letters, each with a leading
+    # space so word starts are grams of their own. Entries are numbered best score first, so
+    # posting lists are sorted and list their best entries first
+    COUNT_BUDGET = 15000
+    MAX_CHECKED = 1500
+    MAX_WALKED = 2000
+    WALK_CHUNK = 250
+    
+    def __init__(self, rows=()):
+        rows = sorted(rows, key=lambda row: row[3] if row[3] is not None else -math.inf, reverse=True)
+        self.urls = [row[0] for row in rows]
+        self.titles = [row[1] for row in rows]
+        self.tags = [row[2] for row in rows]
+        self.scores = array('d', (row[3] if row[3] is not None else -math.inf for row in rows))
+        del rows
+        
+        postings = {}
+        for entry_id, (url, title, tags) in enumerate(zip(self.urls, self.titles, self.tags)):
+            for gram in self.grams(self.entry_text(url, title, tags)):
+                ids = postings.get(gram)
+                if ids is None:
+                    postings[gram] = [entry_id]
+                else:
+                    ids.append(entry_id)
+        self.postings = {gram: array('I', ids) for gram, ids in postings.items()}
+        del postings
+        
+        # Grams in more than one entry in twenty also get a flag per entry, so checking candidates
+        # against them is a lookup
+        self.flags = {}
+        for gram, ids in self.postings.items():
+            if len(ids) * 20 > len(self.urls):
+                flags = bytearray(len(self.urls))
+                for entry_id in ids:
+                    flags[entry_id] = 1
+                self.flags[gram] = flags
+                
+    def __len__(self):
+        return len(self.urls)
+        
+    @staticmethod
+    def entry_text(url, title, tags):
+        text = f"{title} {tags} {UrlCompletionIndex.normalize_url(url)}"
+        return text.lower().translate(UrlCompletionIndex.WORD_SEPARATORS)
+        
+    @staticmethod
+    def query_text(text):
+        return ' '.join(text.lower().translate(UrlCompletionIndex.WORD_SEPARATORS).split())
+        
+    @staticmethod
+    def grams(text):
+        grams = set()
+        for word in text.split():
+            word = ' ' + word
+            grams.add(word[:2])
+            grams.update(word[i:i + 3] for i in range(len(word) - 2))
+        return grams
+        
+    @staticmethod
+    def query_grams(query):
+        # The two letter word starts are only looked up for single letters, as they list most entries
+        grams = set()
+        for word in query.split():
+            word = ' ' + word
+            if len(word) == 2:
+                grams.add(word)
+            else:
+                grams.update(word[i:i + 3] for i in range(len(word) - 2))
+        return grams
+        
+    @staticmethod
+    def needed(grams):
+        # Two thirds of the grams, which leaves room for a typo in each word
+        return (2 * len(grams) + 2) // 3
+        
+    def intersect(self, candidates, gram):
+        # The sorted candidates listed under gram: by flag where the gram has them, otherwise
+        # against the part of the list spanning the candidates, by bisection while the candidates
+        # are few and by one set pass otherwise
+        if not candidates:
+            return []
+        flags = self.flags.get(gram)
+        if flags is not None:
+            return list(itertools.compress(candidates, map(flags.__getitem__, candidates)))
+        ids = self.postings[gram]
+        ids = ids[bisect.bisect_left(ids, candidates[0]):bisect.bisect_right(ids, candidates[-1])]
+        if len(candidates) * 10 < len(ids):
+            found = []
+            for entry_id in candidates:
+                position = bisect.bisect_left(ids, entry_id)
+                if position < len(ids) and ids[position] == entry_id:
+                    found.append(entry_id)
+            return found
+        return sorted(set(candidates).intersection(ids))
+        
+    def groups(self, counts, floor):
+        # {shared: sorted ids} for the candidates that can be checked, the MAX_CHECKED sharing
+        # the most grams and the best ranked among equals. Only the lowest level reached is cut
+        ids = list(counts)
+        shared = list(counts.values())
+        sizes = Counter(shared)
+        lowest = max(sizes)
+        above = 0
+        while lowest > floor and above + sizes[lowest] < self.MAX_CHECKED:
+            above += sizes[lowest]
+            lowest -= 1
+            
+        top = sorted(itertools.compress(ids, map(lowest.__lt__, shared)))
+        top.sort(key=counts.__getitem__, reverse=True)
+        groups = {count: list(group) for count, group in itertools.groupby(top, counts.__getitem__)}
+        
+        # The lowest level is usually large; only its best ids are sorted
+        bottom = list(itertools.compress(ids, map(lowest.__eq__, shared)))
+        wanted = self.MAX_CHECKED - above
+        if len(bottom) > 4 * wanted:
+            cutoff = len(self) * 2 * wanted // len(bottom) + 1
+            head = sorted(filter(cutoff.__gt__, bottom))
+            bottom = head if len(head) >= wanted else sorted(bottom)
+        else:
+            bottom.sort()
+        groups[lowest] = bottom
+        return groups
+        
+    def search(self, query, limit=20):
+        # Returns (url, title, tags, score, shared) for the entries sharing the most of the
+        # query's grams, best score first among equals; query is normalized with query_text
+        grams = self.query_grams(query)
+        if not grams:
+            return [(self.urls[i], self.titles[i], self.tags[i], self.scores[i], 0) for i in range(min(limit, len(self)))]
+        needed = self.needed(grams)
+        found = sorted((gram for gram in grams if gram in self.postings), key=lambda gram: len(self.postings[gram]))
+        if len(found) < needed:
+            return []
+        lists = [self.postings[gram] for gram in found]
+        if len(grams) == 1:
+            return [(self.urls[i], self.titles[i], self.tags[i], self.scores[i], 1) for i in lists[0][:limit]]
+            
+        # Usually the best entries holding every gram are near the head of the rarest list, and
+        # nothing can outrank them
+        if len(lists) == len(grams):
+            complete = []
+            for start in range(0, min(len(lists[0]), self.MAX_WALKED), self.WALK_CHUNK):
+                chunk = list(lists[0][start:start + self.WALK_CHUNK])
+                for gram in found[1:]:
+                    chunk = self.intersect(chunk, gram)
+                complete.extend(chunk)
+                if len(complete) >= limit:
+                    return [(self.urls[i], self.titles[i], self.tags[i], self.scores[i], len(grams)) for i in complete[:limit]]
+                    
+        # The rarest grams are counted in full. An entry sharing enough grams shares at least
+        # needed minus the uncounted ones among them, so enough are counted for that to be one
+        # or more, and more while the budget lasts; the uncounted grams are looked up for the
+        # candidates left. Flagged grams list too many entries to count. When the query needs
+        # them, entries sharing none of the counted grams are only taken from the head of the
+        # rarest flagged list, where the best entries are
+        counts = Counter()
+        counted = 0
+        total = 0
+        while counted < len(lists) and found[counted] not in self.flags and \
+                (counted <= len(lists) - needed or total + len(lists[counted]) <= self.COUNT_BUDGET):
+            counts.update(lists[counted])
+            total += len(lists[counted])
+            counted += 1
+        rest = found[counted:]
+        floor = needed - len(rest)
+        if floor <= 0:
+            floor = 0
+            for entry_id in itertools.filterfalse(counts.__contains__, lists[counted][:self.MAX_WALKED]):
+                counts[entry_id] = 0
+        
+        # Entries are checked most shared first and each group in rank order, a chunk at a time,
+        # until no later entry could make the results
+        groups = self.groups(counts, floor)
+        del counts
+        
+        best = []
+        checked = 0
+        for shared in range(counted, floor - 1, -1):
+            if checked >= self.MAX_CHECKED or (len(best) >= limit and best[0][0] > shared + len(rest)):
+                break
+            group = groups.get(shared, [])
+            for start in range(0, len(group), self.WALK_CHUNK):
+                if checked >= self.MAX_CHECKED or (len(best) >= limit and best[0] >= (shared + len(rest), -group[start])):
+                    break
+                chunk = group[start:start + self.WALK_CHUNK]
+                checked += len(chunk)
+                
+                # Candidates are dropped as soon as the grams left can't take them to needed
+                missing = needed - shared
+                matched = Counter()
+                for position, gram in enumerate(rest):
+                    matched.update(self.intersect(chunk, gram))
+                    left = len(rest) - position - 1
+                    if left < missing:
+                        chunk = [entry_id for entry_id in chunk if matched[entry_id] + left >= missing]
+                for entry_id in chunk:
+                    item = (shared + matched[entry_id], -entry_id)
+                    if len(best) < limit:
+                        heapq.heappush(best, item)
+                    elif item > best[0]:
+                        heapq.heapreplace(best, item)
+                        
+        return [(self.urls[entry_id], self.titles[entry_id], self.tags[entry_id], self.scores[entry_id], shared)
+                for shared, entry_id in ((shared, -negative_id) for shared, negative_id in sorted(best, reverse=True))]
+
+class QuickOpenSource(IncrementalIndexSource):
+    # Quick open palette matches: a QuickOpenIndex over bookmarks and recent history. Pending
+    # entries keep their grams
+    RECENT_HISTORY = 100000
+    THREAD_NAME = 'QuickOpenIndex'
+    DESCRIPTION = 'quick open index'
+    
+    def __init__(self, history_manager, bookmarks_manager):
+        super().__init__(history_manager, QuickOpenIndex())
+        self.bookmarks_manager = bookmarks_manager
+        
+    def index_rows(self):
+        with self.history_manager.readers.connection() as conn:
+            rows = {url: [title, '', score] for url, title, score in conn.execute(
+                'SELECT url, title, frecency FROM urls ORDER BY last_visit DESC LIMIT ?', (self.RECENT_HISTORY,)
+            )}
+        bookmarks = self.bookmarks_manager.get_bookmarks()
+        return self.bookmark_rows(rows, ((b['url'], b['title'], b['tags']) for b in bookmarks))
+        
+    def create_index(self, rows):
+        return QuickOpenIndex((url, title, tags, score) for url, (title, tags, score) in rows.items())
+        
+    def entry_data(self, url, title, tags):
+        return QuickOpenIndex.grams(QuickOpenIndex.entry_text(url, title, tags))
+        
+    def record_bookmark(self, url, title, tags=''):
+        self.record(url, title, self.bookmark_score(), tags)
+        
+    def search(self, text, limit=20):
+        # Returns (url, title, tags) best first
+        query = QuickOpenIndex.query_text(text)
+        grams = QuickOpenIndex.query_grams(query)
+        needed = QuickOpenIndex.needed(grams)
+        index, pending = self.snapshot()
+        results = {url: [title, tags, score, shared] for url, title, tags, score, shared in index.search(query, limit)}
+        for url, (title, tags, score, entry_grams, _) in pending:
+            shared = len(grams & entry_grams)
+            if shared < needed:
+                continue
+            result = results.get(url)
+            if result is not None:
+                score = EnhancedHistoryManager.frecency_add(result[2], score)
+            results[url] = [title, tags, score, shared]
+            
+        # Among entries sharing as many grams, those holding every typed word whole come first
+        words = query.split()
+        def rank(item):
+            url, (title, tags, score, shared) = item
+            text = QuickOpenIndex.entry_text(url, title, tags)
+            return shared, all(word in text for word in words), score if score is not None else -math.inf
+            
+        ranked = sorted(results.items(), key=rank, reverse=True)
+        return [(url, title, tags) for url, (title, tags, score, shared) in ranked[:limit]]
+
+class HistoryTableModel(QAbstractTableModel):
+    # History rows fetched a page at a time as the view scrolls. Only the key where each page starts
+    # is kept for every page; the rows themselves live in a small page cache and are read again
+    # from the database when an evicted page scrolls back into view
+    COLUMNS = ["Title", "URL", "Visit Time", "Visit Count"]
+    PAGE_SIZE = 200
+    CACHED_PAGES = 8
+    
+    def __init__(self, history_manager, parent=None, favicons=None):
+        super().__init__(parent)
+        self.history_manager = history_manager
+        self.favicons = favicons
+        self.query = ''
+        self.page_keys = [None]
+        self.pages = OrderedDict()
+        self.row_count = 0
+        self.exhausted = False
+        
+    def set_query(self, query):
+        self.beginResetModel()
+        self.query = query
+        self.page_keys = [None]
+        self.pages.clear()
+        self.row_count = 0
+        self.exhausted = False
+        self.endResetModel()
+        
+    def refresh(self):
+        self.set_query(self.query)
+        
+    def load_page(self, page):
+        rows = self.pages.get(page)
+        if rows is None:
+            rows = self.history_manager.get_history_page(self.page_keys[page], self.PAGE_SIZE, self.query)
+            self.pages[page] = rows
+            if len(self.pages) > self.CACHED_PAGES:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(page)
+        return rows
+        
+    def row_at(self, row):
+        rows = self.load_page(row // self.PAGE_SIZE)
+        offset = row % self.PAGE_SIZE
+        return rows[offset] if offset < len(rows) else None
+        
+    def url_at(self, row):
+        entry = self.row_at(row)
+        return entry[1] if entry else None
+        
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.row_count
+        
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+        
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole, Qt.DecorationRole):
+            return None
+        entry = self.row_at(index.row())
+        if entry is None:
+            return None
+        if role == Qt.ToolTipRole:
+            return entry[1]
+        if role == Qt.DecorationRole:
+            return self.favicons.icon(entry[1]) if self.favicons and index.column() == 0 else None
+        _, url, title, visit_time, visit_count = entry
+        return (title, url, visit_time, str(visit_count))[index.column()]
+        
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+        
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+        
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        page = len(self.page_keys) - 1
+        rows = self.load_page(page)
+        if len(rows) < self.PAGE_SIZE:
+            self.exhausted = True
+        else:
+            self.page_keys.append((rows[-1][3], rows[-1][0]))
+        if rows:
+            self.beginInsertRows(QModelIndex(), self.row_count, self.row_count + len(rows) - 1)
+            self.row_count += len(rows)
+            self.endInsertRows()
+
+class EnhancedPasswordManager:
+    def __init__(self):
+        self.settings = QSettings('NexusBrowser', 'Passwords')
+        
+    def save_password(self, url, username, password):
+        key = f"{url}_{username}"
+        encrypted_password = self.encrypt_password(password)
+        self.settings.setValue(key, encrypted_password)
+        
+    def get_password(self, url, username):
+        key = f"{url}_{username}"
+        encrypted_password = self.settings.value(key, "")
+        if encrypted_password:
+            return self.decrypt_password(encrypted_password)
+        return ""
+        
+    def get_saved_logins(self, url=None):
+        logins = []
+        all_keys = self.settings.allKeys()
+        
+        for key in all_keys:
+            if key.endswith('_username') or key.endswith('_password'):
+                continue
+                
+            if '_' in key:
+                parts = key.split('_')
+                if len(parts) >= 2:
+                    site_url = '_'.join(parts[:-1])
+                    username = parts[-1]
+                    
+                    if url is None or url in site_url:
+                        password = self.get_password(site_url, username)
+                        logins.append({
+                            'url': site_url,
+                            'username': username,
+                            'password': password
+                        })
+                        
+        return logins
+        
+    def delete_password(self, url, username):
+        key = f"{url}_{username}"
+        self.settings.remove(key)
+        
+    def encrypt_password(self, password):
+        # Simple encryption (in a real application, use proper encryption)
+        return ''.join(chr(ord(c) + 3) for c in password)
+        
+    def decrypt_password(self, encrypted):
+        # Simple decryption
+        return ''.join(chr(ord(c) - 3) for c in encrypted)
+
+class BookmarkIndex:
+    # Every bookmark by id, with folder and tag maps to the ids filed under them, so filters and
+    # listings are set lookups instead of scans. Ids grow as bookmarks are added, so id order
+    # is the order they were saved in
+    def __init__(self, rows=()):
+        self.entries = {}
+        self.by_folder = {}
+        self.by_tag = {}
+        for row in rows:
+            self.add(*row)
+            
+    def __len__(self):
+        return len(self.entries)
+        
+    def add(self, bookmark_id, url, title, folder, tags, added):
+        self.remove(bookmark_id)
+        self.entries[bookmark_id] = (url, title, folder, tuple(tags), added)
+        if folder:
+            self.by_folder.setdefault(folder, set()).add(bookmark_id)
+        for tag in tags:
+            self.by_tag.setdefault(tag, set()).add(bookmark_id)
+            
+    def remove(self, bookmark_id):
+        entry = self.entries.pop(bookmark_id, None)
+        if entry is None:
+            return
+        url, title, folder, tags, added = entry
+        self.discard(self.by_folder, folder, bookmark_id)
+        for tag in tags:
+            self.discard(self.by_tag, tag, bookmark_id)
+            
+    @staticmethod
+    def discard(mapping, key, bookmark_id):
+        ids = mapping.get(key)
+        if ids is not None:
+            ids.discard(bookmark_id)
+            if not ids:
+                del mapping[key]
+                
+    def find(self, folder=None, tags=()):
+        # Ids filed under the folder and every one of the tags, intersecting the smallest set first
+        sets = [self.by_folder.get(folder, set())] if folder else []
+        sets.extend(self.by_tag.get(tag, set()) for tag in tags)
+        if not sets:
+            return list(self.entries)
+        sets.sort(key=len)
+        return sorted(sets[0].intersection(*sets[1:]))
+        
+    def folders(self):
+        return sorted(self.by_folder)
+        
+    def tags(self):
+        return sorted(self.by_tag)
+
+class EnhancedBookmarksManager:
+    # Bookmarks live in the profile database next to history, with folders and tags in their own
+    # tables, and are written through the same writer thread
+    EXPORT_FIELDS = ('url', 'title', 'folder', 'tags', 'time')
+    
+    def __init__(self, history_manager):
+        self.history_manager = history_manager
+        self.writer = history_manager.writer
+        self.readers = history_manager.readers
+        self.writer.submit(self.create_tables)
+        self.writer.flush()
+        self.migrate_settings()
+        
+        # The index is read on the GUI thread and updated on the writer thread as writes commit
+        self.lock = threading.Lock()
+        self.index = BookmarkIndex(self.index_rows())
+        
+    @staticmethod
+    def create_tables(cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bookmark_folders (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bookmark_tags (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bookmarks (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                title TEXT NOT NULL DEFAULT '',
+                folder_id INTEGER REFERENCES bookmark_folders(id),
+                added TIMESTAMP NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bookmark_tag_links (
+                bookmark_id INTEGER NOT NULL REFERENCES bookmarks(id),
+                tag_id INTEGER NOT NULL REFERENCES bookmark_tags(id),
+                PRIMARY KEY (bookmark_id, tag_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS bookmarks_folder_id ON bookmarks(folder_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS bookmark_tag_links_tag_id ON bookmark_tag_links(tag_id, bookmark_id)')
+        
+    def migrate_settings(self):
+        # Earlier versions kept every bookmark as one list in QSettings; move it over in one transaction
+        settings = QSettings('NexusBrowser', 'Bookmarks')
+        bookmarks = settings.value('bookmarks', [])
+        if not bookmarks:
+            return
+            
+        print(f"Migrating {len(bookmarks)} bookmarks to the profile database...")
+        errors = self.writer.errors
+        self.writer.submit(self.save_bookmarks, bookmarks, True, [], [])
+        self.writer.flush()
+        if self.writer.errors == errors:
+            settings.remove('bookmarks')
+            
+    def index_rows(self):
+        with self.readers.connection() as conn:
+            for bookmark_id, url, title, folder, tags, added in conn.execute('''
+                SELECT bookmarks.id, bookmarks.url, bookmarks.title, COALESCE(bookmark_folders.name, ''),
+                       COALESCE((
+                           SELECT group_concat(bookmark_tags.name, ',') FROM bookmark_tag_links
+                           JOIN bookmark_tags ON bookmark_tags.id = bookmark_tag_links.tag_id
+                           WHERE bookmark_tag_links.bookmark_id = bookmarks.id
+                       ), ''),
+                       bookmarks.added
+                FROM bookmarks LEFT JOIN bookmark_folders ON bookmark_folders.id = bookmarks.folder_id
+            '''):
+                yield bookmark_id, url, title, folder, self.split_tags(tags), added
+                
+    def write(self, operation, *args, on_done=None):
+        # Queues a write without waiting for it. What it saved or removed is applied to the index
+        # once it has committed, and on_done is then called on the writer thread
+        changes = self.submit_write(operation, *args)
+        self.writer.submit_exclusive(self.finish_write, changes, on_done)
+        
+    def finish_write(self, conn, changes, on_done):
+        if self.apply_write(changes) and on_done:
+            on_done()
+        
+    def submit_write(self, operation, *args):
+        saved, removed, written = [], [], []
+        changes = (written, saved, removed)
+        self.writer.submit(self.run_write, operation, args, changes)
+        return changes
+        
+    @staticmethod
+    def run_write(cursor, operation, args, changes):
+        # Marks the write done only once the operation has returned; one that raises is rolled
+        # back to its savepoint and leaves written empty
+        written, saved, removed = changes
+        operation(cursor, *args, saved, removed)
+        written.append(True)
+        
+    def apply_write(self, changes):
+        # Only once the writer has been flushed past the write
+        written, saved, removed = changes
+        if not written:
+            return False
+        with self.lock:
+            for bookmark_id in removed:
+                self.index.remove(bookmark_id)
+            for row in saved:
+                self.index.add(*row)
+        return True
+        
+    @staticmethod
+    def split_tags(tags):
+        return list(dict.fromkeys(tag.strip() for tag in tags.split(',') if tag.strip()))
+        
+    @staticmethod
+    def label_id(cursor, table, name):
+        cursor.execute(f'INSERT INTO {table} (name) VALUES (?) ON CONFLICT(name) DO NOTHING', (name,))
+        return cursor.execute(f'SELECT id FROM {table} WHERE name = ?', (name,)).fetchone()[0]
+        
+    @classmethod
+    def save_bookmarks(cls, cursor, bookmarks, replace, saved, removed):
+        # Each bookmark is an upsert on the unique url index plus its tag links. Saved rows are
+        # appended to saved in BookmarkIndex.add order
+        for bookmark in bookmarks:
+            url = bookmark.get('url')
+            if not url:
+                continue
+            existing = cursor.execute('SELECT id FROM bookmarks WHERE url = ?', (url,)).fetchone()
+            if existing and not replace:
+                continue
+            title = bookmark.get('title', '')
+            folder = bookmark.get('folder', '')
+            tags = cls.split_tags(bookmark.get('tags', ''))
+            added = bookmark.get('time') or datetime.now().isoformat()
+            folder_id = cls.label_id(cursor, 'bookmark_folders', folder) if folder else None
+            if existing:
+                old_folder, old_tags = cls.labels_of(cursor, existing[0])
+                cursor.execute(
+                    'UPDATE bookmarks SET title = ?, folder_id = ?, added = ? WHERE id = ?',
+                    (title, folder_id, added, existing[0])
+                )
+                cursor.execute('DELETE FROM bookmark_tag_links WHERE bookmark_id = ?', (existing[0],))
+                bookmark_id = existing[0]
+            else:
+                cursor.execute(
+                    'INSERT INTO bookmarks (url, title, folder_id, added) VALUES (?, ?, ?, ?)',
+                    (url, title, folder_id, added)
+                )
+                bookmark_id = cursor.lastrowid
+            cursor.executemany(
+                'INSERT OR IGNORE INTO bookmark_tag_links (bookmark_id, tag_id) VALUES (?, ?)',
+                [(bookmark_id, cls.label_id(cursor, 'bookmark_tags', tag)) for tag in tags]
+            )
+            if existing:
+                cls.delete_unused_labels(cursor, old_folder, old_tags)
+            saved.append((bookmark_id, url, title, folder, tags, added))
+                
+    @staticmethod
+    def labels_of(cursor, bookmark_id):
+        folder_id = cursor.execute('SELECT folder_id FROM bookmarks WHERE id = ?', (bookmark_id,)).fetchone()[0]
+        tag_ids = [row[0] for row in cursor.execute('SELECT tag_id FROM bookmark_tag_links WHERE bookmark_id = ?', (bookmark_id,))]
+        return folder_id, tag_ids
+        
+    @staticmethod
+    def delete_unused_labels(cursor, folder_id, tag_ids):
+        # Only the folder and tags the changed bookmark used are checked, each through its index
+        if folder_id is not None:
+            cursor.execute(
+                'DELETE FROM bookmark_folders WHERE id = ? AND NOT EXISTS (SELECT 1 FROM bookmarks WHERE folder_id = ?)',
+                (folder_id, folder_id)
+            )
+        cursor.executemany(
+            'DELETE FROM bookmark_tags WHERE id = ? AND NOT EXISTS (SELECT 1 FROM bookmark_tag_links WHERE tag_id = ?)',
+            [(tag_id, tag_id) for tag_id in tag_ids]
+        )
+        
+    @classmethod
+    def delete_bookmark(cls, cursor, url, saved, removed):
+        existing = cursor.execute('SELECT id FROM bookmarks WHERE url = ?', (url,)).fetchone()
+        if existing:
+            folder_id, tag_ids = cls.labels_of(cursor, existing[0])
+            cursor.execute('DELETE FROM bookmark_tag_links WHERE bookmark_id = ?', (existing[0],))
+            cursor.execute('DELETE FROM bookmarks WHERE id = ?', (existing[0],))
+            cls.delete_unused_labels(cursor, folder_id, tag_ids)
+            removed.append(existing[0])
+            
+    def add_bookmark(self, url, title, folder="", tags="", on_done=None):
+        bookmark = {'url': url, 'title': title, 'folder': folder, 'tags': tags, 'time': datetime.now().isoformat()}
+        self.write(self.save_bookmarks, [bookmark], True, on_done=on_done)
+        
+    def iter_bookmarks(self, since=None, until=None):
+        # Rows in EXPORT_FIELDS order, streamed off a pooled cursor. since and until are local
+        # ISO times, compared with the time each bookmark was saved
+        conditions = []
+        params = []
+        if since:
+            conditions.append('bookmarks.added >= ?')
+            params.append(since)
+        if until:
+            conditions.append('bookmarks.added < ?')
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        
+        with self.readers.connection() as conn:
+            yield from conn.execute(f'''
+                SELECT bookmarks.url, bookmarks.title, COALESCE(bookmark_folders.name, ''),
+                       COALESCE((
+                           SELECT group_concat(bookmark_tags.name, ',') FROM bookmark_tag_links
+                           JOIN bookmark_tags ON bookmark_tags.id = bookmark_tag_links.tag_id
+                           WHERE bookmark_tag_links.bookmark_id = bookmarks.id
+                       ), ''),
+                       bookmarks.added
+                FROM bookmarks LEFT JOIN bookmark_folders ON bookmark_folders.id = bookmarks.folder_id
+                {where}
+                ORDER BY bookmarks.id
+            ''', params)
+            
+    def get_bookmarks(self, folder=None, tag=None, tags=()):
+        # Bookmarks in the folder carrying tag and every one of tags, answered from the index
+        wanted = list(tags) + ([tag] if tag else [])
+        bookmarks = []
+        with self.lock:
+            for bookmark_id in self.index.find(folder, wanted):
+                url, title, folder_name, bookmark_tags, added = self.index.entries[bookmark_id]
+                bookmarks.append({'url': url, 'title': title, 'folder': folder_name, 'tags': ','.join(bookmark_tags),
+                                  'time': added})
+        return bookmarks
+        
+    def get_folders(self):
+        with self.lock:
+            return self.index.folders()
+            
+    def get_tags(self):
+        with self.lock:
+            return self.index.tags()
+        
+    def remove_bookmark(self, url, on_done=None):
+        self.write(self.delete_bookmark, url, on_done=on_done)
+        
+    def export_bookmarks(self, file_path, export_format=None, compress=None, since=None, until=None):
+        # JSON unless the file name asks for JSON lines or CSV; a JSON export can be imported again
+        return write_export(file_path, self.EXPORT_FIELDS, self.iter_bookmarks(since, until),
+                            export_format or export_format_for(file_path, 'json'), compress)
+                            
+    def import_bookmarks(self, file_path):
+        # Merges bookmarks on the importer's own thread, keeping the ones already saved
+        importer = BookmarkImporter(self, file_path)
+        importer.start()
+        return importer
+
+class NetscapeBookmarkParser(HTMLParser):
+    # Reads the Netscape bookmark file every browser exports as it is fed. A folder is an <H3>
+    # heading followed by a <DL> list of its contents and a bookmark is an <A> link; bookmarks
+    # collect in self.bookmarks, with their folder path, until take() hands them over
+    def __init__(self, separator='/'):
+        super().__init__(convert_charrefs=True)
+        self.separator = separator
+        self.folders = []
+        self.heading = None
+        self.link = None
+        self.text = None
+        self.bookmarks = []
+        
+    def handle_starttag(self, tag, attrs):
+        if tag == 'h3':
+            self.text = []
+        elif tag == 'a':
+            self.link = dict(attrs)
+            self.text = []
+        elif tag == 'dl':
+            # A list opened right after a heading holds that folder; the outermost one has none
+            self.folders.append(self.heading)
+            self.heading = None
+            
+    def handle_endtag(self, tag):
+        if tag == 'h3' and self.text is not None:
+            self.heading = ''.join(self.text).strip()
+            self.text = None
+        elif tag == 'a' and self.link is not None:
+            self.add_link(self.link, ''.join(self.text).strip())
+            self.link = self.text = None
+        elif tag == 'dl' and self.folders:
+            self.folders.pop()
+            
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+            
+    def add_link(self, attrs, title):
+        url = (attrs.get('href') or '').strip()
+        
+        # Firefox exports its smart folders as place: queries, which only mean something to Firefox
+        if not url or url.startswith('place:'):
+            return
+        self.bookmarks.append({
+            'url': url,
+            'title': title,
+            'folder': self.separator.join(name for name in self.folders if name),
+            'tags': attrs.get('tags') or '',
+            'time': self.added_time(attrs.get('add_date'))
+        })
+        
+    @staticmethod
+    def added_time(value):
+        # Seconds since 1970, though some exporters write milliseconds or microseconds
+        try:
+            timestamp = int(value)
+            while timestamp > 10 ** 11:
+                timestamp //= 1000
+            return datetime.fromtimestamp(timestamp).isoformat() if timestamp > 0 else ''
+        except (TypeError, ValueError, OverflowError, OSError):
+            return ''
+            
+    def take(self):
+        bookmarks, self.bookmarks = self.bookmarks, []
+        return bookmarks
+
+class BookmarkImporter(BackgroundImporter):
+    # Imports a Netscape bookmark file, or a JSON, JSON lines or CSV file as written by
+    # export_bookmarks, optionally gzipped. The file is parsed as it is read and saved a batch
+    # at a time while the next batch is parsed, so memory stays flat however large it is.
+    # Bookmarks whose url is already saved are left as they are
+    BATCH_SIZE = 2000
+    READ_SIZE = 65536
+    # Longest JSON element read before the file is taken to be malformed
+    MAX_ELEMENT_SIZE = 1 << 20
+    THREAD_NAME = 'BookmarkImport'
+    DESCRIPTION = 'bookmarks'
+    
+    def __init__(self, bookmarks_manager, path):
+        super().__init__(path)
+        self.bookmarks_manager = bookmarks_manager
+        self.parsed = 0
+        
+    def detect_source(self, text):
+        # By extension where it is unambiguous, otherwise by the first character
+        name = self.path[:-3] if self.path.endswith('.gz') else self.path
+        extension = os.path.splitext(name)[1].lstrip('.').lower()
+        if extension in ('html', 'htm'):
+            return 'html'
+        if extension == 'csv':
+            return 'csv'
+        start = text.read(1)
+        while start.isspace():
+            start = text.read(1)
+        text.seek(0)
+        if start == '<':
+            return 'html'
+        if start == '[':
+            return 'json'
+        if start == '{':
+            return 'jsonl'
+        raise ValueError(f"{os.path.basename(self.path)} is not a bookmark file")
+        
+    def iter_html(self, text):
+        parser = NetscapeBookmarkParser()
+        for chunk in iter(lambda: text.read(self.READ_SIZE), ''):
+            parser.feed(chunk)
+            yield from parser.take()
+        parser.close()
+        yield from parser.take()
+        
+    def iter_json(self, text):
+        # Elements are decoded one at a time off a buffer that only ever holds the current one
+        decoder = json.JSONDecoder()
+        separators = re.compile(r'[\s,]*')
+        buffer = text.read(self.READ_SIZE).lstrip()
+        position = 1
+        while True:
+            position = separators.match(buffer, position).end()
+            if position == len(buffer):
+                buffer, position = text.read(self.READ_SIZE), 0
+                if not buffer:
+                    raise ValueError(f"{os.path.basename(self.path)} ends before its closing ]")
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # An element that still does not decode past the largest a bookmark could be is
+                # malformed rather than incomplete
+                if len(buffer) - position > self.MAX_ELEMENT_SIZE:
+                    raise ValueError(f"{os.path.basename(self.path)} is not valid JSON: {e.msg}")
+                more = text.read(self.READ_SIZE)
+                if not more:
+                    raise
+                buffer, position = buffer[position:] + more, 0
+                continue
+            yield element
+            
+    def iter_jsonl(self, text):
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+                
+    def iter_csv(self, text):
+        yield from csv.DictReader(text)
+        
+    def iter_bookmarks(self, text):
+        for bookmark in getattr(self, f'iter_{self.source}')(text):
+            if not isinstance(bookmark, dict):
+                continue
+            tags = bookmark.get('tags') or ''
+            yield {
+                'url': str(bookmark.get('url') or '').strip(),
+                'title': str(bookmark.get('title') or ''),
+                'folder': str(bookmark.get('folder') or ''),
+                'tags': ','.join(map(str, tags)) if isinstance(tags, list) else str(tags),
+                'time': str(bookmark.get('time') or '')
+            }
+            
+    def run(self):
+        if not os.path.isfile(self.path):
+            raise ValueError(f"{self.path} does not exist")
+        self.total = os.path.getsize(self.path)
+        
+        with open(self.path, 'rb') as raw:
+            f = gzip.open(raw) if self.path.endswith('.gz') else raw
+            text = io.TextIOWrapper(f, encoding='utf-8-sig', errors='replace', newline='')
+            self.source = self.detect_source(text)
+            bookmarks = self.iter_bookmarks(text)
+            
+            # Each batch is parsed while the one before it commits
+            pending = None
+            for batch in iter(lambda: list(itertools.islice(bookmarks, self.BATCH_SIZE)), []):
+                if pending:
+                    self.commit(pending)
+                    pending = None
+                if self.cancelled:
+                    break
+                self.read = raw.tell()
+                manager = self.bookmarks_manager
+                pending = (manager.submit_write(manager.save_bookmarks, batch, False), len(batch))
+            if pending:
+                self.commit(pending)
+            self.read = raw.tell()
+        return self.imported
+        
+    def commit(self, pending):
+        changes, count = pending
+        self.bookmarks_manager.writer.flush()
+        if not self.bookmarks_manager.apply_write(changes):
+            raise ValueError("Could not save the imported bookmarks")
+        self.imported += len(changes[1])
+        self.parsed += count
+
+class FaviconStore:
+    # Site icons kept in the profile database by page host, so tabs and lists can show them at
+    # once and offline. Image bytes are stored once per content hash however many hosts share
+    # them, and the pixmaps last looked up stay in an LRU on the GUI thread
+    ICON_SIZE = 32
+    
+    # Hosts checked per transaction when sweeping out icons no url uses any more
+    SWEEP_CHUNK = 200
+    
+    def __init__(self, history_manager, cache_size=512):
+        self.history_manager = history_manager
+        self.writer = history_manager.writer
+        self.readers = history_manager.readers
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        
+        # Hosts whose icon the writer swept out, dropped from the cache on the GUI thread's next
+        # lookup. deque appends and pops are atomic
+        self.swept = deque()
+        self.writer.submit(self.create_tables)
+        self.writer.flush()
+        history_manager.favicons = self
+        
+    def create_tables(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS favicon_images (
+                id INTEGER PRIMARY KEY,
+                hash BLOB NOT NULL UNIQUE,
+                data BLOB NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS favicons (
+                host TEXT PRIMARY KEY,
+                image_id INTEGER NOT NULL REFERENCES favicon_images(id),
+                updated TIMESTAMP NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS favicons_image_id ON favicons(image_id)')
+        
+    @staticmethod
+    def key(url):
+        # One icon per site; the scheme and a leading www. don't change it
+        host = (urlsplit(url).hostname or '').lower()
+        return host[4:] if host.startswith('www.') else host
+        
+    def lookup(self, host):
+        # Returns (hash, pixmap). Hosts without a stored icon are cached too, with a null pixmap
+        while self.swept:
+            self.cache.pop(self.swept.popleft(), None)
+        entry = self.cache.get(host)
+        if entry is not None:
+            self.cache.move_to_end(host)
+            return entry
+        with self.readers.connection() as conn:
+            row = conn.execute('''
+                SELECT favicon_images.hash, favicon_images.data
+                FROM favicons JOIN favicon_images ON favicon_images.id = favicons.image_id
+                WHERE favicons.host = ?
+            ''', (host,)).fetchone()
+        pixmap = QPixmap()
+        if row:
+            pixmap.loadFromData(row[1])
+        entry = (row[0] if row else None, pixmap)
+        self.remember(host, entry)
+        return entry
+        
+    def remember(self, host, entry):
+        self.cache[host] = entry
+        self.cache.move_to_end(host)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+            
+    def pixmap(self, url):
+        host = self.key(url)
+        return self.lookup(host)[1] if host else QPixmap()
+        
+    def icon(self, url):
+        pixmap = self.pixmap(url)
+        return QIcon() if pixmap.isNull() else QIcon(pixmap)
+        
+    def store_icon(self, url, icon):
+        host = self.key(url)
+        if not host or icon.isNull():
+            return
+        pixmap = icon.pixmap(self.ICON_SIZE, self.ICON_SIZE)
+        buffer = QBuffer()
+        buffer.open(QIODevice.WriteOnly)
+        if not pixmap.save(buffer, 'PNG'):
+            return
+        data = bytes(buffer.data())
+        digest = hashlib.sha256(data).digest()
+        
+        # Revisits usually bring the same icon, which is already stored
+        if self.lookup(host)[0] == digest:
+            return
+        self.remember(host, (digest, pixmap))
+        self.writer.submit(self.save_icon, host, digest, data)
+        
+    @staticmethod
+    def save_icon(cursor, host, digest, data):
+        cursor.execute('INSERT INTO favicon_images (hash, data) VALUES (?, ?) ON CONFLICT(hash) DO NOTHING', (digest, data))
+        image_id = cursor.execute('SELECT id FROM favicon_images WHERE hash = ?', (digest,)).fetchone()[0]
+        previous = cursor.execute('SELECT image_id FROM favicons WHERE host = ?', (host,)).fetchone()
+        cursor.execute('''
+            INSERT INTO favicons (host, image_id, updated) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(host) DO UPDATE SET image_id = excluded.image_id, updated = excluded.updated
+        ''', (host, image_id))
         
-        if result:
-            # Update existing entry
-            history_id, visit_count = result
+        # The image this host used before goes once no other host uses it
+        if previous and previous[0] != image_id:
             cursor.execute(
-                'UPDATE history SET visit_time = CURRENT_TIMESTAMP, visit_count = ? WHERE id = ?',
-                (visit_count + 1, history_id)
+                'DELETE FROM favicon_images WHERE id = ? AND NOT EXISTS (SELECT 1 FROM favicons WHERE image_id = ?)',
+                (previous[0], previous[0])
             )
-        else:
-            # Insert new entry
-            cursor.execute('INSERT INTO history (url, title) VALUES (?, ?)', (url, title))
             
-        # Update frequent sites
-        cursor.execute('SELECT id, visit_count FROM frequent_sites WHERE url = ?', (url,))
-        result = cursor.fetchone()
-        
-        if result:
-            freq_id, visit_count = result
+    def clear(self, keep_urls=()):
+        # Forgets every icon but those of the sites of keep_urls
+        self.cache.clear()
+        self.writer.submit(self.delete_icons, sorted({self.key(url) for url in keep_urls}))
+        
+    @staticmethod
+    def delete_icons(cursor, kept_hosts):
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS kept_favicon_hosts (host TEXT PRIMARY KEY)')
+        cursor.execute('DELETE FROM temp.kept_favicon_hosts')
+        cursor.executemany('INSERT OR IGNORE INTO temp.kept_favicon_hosts (host) VALUES (?)', [(host,) for host in kept_hosts])
+        cursor.execute('DELETE FROM favicons WHERE host NOT IN (SELECT host FROM temp.kept_favicon_hosts)')
+        cursor.execute('DELETE FROM favicon_images WHERE id NOT IN (SELECT image_id FROM favicons)')
+        
+    def sweep_chunk(self, cursor, after_host='', host=None):
+        # Drops the icons of hosts no history or bookmark url is on any more, SWEEP_CHUNK hosts at a
+        # time in host order, or only host's when one is given, then vacuums the history database
+        if host is None:
             cursor.execute(
-                'UPDATE frequent_sites SET visit_count = ?, last_visit = CURRENT_TIMESTAMP WHERE id = ?',
-                (visit_count + 1, freq_id)
+                'SELECT host FROM favicons WHERE host > ? ORDER BY host LIMIT ?', (after_host, self.SWEEP_CHUNK)
             )
+            hosts = [row[0] for row in cursor.fetchall()]
         else:
-            cursor.execute('INSERT INTO frequent_sites (url, title, visit_count) VALUES (?, ?, 1)', (url, title))
-            
-        self.conn.commit()
-        
-    def get_history(self, limit=100):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT url, title, visit_time, visit_count FROM history ORDER BY visit_time DESC LIMIT ?', (limit,))
-        return cursor.fetchall()
-        
-    def get_frequent_sites(self, limit=10):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT url, title, visit_count FROM frequent_sites ORDER BY visit_count DESC LIMIT ?', (limit,))
-        return cursor.fetchall()
-        
-    def search_history(self, query, limit=20):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'SELECT url, title, visit_time FROM history WHERE url LIKE ? OR title LIKE ? ORDER BY visit_time DESC LIMIT ?',
-            (f'%{query}%', f'%{query}%', limit)
-        )
-        return cursor.fetchall()
-        
-    def clear_history(self, timeframe=None):
-        cursor = self.conn.cursor()
+            hosts = [host]
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('urls', 'bookmarks')")
+        tables = [row[0] for row in cursor.fetchall()]
         
-        if timeframe:
-            # Clear history for a specific timeframe
-            if timeframe == 'last_hour':
-                cursor.execute('DELETE FROM history WHERE visit_time > datetime("now", "-1 hour")')
-            elif timeframe == 'last_day':
-                cursor.execute('DELETE FROM history WHERE visit_time > datetime("now", "-1 day")')
-            elif timeframe == 'last_week':
-                cursor.execute('DELETE FROM history WHERE visit_time > datetime("now", "-7 days")')
-            elif timeframe == 'last_month':
-                cursor.execute('DELETE FROM history WHERE visit_time > datetime("now", "-30 days")')
+        unused = [host for host in hosts if not self.host_in_use(cursor, tables, host)]
+        if unused:
+            cursor.execute(
+                f"SELECT DISTINCT image_id FROM favicons WHERE host IN ({','.join('?' * len(unused))})", unused
+            )
+            image_ids = [row[0] for row in cursor.fetchall()]
+            cursor.executemany('DELETE FROM favicons WHERE host = ?', [(host,) for host in unused])
+            cursor.executemany(
+                'DELETE FROM favicon_images WHERE id = ? AND NOT EXISTS (SELECT 1 FROM favicons WHERE image_id = ?)',
+                [(image_id, image_id) for image_id in image_ids]
+            )
+            self.swept.extend(unused)
+            
+        if host is None and len(hosts) == self.SWEEP_CHUNK:
+            self.writer.submit(self.sweep_chunk, hosts[-1])
         else:
-            # Clear all history
-            cursor.execute('DELETE FROM history')
+            self.writer.submit_exclusive(self.history_manager.vacuum_chunk)
             
-        self.conn.commit()
-        
-    def delete_history_item(self, url):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM history WHERE url = ?', (url,))
-        self.conn.commit()
+    @staticmethod
+    def host_in_use(cursor, tables, host):
+        # Whether an http or https url in tables is on host or www.host: the bare origin, or the
+        # origin followed by a path or a port, each a range of the url index
+        for scheme in ('https', 'http'):
+            for name in (host, 'www.' + host):
+                origin = f'{scheme}://{name}'
+                for table in tables:
+                    cursor.execute(f'''
+                        SELECT 1 FROM {table}
+                        WHERE url = ? OR (url >= ? AND url < ?) OR (url >= ? AND url < ?) LIMIT 1
+                    ''', (origin, origin + '/', origin + '0', origin + ':', origin + ';'))
+                    if cursor.fetchone():
+                        return True
+        return False
 
-class EnhancedPasswordManager:
-    def __init__(self):
-        self.settings = QSettings('NexusBrowser', 'Passwords')
-        
-    def save_password(self, url, username, password):
-        key = f"{url}_{username}"
-        encrypted_password = self.encrypt_password(password)
-        self.settings.setValue(key, encrypted_password)
-        
-    def get_password(self, url, username):
-        key = f"{url}_{username}"
-        encrypted_password = self.settings.value(key, "")
-        if encrypted_password:
-            return self.decrypt_password(encrypted_password)
-        return ""
-        
-    def get_saved_logins(self, url=None):
-        logins = []
-        all_keys = self.settings.allKeys()
+class StorageService(QObject):
+    # Everything a profile keeps on disk, opened once per process and shared by every window.
+    # Changes are announced through signals so each window updates from the change itself
+    visitRecorded = pyqtSignal(str, str, str)
+    historyChanged = pyqtSignal()
+    bookmarksChanged = pyqtSignal()
+    
+    # Emitted from the writer thread when a change has committed, and delivered queued
+    historyWritten = pyqtSignal()
+    bookmarksWritten = pyqtSignal()
+    
+    def __init__(self, profile='default', parent=None):
+        super().__init__(parent)
+        self.profile = profile
+        self.history_path = self.history_database(profile)
+        self.import_legacy_history('browser_history.db')
         
-        for key in all_keys:
-            if key.endswith('_username') or key.endswith('_password'):
-                continue
+        # Initialize managers
+        self.history_manager = EnhancedHistoryManager(self.history_path)
+        self.password_manager = EnhancedPasswordManager()
+        self.bookmarks_manager = EnhancedBookmarksManager(self.history_manager)
+        self.theme_manager = ThemeManager()
+        self.download_manager = DownloadManager()
+        self.favicons = FaviconStore(self.history_manager)
+        self.historyWritten.connect(self.history_updated, Qt.QueuedConnection)
+        self.bookmarksWritten.connect(self.bookmarksChanged, Qt.QueuedConnection)
+        
+        # Address bar suggestions are indexed in the background
+        self.omnibox = OmniboxCompletionSource(self.history_manager)
+        self.omnibox.rebuild([(b['url'], b.get('title', '')) for b in self.bookmarks_manager.get_bookmarks()])
+        self.visitRecorded.connect(self.omnibox.record_visit)
+        
+        # The quick open palette searches bookmarks and recent history, also indexed in the background
+        self.quick_open = QuickOpenSource(self.history_manager, self.bookmarks_manager)
+        self.quick_open.rebuild()
+        self.visitRecorded.connect(self.quick_open.record_visit)
+        
+        # History retention runs shortly after startup and then hourly, off the GUI thread
+        self.maintenance_timer = QTimer(self)
+        self.maintenance_timer.timeout.connect(self.run_history_maintenance)
+        self.maintenance_timer.start(3600000)
+        QTimer.singleShot(60000, self.run_history_maintenance)
+        
+    @staticmethod
+    def history_database(profile):
+        return os.path.join(app_data_dir('profiles', profile), 'history.db')
+        
+    def import_legacy_history(self, legacy_path):
+        # Earlier versions kept history in the working directory; copy it into a new profile once
+        if os.path.exists(self.history_path) or not os.path.isfile(legacy_path):
+            return
+        try:
+            print(f"Importing history from {legacy_path}...")
+            source = sqlite3.connect(legacy_path)
+            target = sqlite3.connect(self.history_path)
+            try:
+                source.backup(target)
+            finally:
+                source.close()
+                target.close()
                 
-            if '_' in key:
-                parts = key.split('_')
-                if len(parts) >= 2:
-                    site_url = '_'.join(parts[:-1])
-                    username = parts[-1]
-                    
-                    if url is None or url in site_url:
-                        password = self.get_password(site_url, username)
-                        logins.append({
-                            'url': site_url,
-                            'username': username,
-                            'password': password
-                        })
-                        
-        return logins
-        
-    def delete_password(self, url, username):
-        key = f"{url}_{username}"
-        self.settings.remove(key)
+            # Nothing has the copy open yet, so this is the time to switch it to incremental
+            # vacuum, which the history retention relies on to keep the file small
+            EnhancedHistoryManager.compact_database(self.history_path)
+        except Exception as e:
+            print(f"Error importing history: {str(e)}")
+            if os.path.exists(self.history_path):
+                os.remove(self.history_path)
+                
+    def record_visit(self, url, title, visit_type='link'):
+        self.history_manager.add_to_history(url, title, visit_type)
+        self.visitRecorded.emit(url, title, visit_type)
+        
+    def clear_history(self, timeframe=None, on_done=None):
+        # Deleting runs on the writer thread; history_updated follows once it has committed, and
+        # on_done is then called on the writer thread
+        def cleared():
+            self.historyWritten.emit()
+            if on_done:
+                on_done()
+        self.history_manager.clear_history(timeframe, cleared)
+        
+        # Icons outlive history only for bookmarked sites
+        if timeframe is None:
+            self.favicons.clear(bookmark['url'] for bookmark in self.bookmarks_manager.get_bookmarks())
+            
+    def delete_history_item(self, url):
+        self.history_manager.delete_history_item(url, self.historyWritten.emit)
         
-    def encrypt_password(self, password):
-        # Simple encryption (in a real application, use proper encryption)
-        return ''.join(chr(ord(c) + 3) for c in password)
+    def import_history(self, path):
+        # Runs on its own thread; call history_updated once importer.done is set
+        importer = HistoryImporter(self.history_manager, path)
+        importer.start()
+        return importer
         
-    def decrypt_password(self, encrypted):
-        # Simple decryption
-        return ''.join(chr(ord(c) - 3) for c in encrypted)
-
-class EnhancedBookmarksManager:
-    def __init__(self):
-        self.settings = QSettings('NexusBrowser', 'Bookmarks')
+    def history_updated(self):
+        self.omnibox.rebuild()
+        self.quick_open.rebuild()
+        self.historyChanged.emit()
         
     def add_bookmark(self, url, title, folder="", tags=""):
-        bookmarks = self.get_bookmarks()
-        
-        # Check if bookmark already exists
-        for bookmark in bookmarks:
-            if bookmark['url'] == url:
-                # Update existing bookmark
-                bookmark['title'] = title
-                bookmark['folder'] = folder
-                bookmark['tags'] = tags
-                bookmark['time'] = datetime.now().isoformat()
-                break
-        else:
-            # Add new bookmark
-            bookmarks.append({
-                'url': url,
-                'title': title,
-                'folder': folder,
-                'tags': tags,
-                'time': datetime.now().isoformat()
-            })
-            
-        self.settings.setValue('bookmarks', bookmarks)
+        # Bookmark lists reload once the write has committed
+        self.bookmarks_manager.add_bookmark(url, title, folder, tags, self.bookmarksWritten.emit)
+        self.omnibox.record_bookmark(url, title)
+        self.quick_open.record_bookmark(url, title, tags)
         
-    def get_bookmarks(self, folder=None, tag=None):
-        bookmarks = self.settings.value('bookmarks', [])
-        
-        if folder:
-            bookmarks = [b for b in bookmarks if b.get('folder', '') == folder]
-            
-        if tag:
-            bookmarks = [b for b in bookmarks if tag in b.get('tags', '').split(',')]
-            
-        return bookmarks
+    def import_bookmarks(self, path):
+        # Runs on its own thread; call bookmarks_updated once importer.done is set
+        return self.bookmarks_manager.import_bookmarks(path)
         
-    def get_folders(self):
-        bookmarks = self.get_bookmarks()
-        folders = set()
+    def bookmarks_updated(self):
+        self.omnibox.rebuild([(b['url'], b.get('title', '')) for b in self.bookmarks_manager.get_bookmarks()])
+        self.quick_open.rebuild()
+        self.bookmarksChanged.emit()
         
-        for bookmark in bookmarks:
-            folder = bookmark.get('folder', '')
-            if folder:
-                folders.add(folder)
-                
-        return sorted(list(folders))
+    def run_history_maintenance(self):
+        settings = QSettings('NexusBrowser', 'Settings')
+        self.history_manager.run_maintenance(
+            settings.value('history_max_age_days', 0, type=int),
+            settings.value('history_max_entries', 0, type=int)
+        )
         
-    def get_tags(self):
-        bookmarks = self.get_bookmarks()
-        tags = set()
+    def close(self):
+        # Commit pending visits before the process exits
+        self.maintenance_timer.stop()
+        self.history_manager.close()
+
+# One storage service per process, shared by every window
+_storage_service = None
+
+def storage_service():
+    global _storage_service
+    
+    if _storage_service is None:
+        settings = QSettings('NexusBrowser', 'Settings')
+        _storage_service = StorageService(settings.value('profile', 'default'))
+        QApplication.instance().aboutToQuit.connect(_storage_service.close)
         
-        for bookmark in bookmarks:
-            for tag in bookmark.get('tags', '').split(','):
-                if tag.strip():
-                    tags.add(tag.strip())
-                    
-        return sorted(list(tags))
+    return _storage_service
+
+class QuickOpenDialog(QDialog):
+    # Fuzzy search over bookmarks and history as you type; Enter opens the selected result
+    MAX_RESULTS = 20
+    
+    def __init__(self, quick_open, favicons=None, parent=None):
+        super().__init__(parent)
+        self.quick_open = quick_open
+        self.favicons = favicons
+        self.setWindowTitle("Quick Open")
+        self.resize(640, 420)
         
-    def remove_bookmark(self, url):
-        bookmarks = self.get_bookmarks()
-        bookmarks = [b for b in bookmarks if b['url'] != url]
-        self.settings.setValue('bookmarks', bookmarks)
+        layout = QVBoxLayout()
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("Search bookmarks and history...")
+        self.search_edit.textChanged.connect(self.update_results)
+        self.search_edit.returnPressed.connect(self.accept)
+        self.search_edit.installEventFilter(self)
+        layout.addWidget(self.search_edit)
+        
+        self.results_list = QListWidget()
+        self.results_list.itemActivated.connect(self.accept)
+        layout.addWidget(self.results_list)
+        self.setLayout(layout)
         
-    def export_bookmarks(self, file_path):
-        bookmarks = self.get_bookmarks()
-        with open(file_path, 'w') as f:
-            json.dump(bookmarks, f, indent=2)
-            
-    def import_bookmarks(self, file_path):
-        try:
-            with open(file_path, 'r') as f:
-                bookmarks = json.load(f)
-                
-            current_bookmarks = self.get_bookmarks()
-            current_urls = {b['url'] for b in current_bookmarks}
+        self.update_results('')
+        
+    def update_results(self, text):
+        self.results_list.clear()
+        for url, title, tags in self.quick_open.search(text, self.MAX_RESULTS):
+            label = f"{title or url}\n{url}"
+            if tags:
+                label += f"  [{tags}]"
+            item = QListWidgetItem(label)
+            if self.favicons:
+                item.setIcon(self.favicons.icon(url))
+            item.setData(Qt.UserRole, url)
+            item.setToolTip(url)
+            self.results_list.addItem(item)
+        if self.results_list.count():
+            self.results_list.setCurrentRow(0)
             
-            # Merge bookmarks, avoiding duplicates
-            for bookmark in bookmarks:
-                if bookmark['url'] not in current_urls:
-                    current_bookmarks.append(bookmark)
-                    
-            self.settings.setValue('bookmarks', current_bookmarks)
+    def eventFilter(self, obj, event):
+        # Arrow keys move through the results without leaving the search box
+        if obj is self.search_edit and event.type() == QEvent.KeyPress and \
+                event.key() in (Qt.Key_Up, Qt.Key_Down, Qt.Key_PageUp, Qt.Key_PageDown):
+            QApplication.sendEvent(self.results_list, event)
             return True
-        except:
-            return False
+        return super().eventFilter(obj, event)
+        
+    def selected_url(self):
+        item = self.results_list.currentItem()
+        return item.data(Qt.UserRole) if item else None
 
 class EnhancedSettingsDialog(QDialog):
     def __init__(self, parent=None):
@@ -978,6 +4731,35 @@ class EnhancedSettingsDialog(QDialog):
         tracking_group.setLayout(tracking_layout)
         privacy_layout.addWidget(tracking_group)
         
+        # Filter lists
+        filter_lists_group = QGroupBox("Filter Lists")
+        filter_lists_layout = QVBoxLayout()
+        
+        self.filter_lists = QListWidget()
+        filter_lists_layout.addWidget(self.filter_lists)
+        
+        filter_lists_group.setLayout(filter_lists_layout)
+        privacy_layout.addWidget(filter_lists_group)
+        
+        # History retention
+        history_group = QGroupBox("History")
+        history_layout = QFormLayout()
+        
+        self.history_max_age = QSpinBox()
+        self.history_max_age.setRange(0, 3650)
+        self.history_max_age.setSpecialValueText("Forever")
+        self.history_max_age.setSuffix(" days")
+        history_layout.addRow("Keep history for:", self.history_max_age)
+        
+        self.history_max_entries = QSpinBox()
+        self.history_max_entries.setRange(0, 10000000)
+        self.history_max_entries.setSingleStep(10000)
+        self.history_max_entries.setSpecialValueText("Unlimited")
+        history_layout.addRow("Maximum entries:", self.history_max_entries)
+        
+        history_group.setLayout(history_layout)
+        privacy_layout.addWidget(history_group)
+        
         # Cookies
         cookies_group = QGroupBox("Cookies")
         cookies_layout = QVBoxLayout()
@@ -1054,7 +4836,16 @@ class EnhancedSettingsDialog(QDialog):
         self.safe_browsing.setChecked(settings.value('safe_browsing', True, type=bool))
         self.do_not_track.setChecked(settings.value('do_not_track', False, type=bool))
         self.cookie_policy.setCurrentText(settings.value('cookie_policy', 'Allow all cookies'))
-        
+        self.history_max_age.setValue(settings.value('history_max_age_days', 0, type=int))
+        self.history_max_entries.setValue(settings.value('history_max_entries', 0, type=int))
+        
+        disabled_lists = set(settings.value('disabled_filter_lists', [], type=list))
+        for path in available_filter_lists():
+            item = QListWidgetItem(os.path.basename(path))
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Unchecked if item.text() in disabled_lists else Qt.Checked)
+            self.filter_lists.addItem(item)
+            
         # Advanced
         self.enable_js.setChecked(settings.value('enable_js', True, type=bool))
         self.hw_acceleration.setChecked(settings.value('hw_acceleration', True, type=bool))
@@ -1073,6 +4864,12 @@ class EnhancedSettingsDialog(QDialog):
         settings.setValue('safe_browsing', self.safe_browsing.isChecked())
         settings.setValue('do_not_track', self.do_not_track.isChecked())
         settings.setValue('cookie_policy', self.cookie_policy.currentText())
+        settings.setValue('history_max_age_days', self.history_max_age.value())
+        settings.setValue('history_max_entries', self.history_max_entries.value())
+        settings.setValue('disabled_filter_lists', [
+            self.filter_lists.item(i).text() for i in range(self.filter_lists.count())
+            if self.filter_lists.item(i).checkState() != Qt.Checked
+        ])
         
         # Advanced
         settings.setValue('enable_js', self.enable_js.isChecked())
@@ -1083,17 +4880,23 @@ class EnhancedSettingsDialog(QDialog):
         super().accept()
 
 class EnhancedBrowser(QMainWindow):
+    # Emitted from the writer thread once a clear this window asked for has committed
+    historyCleared = pyqtSignal()
+    
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Nexus Browser")
         self.setGeometry(100, 100, 1200, 800)
         
-        # Initialize managers
-        self.history_manager = EnhancedHistoryManager()
-        self.password_manager = EnhancedPasswordManager()
-        self.bookmarks_manager = EnhancedBookmarksManager()
-        self.theme_manager = ThemeManager()
-        self.download_manager = DownloadManager()
+        # Storage and managers are shared with every other window
+        self.storage = storage_service()
+        self.history_manager = self.storage.history_manager
+        self.password_manager = self.storage.password_manager
+        self.bookmarks_manager = self.storage.bookmarks_manager
+        self.theme_manager = self.storage.theme_manager
+        self.download_manager = self.storage.download_manager
+        self.omnibox = self.storage.omnibox
+        self.request_interceptor = install_request_interceptor()
         
         # Setup UI
         self.setup_ui()
@@ -1140,6 +4943,10 @@ class EnhancedBrowser(QMainWindow):
         self.progress_bar.setVisible(False)
         self.status_bar.addPermanentWidget(self.progress_bar, 1)
         
+        # Blocked request counter for the current tab
+        self.blocked_label = QLabel()
+        self.status_bar.addPermanentWidget(self.blocked_label)
+        
         # Create toolbar
         self.create_toolbar()
         
@@ -1181,8 +4988,17 @@ class EnhancedBrowser(QMainWindow):
         self.url_bar = QLineEdit()
         self.url_bar.setPlaceholderText("Enter URL or search terms...")
         self.url_bar.returnPressed.connect(self.navigate_to_url)
+        self.url_bar.textEdited.connect(self.update_url_suggestions)
         nav_toolbar.addWidget(self.url_bar)
         
+        # Suggestions are ranked by the omnibox index, so the completer shows them unfiltered
+        self.url_suggestions = QStandardItemModel(self)
+        self.url_completer = QCompleter(self.url_suggestions, self)
+        self.url_completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.url_completer.setCompletionRole(Qt.UserRole)
+        self.url_completer.activated[str].connect(self.open_url_suggestion)
+        self.url_bar.setCompleter(self.url_completer)
+        
         # Go button
         go_btn = QAction(QIcon.fromTheme("go-jump"), "Go", self)
         go_btn.triggered.connect(self.navigate_to_url)
@@ -1244,6 +5060,16 @@ class EnhancedBrowser(QMainWindow):
         
         file_menu.addSeparator()
         
+        import_history_action = QAction("Import History...", self)
+        import_history_action.triggered.connect(self.import_history)
+        file_menu.addAction(import_history_action)
+        
+        import_bookmarks_action = QAction("Import Bookmarks...", self)
+        import_bookmarks_action.triggered.connect(self.import_bookmarks)
+        file_menu.addAction(import_bookmarks_action)
+        
+        file_menu.addSeparator()
+        
         print_action = QAction("Print", self)
         print_action.setShortcut("Ctrl+P")
         print_action.triggered.connect(self.print_page)
@@ -1336,6 +5162,11 @@ class EnhancedBrowser(QMainWindow):
         show_bookmarks_action.triggered.connect(self.show_bookmarks)
         bookmarks_menu.addAction(show_bookmarks_action)
         
+        quick_open_action = QAction("Quick Open...", self)
+        quick_open_action.setShortcut("Ctrl+K")
+        quick_open_action.triggered.connect(self.show_quick_open)
+        bookmarks_menu.addAction(quick_open_action)
+        
         add_bookmark_action = QAction("Add Bookmark", self)
         add_bookmark_action.setShortcut("Ctrl+D")
         add_bookmark_action.triggered.connect(self.add_current_bookmark)
@@ -1373,6 +5204,12 @@ class EnhancedBrowser(QMainWindow):
         self.download_manager.downloadProgress.connect(self.download_progress)
         self.download_manager.downloadFinished.connect(self.download_finished)
         
+        # Blocked request counters
+        self.request_interceptor.block_log.requestsBlocked.connect(self.on_requests_blocked)
+        
+        # History clears are confirmed once the deletes have committed
+        self.historyCleared.connect(self.history_cleared, Qt.QueuedConnection)
+        
     def apply_styling(self):
         # Set application style
         self.setStyleSheet("""
@@ -1550,6 +5387,7 @@ class EnhancedBrowser(QMainWindow):
         web_view.loadFinished.connect(lambda ok, view=web_view: self.on_load_finished(ok, view))
         web_view.loadingProgress.connect(self.update_progress)
         web_view.faviconChanged.connect(lambda icon, view=web_view: self.update_tab_icon(icon, view))
+        web_view.urlChanged.connect(lambda url, view=web_view: self.update_tab_icon(QIcon(), view))
         
         # Set up context menu
         web_view.setContextMenuPolicy(Qt.CustomContextMenu)
@@ -1567,6 +5405,29 @@ class EnhancedBrowser(QMainWindow):
         if index >= 0:
             web_view = self.tab_widget.widget(index)
             self.url_bar.setText(web_view.url().toString())
+            self.update_blocked_label()
+            
+    def on_requests_blocked(self, events):
+        # Requests caught by a page's own interceptor count for that page; without per page
+        # interception the tab is only known by the host it shows
+        page_counts = Counter(event[5] for event in events if event[5] is not None)
+        first_party_counts = Counter(event[0] for event in events if event[5] is None)
+        
+        for index in range(self.tab_widget.count()):
+            web_view = self.tab_widget.widget(index)
+            count = page_counts.get(web_view.page(), 0) + first_party_counts.get(web_view.url().host(), 0)
+            if count:
+                web_view.blocked_requests += count
+                self.tab_widget.setTabToolTip(index, f"{web_view.blocked_requests} requests blocked")
+                
+        self.update_blocked_label()
+        
+    def update_blocked_label(self):
+        web_view = self.tab_widget.currentWidget()
+        if web_view and web_view.blocked_requests:
+            self.blocked_label.setText(f"Blocked: {web_view.blocked_requests}")
+        else:
+            self.blocked_label.setText("")
             
     def update_urlbar(self, url, web_view=None):
         if web_view != self.tab_widget.currentWidget():
@@ -1585,7 +5446,7 @@ class EnhancedBrowser(QMainWindow):
         
         # Add to history
         if ok and web_view.url().scheme() in ['http', 'https']:
-            self.history_manager.add_to_history(web_view.url().toString(), title)
+            self.storage.record_visit(web_view.url().toString(), title, web_view.page().visit_type)
             
     def update_progress(self, progress):
         if progress < 100:
@@ -1595,6 +5456,12 @@ class EnhancedBrowser(QMainWindow):
             self.progress_bar.setVisible(False)
             
     def update_tab_icon(self, icon, web_view):
+        # The stored icon stands in until the page's own has loaded, and is kept current by it
+        url = web_view.url().toString()
+        if icon.isNull():
+            icon = self.storage.favicons.icon(url)
+        else:
+            self.storage.favicons.store_icon(url, icon)
         index = self.tab_widget.indexOf(web_view)
         self.tab_widget.setTabIcon(index, icon)
         
@@ -1620,6 +5487,22 @@ class EnhancedBrowser(QMainWindow):
         if web_view:
             web_view.setUrl(QUrl(url))
             
+    def update_url_suggestions(self, text):
+        self.url_suggestions.clear()
+        for url, title in self.omnibox.suggest(text):
+            item = QStandardItem(f"{title} - {url}" if title else url)
+            item.setData(url, Qt.UserRole)
+            self.url_suggestions.appendRow(item)
+            
+        if self.url_suggestions.rowCount():
+            self.url_completer.complete()
+        else:
+            self.url_completer.popup().hide()
+            
+    def open_url_suggestion(self, url):
+        self.url_bar.setText(url)
+        self.navigate_to_url()
+        
     def navigate_back(self):
         web_view = self.tab_widget.currentWidget()
         if web_view:
@@ -1648,15 +5531,18 @@ class EnhancedBrowser(QMainWindow):
         
         layout = QVBoxLayout()
         
-        # Bookmarks list
+        # Bookmarks list, reloaded whenever any window changes the bookmarks
         bookmarks_list = QListWidget()
-        bookmarks = self.bookmarks_manager.get_bookmarks()
         
-        for bookmark in bookmarks:
-            item = QListWidgetItem(bookmark['title'])
-            item.setData(Qt.UserRole, bookmark['url'])
-            bookmarks_list.addItem(item)
-            
+        def load_bookmarks():
+            bookmarks_list.clear()
+            for bookmark in self.bookmarks_manager.get_bookmarks():
+                item = QListWidgetItem(self.storage.favicons.icon(bookmark['url']), bookmark['title'])
+                item.setData(Qt.UserRole, bookmark['url'])
+                bookmarks_list.addItem(item)
+                
+        load_bookmarks()
+        self.storage.bookmarksChanged.connect(load_bookmarks)
         layout.addWidget(bookmarks_list)
         
         # Buttons
@@ -1677,7 +5563,15 @@ class EnhancedBrowser(QMainWindow):
         
         dialog.setLayout(layout)
         dialog.exec_()
+        self.storage.bookmarksChanged.disconnect(load_bookmarks)
         
+    def show_quick_open(self):
+        dialog = QuickOpenDialog(self.storage.quick_open, self.storage.favicons, self)
+        if dialog.exec_() == QDialog.Accepted and dialog.selected_url():
+            web_view = self.tab_widget.currentWidget()
+            if web_view:
+                web_view.setUrl(QUrl(dialog.selected_url()))
+                
     def open_bookmark(self, bookmarks_list, dialog):
         current_item = bookmarks_list.currentItem()
         if current_item:
@@ -1729,7 +5623,7 @@ class EnhancedBrowser(QMainWindow):
             dialog.setLayout(layout)
             
             if dialog.exec_() == QDialog.Accepted:
-                self.bookmarks_manager.add_bookmark(
+                self.storage.add_bookmark(
                     url, title_edit.text(), folder_edit.text(), tags_edit.text()
                 )
                 
@@ -1750,27 +5644,28 @@ class EnhancedBrowser(QMainWindow):
         search_layout.addWidget(search_btn)
         layout.addLayout(search_layout)
         
-        # History list
-        history_tree = QTreeWidget()
-        history_tree.setHeaderLabels(["Title", "URL", "Visit Time", "Visit Count"])
-        history_tree.header().setSectionResizeMode(0, QHeaderView.Stretch)
-        history_tree.setAlternatingRowColors(True)
-        
-        # Load history
-        history = self.history_manager.get_history(100)
-        for url, title, visit_time, visit_count in history:
-            item = QTreeWidgetItem(history_tree)
-            item.setText(0, title)
-            item.setText(1, url)
-            item.setText(2, visit_time)
-            item.setText(3, str(visit_count))
-            
-        layout.addWidget(history_tree)
+        # History list, paged in from the database as it scrolls. It opens on what has committed
+        # and refreshes through historyWritten once the visits still queued have been written
+        history_model = HistoryTableModel(self.history_manager, dialog, self.storage.favicons)
+        self.storage.historyChanged.connect(history_model.refresh)
+        self.history_manager.when_written(self.storage.historyWritten.emit)
+        history_view = QTableView()
+        history_view.setModel(history_model)
+        history_view.setSelectionBehavior(QAbstractItemView.SelectRows)
+        history_view.setSelectionMode(QAbstractItemView.SingleSelection)
+        history_view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        history_view.verticalHeader().setVisible(False)
+        history_view.verticalHeader().setDefaultSectionSize(history_view.fontMetrics().height() + 8)
+        history_view.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        history_view.setAlternatingRowColors(True)
+        history_view.doubleClicked.connect(lambda: self.open_history_item(history_view, dialog))
+        
+        layout.addWidget(history_view)
         
         # Buttons
         button_layout = QHBoxLayout()
         open_btn = QPushButton("Open")
-        open_btn.clicked.connect(lambda: self.open_history_item(history_tree, dialog))
+        open_btn.clicked.connect(lambda: self.open_history_item(history_view, dialog))
         
         clear_btn = QPushButton("Clear History")
         clear_btn.clicked.connect(self.clear_history)
@@ -1784,30 +5679,25 @@ class EnhancedBrowser(QMainWindow):
         layout.addLayout(button_layout)
         
         # Connect search
-        search_btn.clicked.connect(lambda: self.search_history(search_edit.text(), history_tree))
-        search_edit.returnPressed.connect(lambda: self.search_history(search_edit.text(), history_tree))
+        search_btn.clicked.connect(lambda: self.search_history(search_edit.text(), history_view))
+        search_edit.returnPressed.connect(lambda: self.search_history(search_edit.text(), history_view))
         
         dialog.setLayout(layout)
         dialog.exec_()
+        self.storage.historyChanged.disconnect(history_model.refresh)
         
-    def open_history_item(self, history_tree, dialog):
-        current_item = history_tree.currentItem()
-        if current_item:
-            url = current_item.text(1)
+    def open_history_item(self, history_view, dialog):
+        current_index = history_view.currentIndex()
+        if current_index.isValid():
+            url = history_view.model().url_at(current_index.row())
             web_view = self.tab_widget.currentWidget()
-            if web_view:
+            if web_view and url:
                 web_view.setUrl(QUrl(url))
             dialog.accept()
             
-    def search_history(self, query, history_tree):
-        history_tree.clear()
-        results = self.history_manager.search_history(query)
-        
-        for url, title, visit_time in results:
-            item = QTreeWidgetItem(history_tree)
-            item.setText(0, title)
-            item.setText(1, url)
-            item.setText(2, visit_time)
+    def search_history(self, query, history_view):
+        history_view.model().set_query(query)
+        history_view.scrollToTop()
             
     def clear_history(self):
         reply = QMessageBox.question(
@@ -1817,9 +5707,64 @@ class EnhancedBrowser(QMainWindow):
         )
         
         if reply == QMessageBox.Yes:
-            self.history_manager.clear_history()
-            QMessageBox.information(self, "History Cleared", "Your browsing history has been cleared.")
+            self.storage.clear_history(on_done=self.historyCleared.emit)
+            
+    def history_cleared(self):
+        QMessageBox.information(self, "History Cleared", "Your browsing history has been cleared.")
+            
+    def import_history(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, "Import History", "", "Chrome or Firefox History (History places.sqlite);;All Files (*)"
+        )
+        if not file_path:
+            return
+            
+        importer = self.storage.import_history(file_path)
+        self.follow_import(importer, self.storage.history_updated,
+                           lambda: f"Imported {importer.imported:,} visits from {importer.source.capitalize()}.")
+        
+    def import_bookmarks(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, "Import Bookmarks", "",
+            "Bookmark Files (*.html *.htm *.json *.jsonl *.csv *.gz);;All Files (*)"
+        )
+        if not file_path:
+            return
             
+        importer = self.storage.import_bookmarks(file_path)
+        self.follow_import(importer, self.storage.bookmarks_updated,
+                           lambda: f"Imported {importer.imported:,} of {importer.parsed:,} bookmarks.")
+        
+    def follow_import(self, importer, updated, summary):
+        # Shows a BackgroundImporter in a progress dialog that cancels it, polling it from here so
+        # the window stays responsive. updated is called when it ends and summary gives the message
+        # shown when it completes
+        what = importer.DESCRIPTION
+        title = f"Import {what.capitalize()}"
+        progress = QProgressDialog(f"Importing {what}...", "Cancel", 0, 0, self)
+        progress.setWindowTitle(title)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(0)
+        progress.canceled.connect(importer.cancel)
+        
+        def update_progress():
+            if importer.total:
+                progress.setMaximum(importer.total)
+                progress.setValue(importer.read)
+            if not importer.done:
+                return
+            timer.stop()
+            progress.reset()
+            updated()
+            if importer.error:
+                QMessageBox.warning(self, title, f"Could not import {what}: {importer.error}")
+            elif not importer.cancelled:
+                QMessageBox.information(self, title, summary())
+                
+        timer = QTimer(progress)
+        timer.timeout.connect(update_progress)
+        timer.start(100)
+        
     def show_downloads(self):
         self.download_manager.exec_()
         
@@ -1828,7 +5773,15 @@ class EnhancedBrowser(QMainWindow):
         if dialog.exec_() == QDialog.Accepted:
             # Apply new settings
             self.apply_theme()
-            
+            settings = QSettings('NexusBrowser', 'Settings')
+            self.request_interceptor.request_filter.set_enabled(
+                settings.value('ad_block', True, type=bool),
+                settings.value('safe_browsing', True, type=bool)
+            )
+            if self.request_interceptor.list_watcher:
+                self.request_interceptor.list_watcher.reload()
+            self.storage.run_history_maintenance()
+        
     def show_extensions(self):
         dialog = ExtensionsManager(self)
         dialog.exec_()
@@ -2105,12 +6058,665 @@ class EnhancedBrowser(QMainWindow):
             self.showNormal()
         else:
             self.showFullScreen()
+            
+    def closeEvent(self, event):
+        # Storage stays open for the other windows until the application quits
+        self.history_manager.flush()
+        super().closeEvent(event)
+
+# ==============================
+# BENCHMARKS
+# ==============================
+
+def synthetic_adblock_rules(count, seed=1):
+    rng = random.Random(seed)
+    words = ['ad', 'ads', 'banner', 'track', 'pixel', 'beacon', 'analytics', 'promo', 'sponsor',
+             'popup', 'metrics', 'tag', 'click', 'stat', 'counter', 'affiliate', 'widget', 'sync']
+    rules = set()
+    while len(rules) < count:
+        kind = rng.random()
+        word = rng.choice(words)
+        number = rng.randrange(100000)
+        if kind < 0.5:
+            rules.add(f"{word}{number}.example-{rng.choice(words)}.com")
+        elif kind < 0.8:
+            rules.add(f"/{word}/{rng.choice(words)}{number}.")
+        else:
+            rules.add(f"&{word}_{number}=")
+    return sorted(rules)
+    
+def synthetic_request_urls(count, rules=(), block_ratio=0.1, seed=2):
+    rng = random.Random(seed)
+    rules = list(rules)
+    paths = ['index.html', 'static/app.js', 'img/logo.png', 'css/site.css', 'api/v1/items?page=2',
+             'media/video.mp4', 'fonts/roboto.woff2', 'search?q=python+qt&lang=en']
+    urls = []
+    for i in range(count):
+        url = f"https://www.site{rng.randrange(500)}.com/{rng.choice(paths)}"
+        if rules and rng.random() < block_ratio:
+            url = f"https://cdn{rng.randrange(50)}.net/{rng.choice(rules)}?id={i}"
+        urls.append(url)
+    return urls
+    
+def benchmark_adblock_matcher(rules, urls):
+    results = {}
+    
+    started = time.perf_counter()
+    matcher = MultiPatternMatcher(rules)
+    results['compile_seconds'] = time.perf_counter() - started
+    
+    # The loop EnhancedURLInterceptor used before the compiled matcher
+    def linear_search(url):
+        for rule in rules:
+            if rule in url:
+                return rule
+        return None
+        
+    for name, search in (('linear', linear_search), ('compiled', matcher.search)):
+        blocked = 0
+        started = time.perf_counter()
+        for url in urls:
+            if search(url) is not None:
+                blocked += 1
+        elapsed = time.perf_counter() - started
+        results[name] = {
+            'requests_per_second': len(urls) / elapsed if elapsed else float('inf'),
+            'blocked': blocked
+        }
+        
+    return results
+    
+def run_adblock_benchmark(args):
+    parser = argparse.ArgumentParser(prog='browser.py --bench-adblock',
+                                     description='Compare the compiled ad block matcher with a linear rule scan.')
+    parser.add_argument('--rules', help='rules file to load instead of a synthetic list')
+    parser.add_argument('--sizes', default='1000,10000,70000', help='comma separated synthetic list sizes')
+    parser.add_argument('--requests', type=int, default=2000, help='number of request URLs to match')
+    options = parser.parse_args(args)
+    
+    if options.rules:
+        with open(options.rules, 'r', encoding='utf-8', errors='replace') as f:
+            rule_sets = [[line.strip() for line in f if line.strip() and not line.startswith('!')]]
+    else:
+        rule_sets = [synthetic_adblock_rules(int(size)) for size in options.sizes.split(',')]
+        
+    for rules in rule_sets:
+        urls = synthetic_request_urls(options.requests, rules)
+        results = benchmark_adblock_matcher(rules, urls)
+        linear = results['linear']['requests_per_second']
+        compiled = results['compiled']['requests_per_second']
+        print(f"{len(rules):>8} rules: linear {linear:>12,.0f} req/s | compiled {compiled:>12,.0f} req/s "
+              f"| speedup {compiled / linear:>8.1f}x | compile {results['compile_seconds']:.2f}s "
+              f"| blocked {results['compiled']['blocked']}/{len(urls)}")
+    return 0
+    
+def synthetic_domains(count, seed=3):
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz0123456789'
+    tlds = ['com', 'net', 'org', 'info', 'xyz', 'ru', 'io', 'co.uk']
+    domains = set()
+    while len(domains) < count:
+        name = ''.join(rng.choice(letters) for _ in range(rng.randint(6, 14)))
+        domains.add(f"{name}.{rng.choice(tlds)}")
+    return list(domains)
+    
+def run_safe_browsing_benchmark(args):
+    parser = argparse.ArgumentParser(prog='browser.py --bench-safe-browsing',
+                                     description='Measure safe browsing list memory and lookup time by list size.')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma separated list sizes')
+    parser.add_argument('--lookups', type=int, default=100000, help='number of host lookups per size')
+    options = parser.parse_args(args)
+    
+    for size in (int(size) for size in options.sizes.split(',')):
+        domains = synthetic_domains(size)
+        started = time.perf_counter()
+        threat_list = ThreatDomainList(domains)
+        build_seconds = time.perf_counter() - started
+        
+        # Mostly clean hosts with a few subdomains of listed ones
+        rng = random.Random(4)
+        hosts = [f"www.site{rng.randrange(100000)}.com" for _ in range(options.lookups)]
+        for i in range(0, len(hosts), 50):
+            hosts[i] = "cdn." + rng.choice(domains)
+            
+        started = time.perf_counter()
+        hits = sum(1 for host in hosts if threat_list.find(host) is not None)
+        lookup_seconds = time.perf_counter() - started
+        
+        memory = threat_list.memory_usage()
+        print(f"{size:>9} domains: {memory / 1048576:>7.2f} MB ({memory / size * 1000000 / 1048576:.2f} MB per million) "
+              f"| build {build_seconds:.2f}s | {lookup_seconds / len(hosts) * 1000000:.2f} us/lookup "
+              f"| hits {hits}/{len(hosts)}")
+    return 0
+    
+def synthetic_filter_list(count, seed=5):
+    # Adblock Plus style list plus one URL per blocking filter that the filter matches
+    rng = random.Random(seed)
+    words = ['ad', 'ads', 'banner', 'track', 'pixel', 'beacon', 'analytics', 'promo', 'sponsor',
+             'popup', 'metrics', 'tag', 'click', 'stat', 'counter', 'affiliate', 'widget', 'sync']
+    lines = ['[Adblock Plus 2.0]', '! Synthetic benchmark list']
+    blocked_urls = []
+    
+    for i in range(count):
+        word = rng.choice(words)
+        host = f"{word}{i}.{rng.choice(words)}-network.com"
+        kind = rng.random()
+        if kind < 0.35:
+            lines.append(f"||{host}^")
+            blocked_urls.append((f"https://{host}/collect?id={i}", 'image'))
+        elif kind < 0.5:
+            lines.append(f"||{host}^$third-party")
+            blocked_urls.append((f"https://{host}/lib.js", 'script'))
+        elif kind < 0.65:
+            lines.append(f"/{word}/{rng.choice(words)}{i}.")
+            blocked_urls.append((f"https://static.example{i % 97}.net/{word}/x{word}{i}.gif", 'image'))
+        elif kind < 0.75:
+            lines.append(f"/{word}-{i}/*.js$script")
+            blocked_urls.append((f"https://cdn{i % 13}.net/{word}-{i}/loader.js", 'script'))
+        elif kind < 0.85:
+            lines.append(f"&{word}_{i}=")
+            blocked_urls.append((f"https://api.example{i % 31}.org/v1/e?x=1&{word}_{i}=2", 'xmlhttprequest'))
+        elif kind < 0.95:
+            lines.append(f"||{host}/*/{word}^$script,xmlhttprequest,third-party")
+            blocked_urls.append((f"https://{host}/v2/{word}?cb={i}", 'xmlhttprequest'))
+        elif kind < 0.99:
+            lines.append(f"@@||{host}^$domain=site{i % 50}.com")
+        else:
+            lines.append(f"/{word}[0-9]+{i}\\.js/")
+            
+    return lines, blocked_urls
+    
+def synthetic_request_corpus(count, blocked_urls=(), block_ratio=0.15, seed=6):
+    # (url, first party url, type) tuples; URLs repeat across pages the way they do in real browsing
+    rng = random.Random(seed)
+    resources = [('static/app.js', 'script'), ('img/logo.png', 'image'), ('css/site.css', 'stylesheet'),
+                 ('api/v1/items?page=2', 'xmlhttprequest'), ('fonts/roboto.woff2', 'font'),
+                 ('media/intro.mp4', 'media'), ('embed/player.html', 'subdocument')]
+    third_parties = ['cdn.jsdelivr.net', 'fonts.gstatic.com', 'ajax.googleapis.com', 'cdnjs.cloudflare.com']
+    blocked_urls = list(blocked_urls)
+    corpus = []
+    
+    while len(corpus) < count:
+        site = f"site{rng.randrange(200)}.com"
+        first_party = f"https://www.{site}/"
+        corpus.append((first_party, first_party, 'document'))
+        for _ in range(20):
+            if blocked_urls and rng.random() < block_ratio:
+                url, request_type = rng.choice(blocked_urls)
+            else:
+                path, request_type = rng.choice(resources)
+                host = f"www.{site}" if rng.random() < 0.6 else rng.choice(third_parties)
+                url = f"https://{host}/{path}"
+            corpus.append((url, first_party, request_type))
+            
+    return corpus[:count]
+    
+def load_request_corpus(path):
+    # JSON lines with url, first_party and type keys, or tab separated url, first party url, type
+    corpus = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                corpus.append((entry['url'], entry.get('first_party', ''), entry.get('type', 'other')))
+            else:
+                parts = line.split('\t')
+                corpus.append((parts[0], parts[1] if len(parts) > 1 else '', parts[2] if len(parts) > 2 else 'other'))
+    return corpus
+    
+def benchmark_request_filter(request_filter, corpus):
+    # Host parsing happens up front; QtWebEngine hands the interceptor parsed URLs as well
+    requests = []
+    for url, first_party, request_type in corpus:
+        type_name = ADBLOCK_TYPE_ALIASES.get(request_type, request_type)
+        requests.append((url, urlsplit(url).hostname or '', urlsplit(first_party).hostname or '',
+                         ADBLOCK_TYPE_BITS.get(type_name, ADBLOCK_TYPE_BITS['other']), first_party))
+        
+    check_request = request_filter.check_request
+    clock = time.perf_counter_ns
+    latencies = []
+    blocked = 0
+    
+    started = clock()
+    for url, host, source_host, type_bit, source_url in requests:
+        request_started = clock()
+        if check_request(url, host, source_host, type_bit, source_url) is not None:
+            blocked += 1
+        latencies.append(clock() - request_started)
+    elapsed = (clock() - started) / 1e9
+    
+    latencies.sort()
+    return {
+        'requests': len(requests),
+        'requests_per_second': len(requests) / elapsed if elapsed else float('inf'),
+        'p50_us': latencies[len(latencies) // 2] / 1000 if latencies else 0.0,
+        'p99_us': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] / 1000 if latencies else 0.0,
+        'block_rate': blocked / len(requests) if requests else 0.0,
+        'cache': request_filter.decision_cache.stats()
+    }
+    
+def run_interceptor_benchmark(args):
+    parser = argparse.ArgumentParser(prog='browser.py --bench-interceptor',
+                                     description='Replay a request corpus through the interceptor logic without a GUI.')
+    parser.add_argument('--lists', nargs='*', help='filter list files to load instead of synthetic lists')
+    parser.add_argument('--sizes', default='1000,10000,50000', help='comma separated synthetic list sizes')
+    parser.add_argument('--corpus', help='request corpus (JSON lines or tab separated url, first party, type)')
+    parser.add_argument('--requests', type=int, default=20000, help='synthetic corpus size')
+    parser.add_argument('--cache-size', type=int, default=4096, help='decision cache entries, 0 to disable')
+    options = parser.parse_args(args)
+    
+    if options.lists:
+        list_sets = [('+'.join(os.path.basename(path) for path in options.lists), options.lists)]
+    else:
+        list_sets = [(size, None) for size in options.sizes.split(',')]
+        
+    for label, paths in list_sets:
+        blocked_urls = []
+        tracemalloc.start()
+        started = time.perf_counter()
+        if paths:
+            filter_lists = []
+            for path in paths:
+                with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                    filter_lists.append(AdblockFilterList(os.path.basename(path), f))
+        else:
+            lines, blocked_urls = synthetic_filter_list(int(label))
+            filter_lists = [AdblockFilterList(f"synthetic-{label}", lines)]
+            del lines
+        engine = AdblockFilterEngine(filter_lists)
+        build_seconds = time.perf_counter() - started
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        
+        if options.corpus:
+            corpus = load_request_corpus(options.corpus)
+        else:
+            corpus = synthetic_request_corpus(options.requests, blocked_urls)
+            
+        request_filter = RequestFilter(engine, ThreatDomainList(), cache_size=options.cache_size)
+        results = benchmark_request_filter(request_filter, corpus)
+        print(f"{label:>8} lists, {len(engine):>7} filters: {results['requests_per_second']:>10,.0f} req/s "
+              f"| p50 {results['p50_us']:>6.1f} us | p99 {results['p99_us']:>7.1f} us "
+              f"| memory {memory / 1048576:>7.1f} MB | build {build_seconds:.2f}s "
+              f"| blocked {results['block_rate'] * 100:.1f}% | cache hits {results['cache']['hit_rate'] * 100:.1f}%")
+    return 0
+    
+def run_history_writer_benchmark(args):
+    parser = argparse.ArgumentParser(prog='browser.py --bench-history-writer',
+                                     description='Measure the cost of recording visits with the batched history writer.')
+    parser.add_argument('--visits', type=int, default=5000, help='page loads to record')
+    parser.add_argument('--urls', type=int, default=1000, help='distinct urls visited')
+    parser.add_argument('--rate', type=float, default=0, help='page loads per second, 0 to record as fast as possible')
+    options = parser.parse_args(args)
+    
+    rng = random.Random(7)
+    urls = [f"https://{domain}/page/{i}" for i, domain in enumerate(synthetic_domains(options.urls))]
+    with tempfile.TemporaryDirectory() as directory:
+        history = EnhancedHistoryManager(os.path.join(directory, 'history.db'))
+        call_times = []
+        started = time.perf_counter()
+        for i in range(options.visits):
+            url = rng.choice(urls)
+            call_started = time.perf_counter()
+            history.add_to_history(url, f"Page {i}")
+            call_times.append(time.perf_counter() - call_started)
+            if options.rate:
+                time.sleep(1 / options.rate)
+        peak_depth = history.writer_stats()['queue_depth']
+        history.flush()
+        total_seconds = time.perf_counter() - started
+        stats = history.writer_stats()
+        history.close()
+        
+    call_times.sort()
+    print(f"{options.visits} visits in {total_seconds:.2f}s ({options.visits / total_seconds:,.0f}/s)")
+    print(f"add_to_history: p50 {call_times[len(call_times) // 2] * 1e6:.1f} us "
+          f"| p99 {call_times[int(len(call_times) * 0.99)] * 1e6:.1f} us")
+    print(f"writer: {stats['batches']} batches, {stats['writes']} writes, queue depth at end of load {peak_depth} "
+          f"| commit avg {stats['avg_commit_ms']:.2f} ms, max {stats['max_commit_ms']:.2f} ms | errors {stats['errors']}")
+    return 0
+    
+HISTORY_TITLE_WORDS = ('news', 'python', 'weather', 'recipe', 'football', 'review', 'tutorial', 'release', 'notes',
+                       'github', 'issue', 'pull', 'request', 'search', 'results', 'video', 'music', 'travel',
+                       'booking', 'docs', 'reference', 'guide', 'install', 'linux', 'windows', 'report', 'daily',
+                       'market', 'account', 'settings', 'dashboard', 'forum', 'thread', 'wiki', 'history')
+
+def synthetic_vocabulary(count, seed=10):
+    rng = random.Random(seed)
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'te', 'vo', 'zi', 'pra', 'sto', 'gen', 'mar', 'lin', 'dor']
+    words = list(HISTORY_TITLE_WORDS)
+    while len(words) < count:
+        words.append(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return words
+
+def synthetic_history(count, seed=8):
+    # Rows of (url, title, visit_time, visit_count) spread over the last two years,
+    # with title words drawn from a skewed vocabulary like real page titles
+    rng = random.Random(seed)
+    domains = synthetic_domains(max(count // 20, 10), seed)
+    vocabulary = synthetic_vocabulary(20000)
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    now = time.time()
+    for i in range(count):
+        words = rng.choices(vocabulary, cum_weights=weights, k=rng.randint(2, 6))
+        url = f"https://{rng.choice(domains)}/{'/'.join(words[:2])}/{i}"
+        title = ' '.join(word.capitalize() for word in words) + f" {rng.randint(1, 9999)}"
+        visit_time = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - rng.random() * 63072000))
+        yield url, title, visit_time, rng.randint(1, 20)
+
+def run_history_search_benchmark(args):
+    parser = argparse.ArgumentParser(prog='browser.py --bench-history-search',
+                                     description='Compare full text history search against LIKE scans.')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma separated history sizes')
+    parser.add_argument('--queries', type=int, default=50, help='queries per size')
+    options = parser.parse_args(args)
+    
+    rng = random.Random(9)
+    vocabulary = synthetic_vocabulary(20000)
+    queries = []
+    for _ in range(options.queries):
+        words = rng.sample(vocabulary[:2000], rng.randint(1, 2))
+        # Typed queries usually end mid-word
+        words[-1] = words[-1][:rng.randint(2, len(words[-1]))]
+        queries.append(' '.join(words))
+        
+    for size in (int(size) for size in options.sizes.split(',')):
+        with tempfile.TemporaryDirectory() as directory:
+            history = EnhancedHistoryManager(os.path.join(directory, 'history.db'))
+            started = time.perf_counter()
+            history.writer.submit(lambda cursor: cursor.executemany(
+                'INSERT INTO urls (url, title, last_visit, visit_count) VALUES (?, ?, ?, ?)',
+                synthetic_history(size)
+            ))
+            history.flush()
+            build_seconds = time.perf_counter() - started
+            
+            timings = {}
+            for mode in ('fts', 'like'):
+                history.fts_enabled = mode == 'fts'
+                samples = []
+                for query in queries:
+                    query_started = time.perf_counter()
+                    history.search_history(query)
+                    samples.append(time.perf_counter() - query_started)
+                samples.sort()
+                timings[mode] = (samples[len(samples) // 2] * 1000, samples[int(len(samples) * 0.95)] * 1000)
+            history.close()
+            
+        print(f"{size:>9,} rows (insert {build_seconds:.1f}s): "
+              f"fts p50 {timings['fts'][0]:>7.2f} ms, p95 {timings['fts'][1]:>7.2f} ms "
+              f"| like p50 {timings['like'][0]:>8.2f} ms, p95 {timings['like'][1]:>8.2f} ms")
+    return 0
+    
+def run_omnibox_benchmark(args):
+    parser = argparse.ArgumentParser(prog='browser.py --bench-omnibox',
+                                     description='Measure address bar index build time, memory and per-keystroke latency.')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma separated history sizes')
+    parser.add_argument('--queries', type=int, default=200, help='typed queries per size')
+    options = parser.parse_args(args)
+    
+    for size in (int(size) for size in options.sizes.split(',')):
+        rng = random.Random(11)
+        rows = [(url, title, math.log(visit_count) + rng.random() * 20)
+                for url, title, visit_time, visit_count in synthetic_history(size)]
+                
+        with gc_paused():
+            started = time.perf_counter()
+            index = UrlCompletionIndex(rows)
+            build_seconds = time.perf_counter() - started
+        
+        # Measured on a second build, as tracing slows building several times over
+        tracemalloc.start()
+        sample = UrlCompletionIndex(rows[:len(rows) // 10])
+        memory = tracemalloc.get_traced_memory()[0] * 10
+        tracemalloc.stop()
+        del sample
+        
+        source = OmniboxCompletionSource(None)
+        source.index = index
+        
+        # Replay typing of title words and addresses one keystroke at a time
+        keystrokes = []
+        for url, title, score in rng.sample(rows, options.queries):
+            if rng.random() < 0.3:
+                typed = UrlCompletionIndex.normalize_url(url)[:rng.randint(4, 20)]
+            else:
+                typed = ' '.join(title.lower().split()[:rng.randint(1, 2)])
+            keystrokes.extend(typed[:length] for length in range(1, len(typed) + 1))
+        del rows
+        
+        samples = []
+        for text in keystrokes:
+            keystroke_started = time.perf_counter()
+            source.suggest(text)
+            samples.append(time.perf_counter() - keystroke_started)
+        samples.sort()
+        print(f"{size:>9,} entries: build {build_seconds:>6.2f}s | index memory ~{memory / 1048576:>6.1f} MB "
+              f"| {len(keystrokes)} keystrokes p50 {samples[len(samples) // 2] * 1000:.3f} ms, "
+              f"p99 {samples[int(len(samples) * 0.99)] * 1000:.3f} ms, max {samples[-1] * 1000:.3f} ms")
+    return 0
+    
+# The quick open benchmark fails when p99 keystroke latency reaches this
+QUICK_OPEN_P99_MS = 10
 
+def run_quick_open_benchmark(args):
+    parser = argparse.ArgumentParser(prog='browser.py --bench-quick-open',
+                                     description='Measure quick open index build time and fuzzy search latency.')
+    parser.add_argument('--sizes', default='10000,100000', help='comma separated entry counts')
+    parser.add_argument('--queries', type=int, default=200, help='typed queries per size')
+    options = parser.parse_args(args)
+    
+    tags = ['work', 'reading', 'recipes', 'travel', 'python', 'music']
+    status = 0
+    for size in (int(size) for size in options.sizes.split(',')):
+        rng = random.Random(13)
+        rows = [(url, title, ','.join(rng.sample(tags, 2)) if rng.random() < 0.1 else '',
+                 math.log(visit_count) + rng.random() * 20)
+                for url, title, visit_time, visit_count in synthetic_history(size)]
+                
+        with gc_paused():
+            started = time.perf_counter()
+            index = QuickOpenIndex(rows)
+            build_seconds = time.perf_counter() - started
+        
+        # Replay typing of titles one keystroke at a time, half of them with a letter left out
+        keystrokes = []
+        for url, title, entry_tags, score in rng.sample(rows, options.queries):
+            typed = ' '.join(title.lower().split()[:rng.randint(1, 2)])
+            if rng.random() < 0.5 and len(typed) > 4:
+                dropped = rng.randrange(1, len(typed) - 1)
+                typed = typed[:dropped] + typed[dropped + 1:]
+            keystrokes.extend(typed[:length] for length in range(1, len(typed) + 1))
+        del rows
+        
+        samples = []
+        for text in keystrokes:
+            keystroke_started = time.perf_counter()
+            index.search(QuickOpenIndex.query_text(text))
+            samples.append(time.perf_counter() - keystroke_started)
+        samples.sort()
+        print(f"{size:>9,} entries: build {build_seconds:>6.2f}s | {len(keystrokes)} keystrokes "
+              f"p50 {samples[len(samples) // 2] * 1000:.3f} ms, p95 {samples[int(len(samples) * 0.95)] * 1000:.3f} ms, "
+              f"p99 {samples[int(len(samples) * 0.99)] * 1000:.3f} ms, max {samples[-1] * 1000:.3f} ms")
+        if samples[int(len(samples) * 0.99)] * 1000 >= QUICK_OPEN_P99_MS:
+            print(f"  p99 is over the {QUICK_OPEN_P99_MS} ms keystroke budget")
+            status = 1
+    return status
+    
+def write_synthetic_browser_history(path, source, url_count, visit_count, seed=12):
+    # A minimal Chrome History or Firefox places.sqlite with the tables the importer reads
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    pages = [(i + 1, url, title) for i, (url, title, visit_time, count) in enumerate(synthetic_history(url_count, seed))]
+    now = time.time()
+    
+    def visits():
+        for i in range(visit_count):
+            page_id = rng.randint(1, url_count)
+            timestamp = int((now - rng.random() * 63072000) * 1000000)
+            if source == 'chrome':
+                yield i + 1, page_id, timestamp + 11644473600000000, rng.choice((0, 0, 0, 1, 7, 8, 0x01000000))
+            else:
+                yield i + 1, page_id, timestamp, rng.choice((1, 1, 1, 2, 5, 9))
+                
+    with conn:
+        if source == 'chrome':
+            conn.execute('CREATE TABLE urls (id INTEGER PRIMARY KEY, url LONGVARCHAR, title LONGVARCHAR)')
+            conn.execute('CREATE TABLE visits (id INTEGER PRIMARY KEY, url INTEGER NOT NULL, visit_time INTEGER NOT NULL, '
+                         'transition INTEGER DEFAULT 0 NOT NULL)')
+            conn.executemany('INSERT INTO urls VALUES (?, ?, ?)', pages)
+            conn.executemany('INSERT INTO visits VALUES (?, ?, ?, ?)', visits())
+            conn.execute('CREATE INDEX visits_url_index ON visits (url)')
+        else:
+            conn.execute('CREATE TABLE moz_places (id INTEGER PRIMARY KEY, url LONGVARCHAR, title LONGVARCHAR)')
+            conn.execute('CREATE TABLE moz_historyvisits (id INTEGER PRIMARY KEY, place_id INTEGER, visit_date INTEGER, '
+                         'visit_type INTEGER)')
+            conn.executemany('INSERT INTO moz_places VALUES (?, ?, ?)', pages)
+            conn.executemany('INSERT INTO moz_historyvisits VALUES (?, ?, ?, ?)', visits())
+            conn.execute('CREATE INDEX moz_historyvisits_placedateindex ON moz_historyvisits (place_id, visit_date)')
+    conn.close()
+    
+def run_history_import_benchmark(args):
+    parser = argparse.ArgumentParser(prog='browser.py --bench-history-import',
+                                     description='Measure importing Chrome and Firefox history into a new profile.')
+    parser.add_argument('--visits', type=int, default=1000000, help='visits in the source history')
+    parser.add_argument('--urls', type=int, default=100000, help='distinct urls in the source history')
+    parser.add_argument('--source', choices=['chrome', 'firefox'], default='chrome', help='source browser format')
+    options = parser.parse_args(args)
+    
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, HistoryImporter.SOURCES[options.source]['database'])
+        write_synthetic_browser_history(source_path, options.source, options.urls, options.visits)
+        history = EnhancedHistoryManager(os.path.join(directory, 'history.db'))
+        
+        # The second run imports the same file again and should add nothing
+        for label in ('import', 'reimport'):
+            importer = HistoryImporter(history, directory)
+            tracemalloc.start()
+            started = time.perf_counter()
+            importer.run()
+            seconds = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{label:>8}: {importer.read:,} {importer.source} visits read, {importer.imported:,} imported "
+                  f"in {seconds:.2f}s ({importer.read / seconds:,.0f} rows/s) | peak python memory "
+                  f"{peak / 1048576:.1f} MB")
+                  
+        with history.readers.connection() as conn:
+            urls, visits = conn.execute('SELECT (SELECT COUNT(*) FROM urls), (SELECT COUNT(*) FROM visits)').fetchone()
+        print(f"history now holds {urls:,} urls and {visits:,} visits | writer errors {history.writer_stats()['errors']}")
+        history.close()
+    return 0
+    
 # ==============================
 # MAIN APPLICATION
 # ==============================
 
+def parse_export_time(text, separator):
+    # Accepts a date or a date and time; history is compared in UTC, bookmarks in local time
+    try:
+        return datetime.fromisoformat(text).isoformat(separator, 'seconds')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date or time: {text!r}")
+        
+def export_arguments(parser, separator):
+    parser.add_argument('output', help='file to write; a .gz suffix compresses it')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, help='output format, by default taken from the file name')
+    parser.add_argument('--gzip', action='store_true', default=None, help='compress the output with gzip')
+    parser.add_argument('--since', type=lambda text: parse_export_time(text, separator), help='only rows from this time on')
+    parser.add_argument('--until', type=lambda text: parse_export_time(text, separator), help='only rows before this time')
+    
+def profile_argument(parser):
+    parser.add_argument('--profile', default=QSettings('NexusBrowser', 'Settings').value('profile', 'default'),
+                        help='profile to export')
+    
+def run_export_history(args):
+    parser = argparse.ArgumentParser(prog='browser.py --export-history',
+                                     description='Export browsing history as JSON lines, CSV or JSON.')
+    export_arguments(parser, ' ')
+    profile_argument(parser)
+    options = parser.parse_args(args)
+    
+    path = StorageService.history_database(options.profile)
+    if not os.path.isfile(path):
+        print(f"No history for profile {options.profile!r} at {path}")
+        return 1
+        
+    history = EnhancedHistoryManager(path)
+    try:
+        count = write_export(options.output, ('url', 'title', 'visit_time', 'visit_type'),
+                             history.iter_visits(options.since, options.until), options.format, options.gzip)
+    finally:
+        history.close()
+    print(f"Exported {count:,} visits to {options.output}")
+    return 0
+    
+def run_export_bookmarks(args):
+    parser = argparse.ArgumentParser(prog='browser.py --export-bookmarks',
+                                     description='Export bookmarks as JSON, JSON lines or CSV.')
+    export_arguments(parser, 'T')
+    profile_argument(parser)
+    options = parser.parse_args(args)
+    
+    path = StorageService.history_database(options.profile)
+    if not os.path.isfile(path):
+        print(f"No bookmarks for profile {options.profile!r} at {path}")
+        return 1
+        
+    history = EnhancedHistoryManager(path)
+    try:
+        count = EnhancedBookmarksManager(history).export_bookmarks(options.output, options.format, options.gzip,
+                                                                   options.since, options.until)
+    finally:
+        history.close()
+    print(f"Exported {count:,} bookmarks to {options.output}")
+    return 0
+    
+def run_compact_history(args):
+    parser = argparse.ArgumentParser(prog='browser.py --compact-history',
+                                     description='Rebuild the history database to reclaim free space. '
+                                                 'Close the browser first.')
+    profile_argument(parser)
+    options = parser.parse_args(args)
+    
+    path = StorageService.history_database(options.profile)
+    if not os.path.isfile(path):
+        print(f"No history for profile {options.profile!r} at {path}")
+        return 1
+        
+    try:
+        freed = EnhancedHistoryManager.compact_database(path)
+    except sqlite3.Error as e:
+        print(f"Error compacting {path}: {str(e)}")
+        return 1
+    print(f"Compacted {path}, freeing {max(freed, 0) / 1048576:.1f} MB")
+    return 0
+    
+# Headless tools, dispatched on the first command line argument
+COMMAND_LINE_TOOLS = {
+    '--export-history': run_export_history,
+    '--export-bookmarks': run_export_bookmarks,
+    '--compact-history': run_compact_history,
+    '--bench-adblock': run_adblock_benchmark,
+    '--bench-safe-browsing': run_safe_browsing_benchmark,
+    '--bench-interceptor': run_interceptor_benchmark,
+    '--bench-history-writer': run_history_writer_benchmark,
+    '--bench-history-search': run_history_search_benchmark,
+    '--bench-omnibox': run_omnibox_benchmark,
+    '--bench-quick-open': run_quick_open_benchmark,
+    '--bench-history-import': run_history_import_benchmark
+}
+
 def main():
+    # Command line tools run without creating a window, but read the same data locations
+    if len(sys.argv) > 1 and sys.argv[1] in COMMAND_LINE_TOOLS:
+        QCoreApplication.setOrganizationName("NexusBrowser")
+        QCoreApplication.setApplicationName("Nexus Browser")
+        sys.exit(COMMAND_LINE_TOOLS[sys.argv[1]](sys.argv[2:]))
+        
     # Create application
     app = QApplication(sys.argv)
     app.setApplicationName("Nexus Browser")